@@ -0,0 +1,69 @@
+"""
+This script converts the sharded checkpoints saved by
+`train_eagle3.py --checkpoint-format sharded` to the save_pretrained format of the draft
+model, which SGLang loads.
+
+Usage:
+python scripts/consolidate_checkpoint.py \
+    --checkpoint-dir ./outputs/llama3-8b-eagle3/epoch_0_step_5000
+
+python scripts/consolidate_checkpoint.py \
+    --checkpoint-dir ./outputs/llama3-8b-eagle3 \
+    --all
+"""
+
+import argparse
+import os
+
+from specforge.checkpoint import (
+    consolidate_checkpoint,
+    is_consolidated,
+    list_checkpoints,
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Convert sharded checkpoints to the save_pretrained format"
+    )
+    parser.add_argument(
+        "--checkpoint-dir",
+        type=str,
+        required=True,
+        help="A checkpoint directory, or the output directory of the training with --all",
+    )
+    parser.add_argument(
+        "--output-dir",
+        type=str,
+        default=None,
+        help="The directory to save the draft model to, the checkpoint directory by default",
+    )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="Convert all the checkpoints of the output directory which are not converted yet",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.all:
+        if args.output_dir is not None:
+            raise ValueError("--output-dir is not supported with --all")
+        checkpoint_dirs = [
+            path
+            for path in list_checkpoints(args.checkpoint_dir)
+            if not is_consolidated(path)
+        ]
+    else:
+        checkpoint_dirs = [args.checkpoint_dir]
+
+    for checkpoint_dir in checkpoint_dirs:
+        output_dir = args.output_dir or checkpoint_dir
+        consolidate_checkpoint(checkpoint_dir, output_dir)
+        print(f"Saved {checkpoint_dir} to {os.path.abspath(output_dir)}")
+
+
+if __name__ == "__main__":
+    main()
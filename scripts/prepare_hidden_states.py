@@ -30,16 +30,41 @@ torchrun --nproc_per_node=8 \
     --chat-template llama3 \
     --is-preformatted \
     --max-length 2048
+
+To store the hidden states in packed shards instead of one file per sample, add --output-format packed:
+torchrun --nproc_per_node=8 \
+    scripts/prepare_hidden_states.py \
+    --target-model-path meta-llama/Llama-3.1-8B-Instruct \
+    --enable-aux-hidden-states \
+    --data-path ./cache/dataset/sharegpt_train.jsonl \
+    --output-path ./cache/hidden_states \
+    --chat-template llama3 \
+    --output-format packed \
+    --samples-per-shard 1000
+
+The packed shards can be compressed with zstd or lz4 by adding --shard-codec:
+    --output-format packed --shard-codec zstd
+
+To quantize the stored hidden states to FP8 or INT8, add --quantize-dtype and optionally --quantize-granularity:
+    --quantize-dtype fp8 --quantize-granularity per_token
+
+To store the top-k teacher probabilities over the draft vocab instead of the last hidden states, add --store-topk.
+The vocab mapping is saved along with the hidden states and must be reused for the eval set with --vocab-mapping-path:
+    --store-topk 64 --draft-vocab-size 32000
 """
 
 import argparse
 import gc
-import hashlib
+import io
 import os
-from concurrent.futures import ThreadPoolExecutor
-from dataclasses import asdict, dataclass
+import shutil
+import threading
+import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import torch
 import torch.distributed as dist
@@ -48,7 +73,32 @@ from tqdm import tqdm
 from transformers import AutoConfig, AutoProcessor, AutoTokenizer
 
 from specforge.args import SGLangBackendArgs
-from specforge.data import build_eagle3_dataset, prepare_dp_dataloaders
+from specforge.core.eagle3 import compute_topk_target_p
+from specforge.data import (
+    build_eagle3_dataset,
+    generate_vocab_mapping_file,
+    prepare_dp_dataloaders,
+)
+from specforge.data.manifest import (
+    ManifestEntry,
+    ManifestWriter,
+    get_partial_manifest_path,
+    merge_manifests,
+    verify_manifest,
+)
+from specforge.data.preprocessing import OFFLINE_VOCAB_MAPPING_FILE
+from specforge.data.quantization import (
+    QUANT_DTYPES,
+    QUANT_GRANULARITIES,
+    quantize_hidden_states,
+)
+from specforge.data.shard import SHARD_CODECS, ShardReader, ShardWriter, list_shard_dirs
+from specforge.data.utils import (
+    DataCollatorWithPadding,
+    TokenBudgetBatchSampler,
+    VlmDataCollatorWithPadding,
+    get_sample_lengths,
+)
 from specforge.distributed import (
     destroy_distributed,
     get_dp_group,
@@ -56,7 +106,11 @@ from specforge.distributed import (
     init_distributed,
     is_tp_rank_0,
 )
-from specforge.modeling.target import Eagle3TargetModel, get_eagle3_target_model
+from specforge.modeling.target import (
+    Eagle3TargetModel,
+    TargetHead,
+    get_eagle3_target_model,
+)
 from specforge.utils import print_with_rank, rank_0_priority
 
 
@@ -64,8 +118,86 @@ from specforge.utils import print_with_rank, rank_0_priority
 class DataPoint:
     input_ids: torch.Tensor
     loss_mask: torch.Tensor
-    hidden_state: torch.Tensor
+    hidden_state: Optional[torch.Tensor] = None
     aux_hidden_state: Optional[torch.Tensor] = None
+    hidden_state_scale: Optional[torch.Tensor] = None
+    aux_hidden_state_scale: Optional[torch.Tensor] = None
+    target_topk_probs: Optional[torch.Tensor] = None
+    target_topk_indices: Optional[torch.Tensor] = None
+    target_in_draft: Optional[torch.Tensor] = None
+    # the granularity of the scales, so that the training does not guess it from their shape
+    quantize_granularity: Optional[str] = None
+
+
+# the fields of DataPoint which are saved with a batch dimension
+BATCH_DIM_FIELDS = [
+    "hidden_state",
+    "aux_hidden_state",
+    "hidden_state_scale",
+    "aux_hidden_state_scale",
+]
+# alignment in bytes of the tensors in the staging buffer of the batched transfers
+STAGING_ALIGNMENT = 16
+
+
+def _compact(tensor: Optional[torch.Tensor]) -> Optional[torch.Tensor]:
+    """Copy a tensor which is a view on a larger storage, torch.save would save the whole storage."""
+    if (
+        isinstance(tensor, torch.Tensor)
+        and tensor.untyped_storage().nbytes() > tensor.nbytes
+    ):
+        return tensor.clone()
+    return tensor
+
+
+class PinnedBufferPool:
+    """
+    A pool of pinned CPU buffers whose total size is bounded by a RAM budget. Released
+    buffers are reused by the next acquisitions. This class is thread-safe.
+    """
+
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self.allocated_bytes = 0
+        self.num_in_use = 0
+        self._free_buffers: List[torch.Tensor] = []
+        self._lock = threading.Lock()
+
+    def try_acquire(self, nbytes: int) -> Optional[torch.Tensor]:
+        """
+        Get a pinned uint8 buffer of at least nbytes.
+
+        Returns:
+            The buffer, or None if the budget is exhausted by the buffers in use.
+        """
+        with self._lock:
+            candidates = [b for b in self._free_buffers if b.numel() >= nbytes]
+            if len(candidates) > 0:
+                buffer = min(candidates, key=lambda b: b.numel())
+                self._free_buffers.remove(buffer)
+                self.num_in_use += 1
+                return buffer
+
+            # drop the free buffers which are too small to make room for a new one
+            while (
+                self.allocated_bytes + nbytes > self.budget_bytes
+                and len(self._free_buffers) > 0
+            ):
+                self.allocated_bytes -= self._free_buffers.pop().numel()
+            # a single buffer larger than the budget is allowed to avoid a deadlock
+            if (
+                self.allocated_bytes + nbytes > self.budget_bytes
+                and self.num_in_use > 0
+            ):
+                return None
+            self.allocated_bytes += nbytes
+            self.num_in_use += 1
+        return torch.empty(nbytes, dtype=torch.uint8, pin_memory=True)
+
+    def release(self, buffer: torch.Tensor) -> None:
+        with self._lock:
+            self._free_buffers.append(buffer)
+            self.num_in_use -= 1
 
 
 def parse_args():
@@ -79,6 +211,12 @@ def parse_args():
     )
     model_group.add_argument("--enable-aux-hidden-states", action="store_true")
     model_group.add_argument("--aux-hidden-states-layers", type=str, default=None)
+    model_group.add_argument(
+        "--lm-head-key",
+        type=str,
+        default="lm_head.weight",
+        help="The key of the lm head weight to load from the target model, only used with --store-topk",
+    )
 
     data_group = parser.add_argument_group("data")
     data_group.add_argument("--data-path", type=str, required=True)
@@ -91,10 +229,23 @@ def parse_args():
     )
     data_group.add_argument("--num-samples", type=int, default=None)
     data_group.add_argument("--build-dataset-num-proc", type=int, default=8)
+    data_group.add_argument(
+        "--compact-dataset",
+        action="store_true",
+        help="Cache the processed dataset as memory-mapped flat token buffers with a bit-packed loss mask "
+        "instead of Arrow, which is smaller and faster to read. Not supported with --is-vlm.",
+    )
 
     inference_group = parser.add_argument_group("inference")
     inference_group.add_argument("--tp-size", type=int, default=1)
     inference_group.add_argument("--batch-size", type=int, default=32)
+    inference_group.add_argument(
+        "--max-tokens-per-batch",
+        type=int,
+        default=None,
+        help="Group the samples of similar lengths into batches of at most this many padded tokens "
+        "per extend call, --batch-size is then the max number of samples in a batch.",
+    )
 
     others_group = parser.add_argument_group("others")
     others_group.add_argument("--cache-dir", type=str, default="./cache")
@@ -132,6 +283,89 @@ def parse_args():
         default=2000,
         help="Number of files per subdirectory.",
     )
+    others_group.add_argument(
+        "--journal-verify-tail",
+        type=int,
+        default=256,
+        help="Number of trailing entries of the completion journal whose checksum is verified on resume, "
+        "the corrupted samples are generated again.",
+    )
+    others_group.add_argument(
+        "--batched-transfer",
+        action="store_true",
+        help="Screen NaN on the GPU and transfer each batch to the CPU with a single copy to a pinned "
+        "staging buffer, instead of transferring the samples one by one. This trades CPU RAM for throughput.",
+    )
+    others_group.add_argument(
+        "--io-ram-budget-gb",
+        type=float,
+        default=16,
+        help="Max size of the pinned staging buffers held by the pending writes, only used with --batched-transfer.",
+    )
+    others_group.add_argument(
+        "--output-format",
+        type=str,
+        default="ckpt",
+        choices=["ckpt", "packed"],
+        help="The storage format of the hidden states. 'ckpt' saves one file per sample, "
+        "'packed' appends the samples to memory-mappable shards, one shard directory per DP rank.",
+    )
+    others_group.add_argument(
+        "--samples-per-shard",
+        type=int,
+        default=1000,
+        help="Number of samples per shard, only used when --output-format is packed.",
+    )
+    others_group.add_argument(
+        "--shard-codec",
+        type=str,
+        default="none",
+        choices=SHARD_CODECS,
+        help="Compress the packed shards with this codec after a byte shuffle, only used when --output-format is packed. "
+        "The samples are decompressed by the DataLoader workers during training.",
+    )
+    others_group.add_argument(
+        "--shard-compression-level",
+        type=int,
+        default=None,
+        help="The compression level of --shard-codec, defaults to the codec's default level.",
+    )
+    others_group.add_argument(
+        "--quantize-dtype",
+        type=str,
+        default=None,
+        choices=list(QUANT_DTYPES.keys()),
+        help="Quantize the stored hidden states to this dtype to reduce the disk usage. "
+        "The hidden states are dequantized to bfloat16 after being copied to the GPU during training.",
+    )
+    others_group.add_argument(
+        "--quantize-granularity",
+        type=str,
+        default="per_token",
+        choices=QUANT_GRANULARITIES,
+        help="The granularity of the quantization scales. 'per_token' uses one scale per token "
+        "and per captured layer, 'per_channel' uses one scale per channel for each sample.",
+    )
+    others_group.add_argument(
+        "--store-topk",
+        type=int,
+        default=None,
+        help="Store the top-k probabilities of the target model over the draft vocab instead of "
+        "the last hidden states, which removes the lm head projection from offline training.",
+    )
+    others_group.add_argument(
+        "--draft-vocab-size",
+        type=int,
+        default=32000,
+        help="The draft vocab size used to compute the vocab mapping, only used with --store-topk.",
+    )
+    others_group.add_argument(
+        "--vocab-mapping-path",
+        type=str,
+        default=None,
+        help="Use an existing vocab mapping file instead of computing it from the dataset, "
+        "only used with --store-topk.",
+    )
 
     sglang_group = parser.add_argument_group("sglang")
     SGLangBackendArgs.add_args(sglang_group)
@@ -205,6 +439,18 @@ class HiddenStatesGenerator:
         num_io_threads: int = 4,
         io_queue_size: int = 50,
         file_group_size: int = 2000,
+        output_format: str = "ckpt",
+        samples_per_shard: int = 1000,
+        shard_codec: str = "none",
+        shard_compression_level: Optional[int] = None,
+        quantize_dtype: Optional[str] = None,
+        quantize_granularity: str = "per_token",
+        target_head: Optional[TargetHead] = None,
+        t2d: Optional[torch.Tensor] = None,
+        store_topk: Optional[int] = None,
+        batched_transfer: bool = False,
+        io_ram_budget_gb: float = 16,
+        journal_verify_tail: int = 256,
     ):
         """
         Args:
@@ -213,6 +459,18 @@ class HiddenStatesGenerator:
             num_io_threads: Number of threads for async I/O.
             io_queue_size: Max number of pending I/O futures before cleanup.
             file_group_size: Number of files per subdirectory.
+            output_format: "ckpt" to save one file per sample, "packed" to append samples to shards.
+            samples_per_shard: Number of samples per shard for the packed format.
+            shard_codec: "none", "zstd" or "lz4", the codec used to compress the shards.
+            shard_compression_level: The compression level of shard_codec.
+            quantize_dtype: If set, quantize the hidden states to "fp8" or "int8" before saving.
+            quantize_granularity: "per_token" or "per_channel" quantization scales.
+            target_head: The lm head of the target model, required by store_topk.
+            t2d: The boolean mask of the target tokens which are in the draft vocab, required by store_topk.
+            store_topk: If set, save the top-k target probabilities over the draft vocab instead of the last hidden states.
+            batched_transfer: Whether to transfer each batch to the CPU with a single copy, io_queue_size is replaced by io_ram_budget_gb.
+            io_ram_budget_gb: Max size in GB of the pinned staging buffers used by batched_transfer.
+            journal_verify_tail: Number of trailing entries of the completion journal verified on resume.
         """
         self.model = target_model
         self.enable_aux_hidden_states = enable_aux_hidden_states
@@ -221,6 +479,31 @@ class HiddenStatesGenerator:
         self.num_io_threads = num_io_threads
         self.io_queue_size = io_queue_size
         self.file_group_size = file_group_size
+        self.output_format = output_format
+        self.samples_per_shard = samples_per_shard
+        self.shard_codec = shard_codec
+        self.shard_compression_level = shard_compression_level
+        self.shard_writer = None
+        self.manifest_writer = None
+        self.output_path = None
+        # token statistics of the samples in the current shard, recorded in the manifest
+        # once the shard is finalized
+        self._pending_shard_stats = {}
+        self.quantize_dtype = quantize_dtype
+        self.quantize_granularity = quantize_granularity
+        self.target_head = target_head
+        self.t2d = t2d
+        self.store_topk = store_topk
+        self.batched_transfer = batched_transfer
+        self.journal_verify_tail = journal_verify_tail
+        # whether the output was written by a run without completion journal, the files
+        # then have to be probed to resume
+        self._legacy_resume = False
+        self.staging_pool = (
+            PinnedBufferPool(int(io_ram_budget_gb * 1024**3))
+            if batched_transfer
+            else None
+        )
 
         # progress bar should only shown on TP rank = 0
         self.show_progress = dist.get_rank(get_tp_group()) == 0
@@ -232,7 +515,11 @@ class HiddenStatesGenerator:
     def __enter__(self):
         """Initializes resources when entering a 'with' block."""
         if is_tp_rank_0():
-            self.io_executor = ThreadPoolExecutor(max_workers=self.num_io_threads)
+            # samples are appended to the shard sequentially, so a single writer thread is used
+            num_io_threads = (
+                1 if self.output_format == "packed" else self.num_io_threads
+            )
+            self.io_executor = ThreadPoolExecutor(max_workers=num_io_threads)
         self.pending_futures = []
         return self
 
@@ -244,43 +531,221 @@ class HiddenStatesGenerator:
             self._wait_all_saves()
             self.io_executor.shutdown(wait=True)
             self.io_executor = None  # Reset for safety
+            if self.shard_writer is not None:
+                self._add_shard_manifest_entries(self.shard_writer.close())
+                self.shard_writer = None
+            if self.manifest_writer is not None:
+                self.manifest_writer.close()
+                self.manifest_writer = None
 
         # Final barrier to ensure all processes exit generate() cleanly
         dist.barrier()
 
-    def _save_tensor_sync(self, data_point: DataPoint, output_file: str) -> None:
+    def _has_nan(self, data_point: DataPoint, name: str) -> bool:
         """
-        Save a data point to a file synchronously. If there is any NaN value in the data, this datapoint will be skipped.
+        Check if there is any NaN value in the hidden states of the data point.
 
         Args:
-            data_point (DataPoint): The data point to save.
-            output_file (str): The path to the output file.
+            data_point (DataPoint): The data point to check.
+            name (str): The name of the data point used in the warning message.
+
+        Returns:
+            bool: True if NaN is found.
         """
         if data_point.hidden_state is not None and torch.any(
             torch.isnan(data_point.hidden_state)
         ):
-            print(
-                f"Warning: NaN found in hidden_state for {output_file}. Skipping save."
-            )
-            return
+            print(f"Warning: NaN found in hidden_state for {name}. Skipping save.")
+            return True
 
         if data_point.aux_hidden_state is not None and torch.any(
             torch.isnan(data_point.aux_hidden_state)
         ):
-            print(
-                f"Warning: NaN found in aux_hidden_state for {output_file}. Skipping save."
+            print(f"Warning: NaN found in aux_hidden_state for {name}. Skipping save.")
+            return True
+
+        # the quantized values cannot hold NaN (e.g. int8), but a NaN always propagates to its scale
+        for scale_name in ["hidden_state_scale", "aux_hidden_state_scale"]:
+            scale = getattr(data_point, scale_name)
+            if scale is not None and torch.any(torch.isnan(scale)):
+                print(f"Warning: NaN found in {scale_name} for {name}. Skipping save.")
+                return True
+
+        if data_point.target_topk_probs is not None and torch.any(
+            torch.isnan(data_point.target_topk_probs)
+        ):
+            print(f"Warning: NaN found in target_topk_probs for {name}. Skipping save.")
+            return True
+        return False
+
+    def _save_tensor_sync(
+        self,
+        data_point: DataPoint,
+        output_file: str,
+        sample_id: int,
+        check_nan: bool = True,
+    ) -> None:
+        """
+        Save a data point to a file synchronously and record it in the manifest. If there is any NaN value in the data, this datapoint will be skipped.
+
+        Args:
+            data_point (DataPoint): The data point to save.
+            output_file (str): The path to the output file.
+            sample_id (int): The global index of the data point.
+            check_nan (bool): Whether to check the data point for NaN, it is done on the GPU for batched transfers.
+        """
+        if check_nan and self._has_nan(data_point, output_file):
+            return
+
+        # the tensors of a batched transfer are views on the staging buffer, they are
+        # compacted so that only their own bytes are serialized
+        data = {name: _compact(value) for name, value in vars(data_point).items()}
+        # serialize in memory once so that the checksum does not require reading the file back
+        buffer = io.BytesIO()
+        torch.save(data, buffer)
+        data = buffer.getvalue()
+        with open(output_file, "wb") as f:
+            f.write(data)
+            # the journal entry must not reach the disk before the data it refers to
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.manifest_writer.add(
+            ManifestEntry(
+                sample_id=sample_id,
+                path=os.path.relpath(output_file, self.output_path),
+                num_tokens=data_point.input_ids.shape[0],
+                num_loss_tokens=int(data_point.loss_mask.sum()),
+                checksum=zlib.crc32(data),
+            )
+        )
+
+    def _recover_manifest_entry(self, output_file: str, sample_id: int) -> None:
+        """
+        Record a data point saved by a previous run which is missing from the manifest.
+
+        Args:
+            output_file (str): The path to the saved file.
+            sample_id (int): The global index of the data point.
+        """
+        with open(output_file, "rb") as f:
+            data = f.read()
+            # the file of the previous run may not have reached the disk yet
+            os.fsync(f.fileno())
+        data_point = torch.load(io.BytesIO(data), weights_only=False)
+        self.manifest_writer.add(
+            ManifestEntry(
+                sample_id=sample_id,
+                path=os.path.relpath(output_file, self.output_path),
+                num_tokens=data_point["input_ids"].shape[0],
+                num_loss_tokens=int(data_point["loss_mask"].sum()),
+                checksum=zlib.crc32(data),
             )
+        )
+
+    def _verify_journal_tail(self) -> None:
+        """
+        Verify the samples of the last entries of the completion journal. The entries are
+        appended once the data is fsynced, this catches the last samples of an output
+        written otherwise, e.g. copied or written by an older run, which may be missing or
+        truncated after a crash. They are removed from the journal to be generated again.
+        """
+        entries = list(self.manifest_writer.entries.values())
+        tail = entries[max(len(entries) - self.journal_verify_tail, 0) :]
+        corrupted = verify_manifest(self.output_path, tail)
+        if len(corrupted) > 0:
+            print_with_rank(
+                f"Found {len(corrupted)} missing or corrupted samples in the completion journal, "
+                "they will be generated again."
+            )
+            self.manifest_writer.discard([entry.sample_id for entry in corrupted])
+
+    def _add_shard_manifest_entries(self, shard_dir: Optional[str]) -> None:
+        """
+        Record the data points of a finalized shard in the manifest, the data points already in the manifest are skipped.
+
+        Args:
+            shard_dir (Optional[str]): The directory of the finalized shard, nothing is recorded if None.
+        """
+        if shard_dir is None:
             return
+        reader = ShardReader(shard_dir)
+        for local_index, sample_id in enumerate(reader.sample_ids):
+            if sample_id in self.manifest_writer.entries:
+                continue
+            if sample_id in self._pending_shard_stats:
+                num_tokens, num_loss_tokens = self._pending_shard_stats.pop(sample_id)
+            else:
+                # written by a run which did not record it in the manifest
+                loss_mask = reader[local_index]["loss_mask"]
+                num_tokens, num_loss_tokens = loss_mask.shape[0], int(loss_mask.sum())
+            self.manifest_writer.add(
+                ManifestEntry(
+                    sample_id=sample_id,
+                    path=os.path.relpath(shard_dir, self.output_path),
+                    num_tokens=num_tokens,
+                    num_loss_tokens=num_loss_tokens,
+                    checksum=reader.checksums[local_index],
+                    index=local_index,
+                )
+            )
+        # the shard is fsynced before its index is written, so is its journal
+        self.manifest_writer.sync()
 
-        torch.save(asdict(data_point), output_file)
+    def _write_shard_sync(
+        self, data_point: DataPoint, sample_id: int, check_nan: bool = True
+    ) -> None:
+        """
+        Append a data point to the current shard synchronously. If there is any NaN value in the data, this datapoint will be skipped.
 
-    def _save_tensor_async(self, data_point: DataPoint, output_file: str) -> None:
+        Args:
+            data_point (DataPoint): The data point to save.
+            sample_id (int): The global index of the data point.
+            check_nan (bool): Whether to check the data point for NaN, it is done on the GPU for batched transfers.
+        """
+        if check_nan and self._has_nan(data_point, f"sample {sample_id}"):
+            return
+
+        # the hidden states carry a batch dimension of 1, the shards are stored token-major
+        tensors = {
+            "input_ids": data_point.input_ids,
+            "loss_mask": data_point.loss_mask,
+            "aux_hidden_state": data_point.aux_hidden_state.squeeze(0),
+        }
+        if data_point.hidden_state is not None:
+            tensors["hidden_state"] = data_point.hidden_state.squeeze(0)
+        for name in ["target_topk_probs", "target_topk_indices", "target_in_draft"]:
+            tensor = getattr(data_point, name)
+            if tensor is not None:
+                tensors[name] = tensor
+        sample_tensors = {}
+        for scale_name in ["hidden_state_scale", "aux_hidden_state_scale"]:
+            scale = getattr(data_point, scale_name)
+            if scale is None:
+                continue
+            scale = scale.squeeze(0)
+            if self.quantize_granularity == "per_token":
+                tensors[scale_name] = scale
+            else:
+                sample_tensors[scale_name] = scale
+        self._pending_shard_stats[sample_id] = (
+            data_point.input_ids.shape[0],
+            int(data_point.loss_mask.sum()),
+        )
+        self._add_shard_manifest_entries(
+            self.shard_writer.write(sample_id, tensors, sample_tensors)
+        )
+
+    def _save_tensor_async(
+        self, data_point: DataPoint, sample_id: int, output_path: str
+    ) -> None:
         """
         Submit a job to the io_executor to save the data point asynchronously.
 
         Args:
             data_point (DataPoint): The data point to save.
-            output_file (str): The path to the output file.
+            sample_id (int): The global index of the data point.
+            output_path (str): The path to the output directory.
         """
         assert is_tp_rank_0(), "Only tp_rank=0 should call _save_tensor_async"
         # If the queue of pending save operations is full, we must wait.
@@ -293,10 +758,37 @@ class HiddenStatesGenerator:
             if len(self.pending_futures) >= self.io_queue_size:
                 self.pending_futures.pop(0).result()
 
-        future = self.io_executor.submit(
-            self._save_tensor_sync, data_point, output_file
+        self.pending_futures.append(
+            self._submit_save(data_point, sample_id, output_path)
+        )
+
+    def _submit_save(
+        self,
+        data_point: DataPoint,
+        sample_id: int,
+        output_path: str,
+        check_nan: bool = True,
+    ) -> Future:
+        """
+        Submit the save of a data point to the io_executor in the configured output format.
+
+        Args:
+            data_point (DataPoint): The data point to save.
+            sample_id (int): The global index of the data point.
+            output_path (str): The path to the output directory.
+            check_nan (bool): Whether to check the data point for NaN before saving.
+
+        Returns:
+            Future: The future of the save.
+        """
+        if self.output_format == "packed":
+            return self.io_executor.submit(
+                self._write_shard_sync, data_point, sample_id, check_nan
+            )
+        output_file = self._get_file_path(output_path, sample_id)
+        return self.io_executor.submit(
+            self._save_tensor_sync, data_point, output_file, sample_id, check_nan
         )
-        self.pending_futures.append(future)
 
     def _wait_all_saves(self):
         """
@@ -342,7 +834,9 @@ class HiddenStatesGenerator:
         self, output_path: str, global_indices: List[int]
     ) -> List[bool]:
         """
-        A helper function to check if the files for the given global indices exist.
+        A helper function to check if the samples of the given global indices were already saved.
+        The completion journal is the source of truth, the files are only probed for outputs
+        written without journal.
 
         Args:
             output_path (str): The path to the output directory.
@@ -354,14 +848,233 @@ class HiddenStatesGenerator:
         if not is_tp_rank_0():
             return [False] * len(global_indices)
 
+        if self.output_format == "packed" or not self._legacy_resume:
+            return [idx in self.manifest_writer.entries for idx in global_indices]
+
         def check_single_file(idx):
-            return os.path.exists(self._get_file_path(output_path, idx))
+            if idx in self.manifest_writer.entries:
+                return True
+            output_file = self._get_file_path(output_path, idx)
+            if not os.path.exists(output_file):
+                return False
+            # saved by a run which did not write the manifest
+            self._recover_manifest_entry(output_file, idx)
+            return True
 
         # Parallel file existence check
         with ThreadPoolExecutor(max_workers=self.num_io_threads) as executor:
             exists = list(executor.map(check_single_file, global_indices))
         return exists
 
+    def _quantize(
+        self, hidden_states: Optional[torch.Tensor], num_groups: int
+    ) -> Tuple[Optional[torch.Tensor], Optional[torch.Tensor]]:
+        """
+        Quantize the hidden states of one sample with the configured dtype and granularity.
+
+        Args:
+            hidden_states (Optional[torch.Tensor]): The hidden states of shape (seq_len, hidden_size).
+            num_groups (int): The number of channel groups for per-token scales, i.e. the number of captured layers.
+
+        Returns:
+            Tuple[Optional[torch.Tensor], Optional[torch.Tensor]]: The quantized hidden states and their scales.
+        """
+        if hidden_states is None:
+            return None, None
+        return quantize_hidden_states(
+            hidden_states,
+            dtype=self.quantize_dtype,
+            granularity=self.quantize_granularity,
+            num_groups=num_groups,
+        )
+
+    def _process_sample_on_gpu(
+        self,
+        aux_hidden_states: Optional[torch.Tensor],
+        last_hidden_states: Optional[torch.Tensor],
+    ) -> Dict[str, torch.Tensor]:
+        """
+        Compute the tensors to save for one sample on the GPU, so that less data is transferred to CPU.
+
+        Args:
+            aux_hidden_states (Optional[torch.Tensor]): The aux hidden states of shape (seq_len, num_aux_layers * hidden_size).
+            last_hidden_states (Optional[torch.Tensor]): The last hidden states of shape (seq_len, hidden_size).
+
+        Returns:
+            Dict[str, torch.Tensor]: A mapping from DataPoint field name to tensor, without batch dimension.
+        """
+        fields = {}
+        # the aux hidden states concatenate those of the captured layers, each layer has
+        # its own per-token scales
+        num_aux_layers = 1
+        if aux_hidden_states is not None and last_hidden_states is not None:
+            num_aux_layers = aux_hidden_states.shape[-1] // last_hidden_states.shape[-1]
+        # replace the last hidden states by the sparse teacher distribution
+        if self.store_topk is not None:
+            (
+                fields["target_topk_probs"],
+                fields["target_topk_indices"],
+                fields["target_in_draft"],
+            ) = compute_topk_target_p(
+                self.target_head(last_hidden_states), self.t2d, self.store_topk
+            )
+            last_hidden_states = None
+
+        if self.quantize_dtype is not None:
+            aux_hidden_states, fields["aux_hidden_state_scale"] = self._quantize(
+                aux_hidden_states, num_groups=num_aux_layers
+            )
+            last_hidden_states, fields["hidden_state_scale"] = self._quantize(
+                last_hidden_states, num_groups=1
+            )
+        fields["aux_hidden_state"] = aux_hidden_states
+        fields["hidden_state"] = last_hidden_states
+        return {name: tensor for name, tensor in fields.items() if tensor is not None}
+
+    def _to_data_point(
+        self,
+        input_ids: torch.Tensor,
+        loss_mask: torch.Tensor,
+        fields: Dict[str, torch.Tensor],
+    ) -> DataPoint:
+        """
+        Build a data point from the CPU tensors returned by `_process_sample_on_gpu`.
+        The hidden states and their scales are saved with a batch dimension.
+        """
+        fields = {
+            name: tensor.unsqueeze(0) if name in BATCH_DIM_FIELDS else tensor
+            for name, tensor in fields.items()
+        }
+        return DataPoint(
+            input_ids=input_ids,
+            loss_mask=loss_mask,
+            quantize_granularity=(
+                self.quantize_granularity if self.quantize_dtype is not None else None
+            ),
+            **fields,
+        )
+
+    def _has_nan_gpu(self, fields: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """
+        Check if there is any NaN value in the tensors of one sample without synchronizing with the GPU.
+
+        Args:
+            fields (Dict[str, torch.Tensor]): The tensors returned by `_process_sample_on_gpu`.
+
+        Returns:
+            torch.Tensor: A boolean scalar tensor on the GPU.
+        """
+        # the quantized values cannot hold NaN (e.g. int8), but a NaN always propagates to its scale
+        flags = [
+            torch.isnan(tensor).any()
+            for tensor in fields.values()
+            if tensor.is_floating_point() and tensor.element_size() > 1
+        ]
+        if len(flags) == 0:
+            return torch.zeros((), dtype=torch.bool, device="cuda")
+        return torch.stack(flags).any()
+
+    def _save_batch_async(
+        self,
+        batch: Dict[str, torch.Tensor],
+        sample_fields: List[Dict[str, torch.Tensor]],
+        sample_ids: List[int],
+        output_path: str,
+    ) -> None:
+        """
+        Screen the samples of a batch for NaN on the GPU, transfer them to a pinned staging buffer
+        with a single copy and submit the saves of the slices to the io_executor.
+
+        Args:
+            batch (Dict[str, torch.Tensor]): The CPU batch with the input_ids and loss_mask.
+            sample_fields (List[Dict[str, torch.Tensor]]): The GPU tensors of each sample.
+            sample_ids (List[int]): The global index of each sample.
+            output_path (str): The path to the output directory.
+        """
+        self.pending_futures = [f for f in self.pending_futures if not f.done()]
+
+        # 1. one device sync for the NaN screening of the whole batch
+        has_nan = torch.stack(
+            [self._has_nan_gpu(fields) for fields in sample_fields]
+        ).tolist()
+        valid = []
+        for i, sample_id in enumerate(sample_ids):
+            if has_nan[i]:
+                print(f"Warning: NaN found for sample {sample_id}. Skipping save.")
+            else:
+                valid.append(i)
+        if len(valid) == 0:
+            return
+
+        # 2. pack the samples into one contiguous buffer on the GPU, each tensor is aligned
+        # so that its slice of the staging buffer can be viewed with its dtype
+        chunks, layouts, offset = [], [], 0
+        for i in valid:
+            layout = {}
+            for name, tensor in sample_fields[i].items():
+                data = tensor.contiguous().reshape(-1).view(torch.uint8)
+                layout[name] = (tensor.dtype, tensor.shape, offset, data.numel())
+                chunks.append(data)
+                offset += data.numel()
+                if offset % STAGING_ALIGNMENT != 0:
+                    padding_size = STAGING_ALIGNMENT - offset % STAGING_ALIGNMENT
+                    chunks.append(
+                        torch.empty(padding_size, dtype=torch.uint8, device="cuda")
+                    )
+                    offset += padding_size
+            layouts.append(layout)
+        gpu_buffer = torch.cat(chunks)
+        del chunks
+
+        # 3. a single async copy to the staging buffer, the RAM budget bounds the number of
+        # buffers held by the pending writes
+        staging = self._acquire_staging_buffer(gpu_buffer.numel())
+        staging[: gpu_buffer.numel()].copy_(gpu_buffer, non_blocking=True)
+        torch.cuda.current_stream().synchronize()
+        del gpu_buffer
+
+        # 4. hand the slices to the writer threads, the staging buffer is released once all
+        # of them are saved
+        remaining = [len(valid)]
+        lock = threading.Lock()
+
+        def release(_):
+            with lock:
+                remaining[0] -= 1
+                done = remaining[0] == 0
+            if done:
+                self.staging_pool.release(staging)
+
+        for i, layout in zip(valid, layouts):
+            fields = {
+                name: staging[start : start + nbytes].view(dtype).view(shape)
+                for name, (dtype, shape, start, nbytes) in layout.items()
+            }
+            data_point = self._to_data_point(
+                batch["input_ids"][i].clone(), batch["loss_mask"][i].clone(), fields
+            )
+            future = self._submit_save(
+                data_point, sample_ids[i], output_path, check_nan=False
+            )
+            future.add_done_callback(release)
+            self.pending_futures.append(future)
+
+    def _acquire_staging_buffer(self, nbytes: int) -> torch.Tensor:
+        """
+        Get a pinned staging buffer of at least nbytes, waiting for the pending writes to
+        complete if the RAM budget is exhausted.
+        """
+        while True:
+            buffer = self.staging_pool.try_acquire(nbytes)
+            if buffer is not None:
+                return buffer
+            self.pending_futures = [f for f in self.pending_futures if not f.done()]
+            if len(self.pending_futures) == 0:
+                # the buffers are released by the future callbacks, retry
+                time.sleep(0.01)
+                continue
+            self.pending_futures.pop(0).result()
+
     def _get_file_path(self, output_path: str, idx: int) -> str:
         """
         A helper function to get the standard file path for the data point with the given index.
@@ -386,17 +1099,65 @@ class HiddenStatesGenerator:
         samples_per_dp: int = 0,
     ):
         """
-        This version prioritizes minimal CPU RAM usage above all else, even at the cost of performance.
+        By default, this version prioritizes minimal CPU RAM usage above all else, even at the cost of performance.
         - It processes samples one-by-one within the tp_rank_0 process.
         - It avoids batching GPU-to-CPU transfers.
         - It ensures only one sample's data is in RAM for I/O at any given time.
+
+        With batched_transfer, it prioritizes throughput instead.
+        - It screens the samples for NaN on the GPU with a single device sync per batch.
+        - It transfers each batch to a reusable pinned staging buffer with a single copy.
+        - It bounds the RAM held by the pending writes with io_ram_budget_gb.
         """
-        self._prepare_output_dirs(output_path, start_idx, samples_per_dp)
+        self.output_path = output_path
+        if is_tp_rank_0():
+            self.manifest_writer = ManifestWriter(
+                get_partial_manifest_path(output_path, dist.get_rank(get_dp_group())),
+                # the packed format syncs the journal along with the shards
+                sync_interval=(
+                    self.samples_per_shard
+                    if self.output_format == "packed"
+                    else self.io_queue_size
+                ),
+            )
+            self._legacy_resume = (
+                len(self.manifest_writer.entries) == 0
+                and self.output_format == "ckpt"
+                and any(name.startswith("rows_") for name in os.listdir(output_path))
+            )
+        if self.output_format == "packed":
+            if is_tp_rank_0():
+                self.shard_writer = ShardWriter(
+                    os.path.join(
+                        output_path, f"dp_rank_{dist.get_rank(get_dp_group())}"
+                    ),
+                    samples_per_shard=self.samples_per_shard,
+                    codec=self.shard_codec,
+                    compression_level=self.shard_compression_level,
+                    metadata=(
+                        {"quantize_granularity": self.quantize_granularity}
+                        if self.quantize_dtype is not None
+                        else None
+                    ),
+                )
+                for shard_dir in list_shard_dirs(self.shard_writer.output_dir):
+                    self._add_shard_manifest_entries(shard_dir)
+        else:
+            self._prepare_output_dirs(output_path, start_idx, samples_per_dp)
+        if is_tp_rank_0():
+            self._verify_journal_tail()
 
         tp_group = get_tp_group()
         tp_group_ranks = dist.get_process_group_ranks(tp_group)
         tp_rank_0_global = tp_group_ranks[0]
         global_idx = start_idx
+        # the token budget batches carry the dataset indices of their samples
+        batch_sampler = getattr(data_loader, "batch_sampler", None)
+        sampler_batches = (
+            batch_sampler.batches
+            if isinstance(batch_sampler, TokenBudgetBatchSampler)
+            else None
+        )
 
         progress_bar = tqdm(
             data_loader,
@@ -407,10 +1168,14 @@ class HiddenStatesGenerator:
         )
 
         total_skipped, total_processed = 0, 0
+        total_tokens, start_time = 0, time.perf_counter()
 
         for batch_idx, batch in enumerate(progress_bar):
             batch_size = batch["input_ids"].size(0)
-            current_batch_indices = list(range(global_idx, global_idx + batch_size))
+            if sampler_batches is not None:
+                current_batch_indices = sampler_batches[batch_idx]
+            else:
+                current_batch_indices = list(range(global_idx, global_idx + batch_size))
 
             # # Step 1: Synchronize valid indices across TP group
             # we check which files already exist and sync this info across TP ranks
@@ -446,6 +1211,7 @@ class HiddenStatesGenerator:
                 "loss_mask": batch["loss_mask"][valid_indices_in_batch],
             }
             del batch
+            total_tokens += int(filtered_batch["attention_mask"].sum())
             if num_valid == 0:
                 # Data has already been generated, no sample processing, update progress bar.
                 if self.show_progress:
@@ -473,43 +1239,59 @@ class HiddenStatesGenerator:
             del filtered_batch_gpu
 
             if is_tp_rank_0():
-                for i, (
-                    current_global_idx,
-                    aux_hidden_states,
-                    last_hidden_states,
-                ) in enumerate(
-                    zip(
+                if self.batched_transfer:
+                    # post-process the whole batch on the GPU and transfer it at once
+                    sample_fields = [
+                        self._process_sample_on_gpu(
+                            aux_hidden_states, last_hidden_states
+                        )
+                        for aux_hidden_states, last_hidden_states in zip(
+                            aux_hidden_states_list, last_hidden_states_list
+                        )
+                    ]
+                    self._save_batch_async(
+                        filtered_batch,
+                        sample_fields,
                         sample_global_indices,
-                        aux_hidden_states_list,
-                        last_hidden_states_list,
-                    )
-                ):
-
-                    # Process ONE sample at a time to minimize CPU RAM footprint
-                    # 1. Transfer only the required slice for one sample to CPU
-                    aux_hidden_states = (
-                        aux_hidden_states.cpu().clone().unsqueeze(0)
-                        if aux_hidden_states is not None
-                        else None
-                    )
-                    last_hidden_states = (
-                        last_hidden_states.cpu().clone().unsqueeze(0)
-                        if last_hidden_states is not None
-                        else None
-                    )
-                    data_point = DataPoint(
-                        input_ids=filtered_batch["input_ids"][i].clone(),
-                        loss_mask=filtered_batch["loss_mask"][i].clone(),
-                        hidden_state=last_hidden_states,
-                        aux_hidden_state=aux_hidden_states,
+                        output_path,
                     )
+                    del sample_fields
+                else:
+                    for i, (
+                        current_global_idx,
+                        aux_hidden_states,
+                        last_hidden_states,
+                    ) in enumerate(
+                        zip(
+                            sample_global_indices,
+                            aux_hidden_states_list,
+                            last_hidden_states_list,
+                        )
+                    ):
+                        # Process ONE sample at a time to minimize CPU RAM footprint
+                        # 0. Compute the tensors to save on the GPU
+                        fields = self._process_sample_on_gpu(
+                            aux_hidden_states, last_hidden_states
+                        )
+
+                        # 1. Transfer only the required slice for one sample to CPU
+                        fields = {
+                            name: tensor.cpu().clone()
+                            for name, tensor in fields.items()
+                        }
+                        data_point = self._to_data_point(
+                            filtered_batch["input_ids"][i].clone(),
+                            filtered_batch["loss_mask"][i].clone(),
+                            fields,
+                        )
 
-                    # 3. Save asynchronously (the backpressure logic is still crucial)
-                    output_file = self._get_file_path(output_path, current_global_idx)
-                    self._save_tensor_async(data_point, output_file)
+                        # 2. Save asynchronously (the backpressure logic is still crucial)
+                        self._save_tensor_async(
+                            data_point, current_global_idx, output_path
+                        )
 
-                    # 4. Immediately clean up the single-sample CPU tensors
-                    del last_hidden_states, aux_hidden_states
+                        # 3. Immediately clean up the single-sample CPU tensors
+                        del fields, data_point
 
                 total_processed += len(sample_global_indices)
 
@@ -528,13 +1310,19 @@ class HiddenStatesGenerator:
                         "pending_io": (
                             len(self.pending_futures) if is_tp_rank_0() else 0
                         ),
+                        "tokens/s": f"{total_tokens / (time.perf_counter() - start_time):.0f}",
                     }
                 )
 
         if self.show_progress:
+            elapsed = time.perf_counter() - start_time
             print(
                 f"\nGeneration loop finished. Processed: {total_processed}, Skipped: {total_skipped}"
             )
+            print_with_rank(
+                f"DP Rank {dist.get_rank(get_dp_group())} generated {total_tokens} tokens "
+                f"in {elapsed:.1f}s ({total_tokens / elapsed:.1f} tokens/s)"
+            )
         dist.barrier()
 
 
@@ -570,45 +1358,56 @@ def main():
     if args.num_samples is not None:
         dataset = dataset.select(range(args.num_samples))
 
-    # Tokenizer and cache key
+    # Tokenizer
     tokenizer = AutoTokenizer.from_pretrained(
         args.target_model_path, trust_remote_code=True
     )
-    cache_params_string = f"{args.data_path}-{args.max_length}-{args.chat_template}-{args.target_model_path}-{args.num_samples}-{args.is_preformatted}"
-    cache_key = hashlib.md5(cache_params_string.encode()).hexdigest()
 
     # Preprocess on complete, un-sharded dataset
     with rank_0_priority():
         print_with_rank("Main process is building the dataset cache...")
-        eagle3_dataset = build_eagle3_dataset(
+        # the processed rows are shared with the cache of the training script
+        eagle3_dataset, cache_key = build_eagle3_dataset(
             dataset=dataset,
             tokenizer=tokenizer,
             chat_template=args.chat_template,
             max_length=args.max_length,
             cache_dir=os.path.join(args.cache_dir, "processed_dataset"),
-            cache_key=cache_key,
+            return_cache_key=True,
             is_vlm=args.is_vlm,
             is_preformatted=args.is_preformatted,
             processor=processor,
             num_proc=args.build_dataset_num_proc,
+            compact=args.compact_dataset,
         )
+        target_head, t2d = None, None
+        if args.store_topk is not None:
+            vocab_mapping_path = args.vocab_mapping_path
+            if vocab_mapping_path is None:
+                vocab_mapping_path = generate_vocab_mapping_file(
+                    dataset=eagle3_dataset,
+                    target_vocab_size=target_model_config.vocab_size,
+                    draft_vocab_size=args.draft_vocab_size,
+                    cache_dir=os.path.join(args.cache_dir, "vocab_mapping"),
+                    cache_key=cache_key,
+                    num_proc=args.build_dataset_num_proc,
+                )
+            if dist.get_rank() == 0:
+                # the training script loads the vocab mapping from the hidden states path
+                os.makedirs(args.output_path, exist_ok=True)
+                shutil.copy(
+                    vocab_mapping_path,
+                    os.path.join(args.output_path, OFFLINE_VOCAB_MAPPING_FILE),
+                )
+            if is_tp_rank_0():
+                t2d = torch.load(vocab_mapping_path)["t2d"].cuda()
+                target_head = TargetHead.from_pretrained(
+                    model_path=args.target_model_path,
+                    lm_head_key=args.lm_head_key,
+                    cache_dir=args.model_download_dir,
+                )
     print_with_rank(f"Dataset prepared with {len(eagle3_dataset)} samples.")
 
-    # Create DP-sharded dataloader
-    data_loader = prepare_dp_dataloaders(
-        dataset=eagle3_dataset,
-        batch_size=args.batch_size,
-        num_workers=args.num_workers,
-        shuffle=False,
-        process_group=get_dp_group(),
-        is_vlm=args.is_vlm,
-    )
-
-    print_with_rank(
-        f"DataLoader created for DP Rank {dist.get_rank(get_dp_group())}. "
-        f"Number of batches: {len(data_loader)}"
-    )
-
     # Calculate starting index and sample count for current DP rank
     total = len(eagle3_dataset)
     dp_rank = dist.get_rank(get_dp_group())
@@ -630,6 +1429,42 @@ def main():
         f"starting from index {start_idx}"
     )
 
+    # Create DP-sharded dataloader
+    if args.max_tokens_per_batch is not None:
+        # each DP rank processes its contiguous range of samples sorted by length, the
+        # samples are saved under their dataset index so that the output does not depend
+        # on the batching
+        batch_sampler = TokenBudgetBatchSampler(
+            get_sample_lengths(eagle3_dataset, start_idx, start_idx + samples_per_dp),
+            max_tokens=args.max_tokens_per_batch,
+            indices=range(start_idx, start_idx + samples_per_dp),
+            max_batch_size=args.batch_size,
+        )
+        data_loader = torch.utils.data.DataLoader(
+            eagle3_dataset,
+            batch_sampler=batch_sampler,
+            num_workers=args.num_workers,
+            collate_fn=(
+                VlmDataCollatorWithPadding()
+                if args.is_vlm
+                else DataCollatorWithPadding()
+            ),
+        )
+    else:
+        data_loader = prepare_dp_dataloaders(
+            dataset=eagle3_dataset,
+            batch_size=args.batch_size,
+            num_workers=args.num_workers,
+            shuffle=False,
+            process_group=get_dp_group(),
+            is_vlm=args.is_vlm,
+        )
+
+    print_with_rank(
+        f"DataLoader created for DP Rank {dp_rank}. "
+        f"Number of batches: {len(data_loader)}"
+    )
+
     # Generate hidden states
     try:
         # Pass configurable arguments from args if needed
@@ -639,6 +1474,18 @@ def main():
             num_io_threads=args.num_io_threads,
             io_queue_size=args.io_queue_size,
             file_group_size=args.file_group_size,
+            output_format=args.output_format,
+            samples_per_shard=args.samples_per_shard,
+            shard_codec=args.shard_codec,
+            shard_compression_level=args.shard_compression_level,
+            quantize_dtype=args.quantize_dtype,
+            quantize_granularity=args.quantize_granularity,
+            target_head=target_head,
+            t2d=t2d,
+            store_topk=args.store_topk,
+            batched_transfer=args.batched_transfer,
+            io_ram_budget_gb=args.io_ram_budget_gb,
+            journal_verify_tail=args.journal_verify_tail,
             # Other params like io_queue_size can also be added to argparse
         ) as hidden_states_generator:
 
@@ -650,6 +1497,18 @@ def main():
                 samples_per_dp=samples_per_dp,
             )
 
+        # merge the manifests of all the DP ranks so that the dataset can be opened
+        # without scanning the output directory
+        if dist.get_rank() == 0:
+            manifest_path = merge_manifests(
+                [
+                    get_partial_manifest_path(args.output_path, i)
+                    for i in range(dp_size)
+                ],
+                args.output_path,
+            )
+            print_with_rank(f"Saved the manifest to {manifest_path}")
+
     finally:
         # The finally block ensures destroy_distributed is always called
         print_with_rank("All hidden states generated or job finished.")
@@ -4,6 +4,8 @@ import math
 import os
 import time
 from argparse import ArgumentParser, Namespace
+from functools import partial
+from itertools import islice
 from typing import List, Optional, Tuple, Union
 
 import torch
@@ -25,31 +27,57 @@ from specforge import (
     QwenVLOnlineEagle3Model,
 )
 from specforge.args import SGLangBackendArgs, TrackerArgs
+from specforge.checkpoint import (
+    RANK_STATE_NAME,
+    TRAINING_STATE_NAME,
+    AsyncCheckpointer,
+    consolidate_checkpoint,
+    is_consolidated,
+    list_checkpoints,
+    remove_old_checkpoints,
+)
 from specforge.data import (
     build_eagle3_dataset,
     build_offline_eagle3_dataset,
     generate_vocab_mapping_file,
+    get_offline_vocab_mapping_path,
     prepare_dp_dataloaders,
 )
+from specforge.data.prefetch import BatchPrefetcher, TargetPrefetcher
+from specforge.data.quantization import dequantize_hidden_states
+from specforge.data.streaming import StreamingEagle3Dataset
 from specforge.distributed import (
     destroy_distributed,
     get_dp_group,
+    get_draft_group,
+    get_draft_ranks,
+    get_target_ranks,
     get_tp_group,
     init_distributed,
+    is_disaggregated,
+    is_target_rank,
 )
+from specforge.metrics import MetricAccumulator, ReducedMetrics
 from specforge.modeling.target import (
+    Eagle3DataReceiver,
+    Eagle3DataSender,
     Eagle3TargetModel,
+    Eagle3TargetOutput,
     TargetHead,
     get_eagle3_target_model,
+    get_num_transfer_steps,
 )
 from specforge.optimizer import BF16Optimizer
 from specforge.tracker import Tracker, create_tracker, get_tracker_class
 from specforge.utils import (
     create_draft_config_from_target,
-    get_last_checkpoint,
+    get_document_end_mask,
+    get_rng_state,
+    padding,
     print_on_rank0,
     print_with_rank,
     rank_0_priority,
+    set_rng_state,
 )
 
 
@@ -104,6 +132,30 @@ def parse_args() -> Tuple[ArgumentParser, Namespace]:
         help="Whether the input data is preformatted text with the chat template already applied to the conversation messages.",
     )
     dataset_group.add_argument("--build-dataset-num-proc", type=int, default=8)
+    dataset_group.add_argument(
+        "--compact-dataset",
+        action="store_true",
+        help="Cache the processed dataset as memory-mapped flat token buffers with a bit-packed loss mask "
+        "instead of Arrow, which is smaller and faster to read. Not supported with --is-vlm.",
+    )
+    dataset_group.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Read and tokenize the training JSONL files on the fly instead of preprocessing the whole dataset "
+        "before training. Requires --total-steps, only supported for online training of text models.",
+    )
+    dataset_group.add_argument(
+        "--streaming-shuffle-buffer-size",
+        type=int,
+        default=10000,
+        help="The number of samples in the shuffle buffer of each DataLoader worker in streaming mode.",
+    )
+    dataset_group.add_argument(
+        "--streaming-vocab-mapping-samples",
+        type=int,
+        default=100000,
+        help="The number of samples the vocab mapping is computed from in streaming mode.",
+    )
 
     # training hyper params
     training_group = parser.add_argument_group("training")
@@ -140,14 +192,39 @@ def parse_args() -> Tuple[ArgumentParser, Namespace]:
     )
     training_group.add_argument("--eval-interval", type=int, default=5000)
     training_group.add_argument("--save-interval", type=int, default=5000)
+    training_group.add_argument(
+        "--checkpoint-format",
+        type=str,
+        default="full",
+        choices=["full", "sharded"],
+        help="full gathers the draft weights and saves them with save_pretrained on rank 0 while the training "
+        "waits, sharded has each rank write its shards in the background. The sharded checkpoints are "
+        "converted to the save_pretrained format with scripts/consolidate_checkpoint.py, the last one is "
+        "converted at the end of the training.",
+    )
+    training_group.add_argument(
+        "--max-checkpoints",
+        type=int,
+        default=None,
+        help="The number of latest checkpoints to keep in --output-dir, the older ones are deleted",
+    )
     training_group.add_argument(
         "--log-interval",
         type=int,
         default=50,
-        help="Log training metrics every N steps",
+        help="Log training metrics every N steps, averaged over the steps since the last log",
     )
     training_group.add_argument("--seed", type=int, default=0)
     training_group.add_argument("--draft-accumulation-steps", type=int, default=1)
+    training_group.add_argument(
+        "--max-tokens-per-batch",
+        type=int,
+        default=None,
+        help="Batch a variable number of training samples of similar lengths instead of --batch-size samples, "
+        "such that the padded batch size times --ttt-length fits this many tokens, since the draft model keeps "
+        "the keys and values of every TTT step. The accumulated gradients are normalized by the number of "
+        "tokens instead of the number of steps. Requires --tp-size 1.",
+    )
 
     # data processing type
     optimization_group = parser.add_argument_group("optimization")
@@ -163,6 +240,62 @@ def parse_args() -> Tuple[ArgumentParser, Namespace]:
         default="flex_attention",
         help="The attention backend for the draft model",
     )
+    optimization_group.add_argument(
+        "--prefetch-batches",
+        type=int,
+        default=2,
+        help="The number of offline batches copied to the GPU ahead of the current one, 0 to disable",
+    )
+    optimization_group.add_argument(
+        "--target-prefetch-batches",
+        type=int,
+        default=0,
+        help="The number of online batches whose target model forward runs ahead of the draft training, on a "
+        "side CUDA stream, or in a background thread for the sglang backend. Each of them holds its hidden "
+        "states and logits on the GPU. 0 to disable.",
+    )
+    optimization_group.add_argument(
+        "--num-target-ranks",
+        type=int,
+        default=0,
+        help="The number of ranks which only run the target model, in groups of --tp-size ranks, and send its "
+        "outputs to the other ranks, which only train the draft model. The last ranks run the target model. "
+        "0 to run both models on every rank. Only supported for online training of text models.",
+    )
+    optimization_group.add_argument(
+        "--target-queue-size",
+        type=int,
+        default=2,
+        help="The number of target model outputs each rank holds in flight with --num-target-ranks, which "
+        "bounds the GPU memory of the outputs sent or received ahead of the draft training",
+    )
+    optimization_group.add_argument(
+        "--dataloader-num-workers",
+        type=int,
+        default=4,
+        help="The number of DataLoader worker processes, which also decompress the compressed offline shards",
+    )
+    optimization_group.add_argument(
+        "--pack-sequences",
+        action="store_true",
+        help="Pack several training samples into each row of --max-length tokens, the documents of a row do not "
+        "attend to each other. Requires --batch-size 1 and --attention-backend flex_attention, only supported "
+        "for offline training of text models.",
+    )
+    optimization_group.add_argument(
+        "--pad-to-multiple-of",
+        type=int,
+        default=None,
+        help="Pad the batches to a multiple of this many tokens, e.g. 128, the block size of flex attention, "
+        "which bounds the number of sequence lengths the attention is compiled for. The loss is a mean over "
+        "the positions of the batch, padding included. Not supported with --is-vlm or --pack-sequences.",
+    )
+    optimization_group.add_argument(
+        "--group-by-length",
+        action="store_true",
+        help="Group the training samples of similar lengths into the batches of the same step, and balance "
+        "their tokens across the DP ranks, to cut the padding. The padding ratio is logged at each epoch.",
+    )
 
     # other args
     other_group = parser.add_argument_group("others")
@@ -296,6 +429,9 @@ def build_target_model(
             processor = None
 
         return target_model, processor
+    elif get_offline_vocab_mapping_path(args.train_hidden_states_path) is not None:
+        # the sparse teacher distributions are stored, the lm head is not needed
+        return None, None
     else:
         target_head = TargetHead.from_pretrained(
             model_path=args.target_model_path,
@@ -318,18 +454,110 @@ def sanity_check(args: Namespace) -> None:
     args.dp_size = dist.get_world_size() // args.tp_size
     args.target_batch_size = args.tp_size * args.batch_size
 
+    if args.streaming:
+        if args.total_steps is None:
+            raise ValueError(
+                "--total-steps must be provided with --streaming, the length of the stream is unknown"
+            )
+        if args.is_vlm or args.train_hidden_states_path is not None:
+            raise ValueError(
+                "--streaming is only supported for online training of text models"
+            )
+        # the stream is infinite, the training stops after the total steps
+        if args.max_num_steps is None:
+            args.max_num_steps = args.total_steps
 
-def build_draft_model(args: Namespace) -> Tuple[AutoDraftModelConfig, nn.Module]:
+    if args.target_prefetch_batches > 0:
+        if args.is_vlm or args.train_hidden_states_path is not None:
+            raise ValueError(
+                "--target-prefetch-batches is only supported for online training of text models"
+            )
+        # the collectives of the target model would be issued from the background
+        # thread, in a different order than those of FSDP on each rank
+        if args.target_model_backend == "sglang" and args.tp_size != 1:
+            raise ValueError(
+                "--target-prefetch-batches requires --tp-size 1 with the sglang backend"
+            )
+
+    if args.num_target_ranks > 0:
+        if args.is_vlm or args.train_hidden_states_path is not None or args.streaming:
+            raise ValueError(
+                "--num-target-ranks is only supported for online training of text models without --streaming"
+            )
+        # the sglang backend builds its TP groups over all the ranks
+        if args.target_model_backend == "sglang":
+            raise ValueError(
+                "--num-target-ranks is not supported with the sglang backend"
+            )
+        if (
+            args.resume
+            or args.eval_data_path is not None
+            or args.max_tokens_per_batch is not None
+            or args.target_prefetch_batches > 0
+        ):
+            raise ValueError(
+                "--num-target-ranks is not supported with --resume, --eval-data-path, --max-tokens-per-batch or --target-prefetch-batches"
+            )
+        if args.target_queue_size < 1:
+            raise ValueError("--target-queue-size must be at least 1")
+        # the draft model runs dp over the ranks which do not run the target model
+        args.dp_size = dist.get_world_size() - args.num_target_ranks
+
+    if args.max_checkpoints is not None and args.max_checkpoints < 1:
+        raise ValueError("--max-checkpoints must be at least 1")
+
+    if args.pack_sequences:
+        # the target model of online training would attend across the documents
+        if args.is_vlm or args.train_hidden_states_path is None:
+            raise ValueError(
+                "--pack-sequences is only supported for offline training of text models"
+            )
+        if args.attention_backend != "flex_attention":
+            raise ValueError(
+                "--pack-sequences requires --attention-backend flex_attention"
+            )
+        if args.batch_size != 1:
+            raise ValueError(
+                "--pack-sequences requires --batch-size 1, each row packs samples up to --max-length tokens"
+            )
+
+    if args.group_by_length and (args.streaming or args.pack_sequences):
+        raise ValueError(
+            "--group-by-length is not supported with --streaming or --pack-sequences"
+        )
+
+    if args.pad_to_multiple_of is not None and (args.is_vlm or args.pack_sequences):
+        raise ValueError(
+            "--pad-to-multiple-of is not supported with --is-vlm or --pack-sequences"
+        )
+
+    if args.max_tokens_per_batch is not None:
+        if args.streaming or args.pack_sequences or args.group_by_length:
+            raise ValueError(
+                "--max-tokens-per-batch is not supported with --streaming, --pack-sequences or --group-by-length"
+            )
+        # the batches of the target model are split between the TP ranks
+        if args.tp_size != 1:
+            raise ValueError("--max-tokens-per-batch requires --tp-size 1")
+        if args.max_tokens_per_batch < args.ttt_length:
+            raise ValueError("--max-tokens-per-batch must be at least --ttt-length")
+
+
+def build_draft_model_config(args: Namespace) -> AutoDraftModelConfig:
     # Handle draft model config
     if args.draft_model_config is None:
         # Auto-generate and save config file
         auto_config_path = create_draft_config_from_target(
             target_model_path=args.target_model_path, cache_dir=args.model_download_dir
         )
-        draft_model_config = AutoDraftModelConfig.from_file(auto_config_path)
+        return AutoDraftModelConfig.from_file(auto_config_path)
     else:
         # Use provided config file
-        draft_model_config = AutoDraftModelConfig.from_file(args.draft_model_config)
+        return AutoDraftModelConfig.from_file(args.draft_model_config)
+
+
+def build_draft_model(args: Namespace) -> Tuple[AutoDraftModelConfig, nn.Module]:
+    draft_model_config = build_draft_model_config(args)
 
     # Handle base ckpt, config file
     draft_model_last_checkpoint = None
@@ -346,8 +574,15 @@ def build_draft_model(args: Namespace) -> Tuple[AutoDraftModelConfig, nn.Module]
     # detecting last ckpt for draft model
     if args.resume and os.path.isdir(args.output_dir):
         print_on_rank0(args.output_dir)
-        draft_model_last_checkpoint = get_last_checkpoint(args.output_dir)
+        checkpoints = list_checkpoints(args.output_dir)
+        draft_model_last_checkpoint = checkpoints[-1] if checkpoints else None
         print_on_rank0(f"Last checkpoint detected: {draft_model_last_checkpoint}")
+        if draft_model_last_checkpoint and not is_consolidated(
+            draft_model_last_checkpoint
+        ):
+            # the weights of a sharded checkpoint are restored from the fp32 master
+            # weights of the optimizer, see load_training_state
+            draft_model_last_checkpoint = None
 
     if draft_model_last_checkpoint:
         draft_model = AutoEagle3DraftModel.from_pretrained(
@@ -376,49 +611,99 @@ def build_dataloaders(
     tokenizer = AutoTokenizer.from_pretrained(args.target_model_path)
 
     # convert to dataloader
-    cache_params_string = (
-        f"{args.train_data_path}-"
-        f"{args.max_length}-"
-        f"{args.chat_template}-"
-        f"{args.target_model_path}"  # Tokenizer may also different
-    )
-    cache_key = hashlib.md5(cache_params_string.encode()).hexdigest()
-    train_dataset = load_dataset("json", data_files=args.train_data_path)["train"]
-    with rank_0_priority():
-        train_eagle3_dataset = build_eagle3_dataset(
-            dataset=train_dataset,
-            tokenizer=tokenizer,
-            chat_template=args.chat_template,
+    if args.streaming:
+        # the stream is not hashed, the vocab mapping is cached by the data path
+        cache_params_string = (
+            f"{args.train_data_path}-"
+            f"{args.max_length}-"
+            f"{args.chat_template}-"
+            f"{args.target_model_path}-"  # Tokenizer may also different
+            f"{args.streaming_vocab_mapping_samples}"
+        )
+        cache_key = hashlib.md5(cache_params_string.encode()).hexdigest()
+        train_eagle3_dataset = StreamingEagle3Dataset(
+            args.train_data_path,
+            tokenizer,
+            args.chat_template,
             max_length=args.max_length,
-            cache_dir=os.path.join(args.cache_dir, "processed_dataset"),
-            cache_key=cache_key,
-            is_vlm=args.is_vlm,
             is_preformatted=args.is_preformatted,
-            processor=processor,
-            num_proc=args.build_dataset_num_proc,
+            seed=args.seed,
+            dp_rank=dist.get_rank(get_dp_group()),
+            dp_size=dist.get_world_size(get_dp_group()),
+            shuffle_buffer_size=args.streaming_shuffle_buffer_size,
+            vocab_mapping_num_samples=args.streaming_vocab_mapping_samples,
         )
-        vocab_mapping_path = generate_vocab_mapping_file(
-            dataset=train_eagle3_dataset,
-            target_vocab_size=draft_model_config.vocab_size,
-            draft_vocab_size=draft_model_config.draft_vocab_size,
-            cache_dir=os.path.join(args.cache_dir, "vocab_mapping"),
-            cache_key=cache_key,
-        )
-
-        if args.train_hidden_states_path is not None:
-            train_eagle3_dataset = build_offline_eagle3_dataset(
-                args.train_hidden_states_path,
-                args.max_length,
+        with rank_0_priority():
+            # the mapping of a sample of the stream differs from the full dataset one
+            vocab_mapping_path = generate_vocab_mapping_file(
+                dataset=train_eagle3_dataset,
+                target_vocab_size=draft_model_config.vocab_size,
+                draft_vocab_size=draft_model_config.draft_vocab_size,
+                cache_dir=os.path.join(args.cache_dir, "vocab_mapping"),
+                cache_key=f"{cache_key}-streaming",
             )
+    else:
+        train_dataset = load_dataset("json", data_files=args.train_data_path)["train"]
+        with rank_0_priority():
+            # the cache key changes with the content of the dataset
+            train_eagle3_dataset, cache_key = build_eagle3_dataset(
+                dataset=train_dataset,
+                tokenizer=tokenizer,
+                chat_template=args.chat_template,
+                max_length=args.max_length,
+                cache_dir=os.path.join(args.cache_dir, "processed_dataset"),
+                is_vlm=args.is_vlm,
+                is_preformatted=args.is_preformatted,
+                processor=processor,
+                num_proc=args.build_dataset_num_proc,
+                compact=args.compact_dataset,
+                return_cache_key=True,
+            )
+            vocab_mapping_path = None
+            if args.train_hidden_states_path is not None:
+                # the sparse teacher distributions must use the same vocab mapping
+                vocab_mapping_path = get_offline_vocab_mapping_path(
+                    args.train_hidden_states_path
+                )
+            if vocab_mapping_path is None:
+                vocab_mapping_path = generate_vocab_mapping_file(
+                    dataset=train_eagle3_dataset,
+                    target_vocab_size=draft_model_config.vocab_size,
+                    draft_vocab_size=draft_model_config.draft_vocab_size,
+                    cache_dir=os.path.join(args.cache_dir, "vocab_mapping"),
+                    cache_key=cache_key,
+                    num_proc=args.build_dataset_num_proc,
+                )
 
+            if args.train_hidden_states_path is not None:
+                train_eagle3_dataset = build_offline_eagle3_dataset(
+                    args.train_hidden_states_path,
+                    args.max_length,
+                )
+
+    # the offline hidden states are large, pinning them speeds up the H2D copy
+    is_offline = args.train_hidden_states_path is not None
     train_dataloader = prepare_dp_dataloaders(
         train_eagle3_dataset,
         args.target_batch_size,
-        num_workers=4,
+        num_workers=args.dataloader_num_workers,
         shuffle=True,
         process_group=get_dp_group(),
         is_vlm=args.is_vlm,
+        pin_memory=is_offline,
+        pack_max_tokens=args.max_length if args.pack_sequences else None,
+        group_by_length=args.group_by_length,
+        max_tokens_per_batch=(
+            args.max_tokens_per_batch // args.ttt_length
+            if args.max_tokens_per_batch is not None
+            else None
+        ),
+        pad_to_multiple_of=args.pad_to_multiple_of,
     )
+    if is_offline and args.prefetch_batches > 0:
+        train_dataloader = BatchPrefetcher(
+            train_dataloader, num_prefetch=args.prefetch_batches
+        )
 
     if args.eval_data_path is not None or args.eval_hidden_states_path is not None:
         if args.eval_data_path is not None:
@@ -441,10 +726,11 @@ def build_dataloaders(
         eval_dataloader = prepare_dp_dataloaders(
             eval_eagle3_dataset,
             args.target_batch_size,
-            num_workers=4,
+            num_workers=args.dataloader_num_workers,
             shuffle=False,
             process_group=get_dp_group(),
             is_vlm=args.is_vlm,
+            pad_to_multiple_of=args.pad_to_multiple_of,
         )
         print_with_rank("Initialized eval dataloader")
     else:
@@ -462,20 +748,48 @@ def save_checkpoints(
     step: int,
     eagle3_model: nn.Module,
     optimizer: Optimizer,
+    epoch_step: int = 0,
+    checkpointer: Optional[AsyncCheckpointer] = None,
 ):
     epoch_output_dir = os.path.join(args.output_dir, f"epoch_{epoch}_step_{step}")
+    # the optimizer holds the shard of the parameters of each rank
+    rank_state = {"optimizer": optimizer.state_dict(), "rng_state": get_rng_state()}
+    state_to_save = {
+        "epoch": epoch,
+        "global_step": step,
+        # the number of batches of the epoch which were trained on
+        "epoch_step": epoch_step,
+        "world_size": dist.get_world_size(get_draft_group()),
+        "args": args,
+    }
+
+    if checkpointer is not None:
+        with FSDP.state_dict_type(eagle3_model, StateDictType.SHARDED_STATE_DICT):
+            model_state_dict = eagle3_model.state_dict()
+        draft_model_state_dict = {
+            k.replace("draft_model.", ""): v
+            for k, v in model_state_dict.items()
+            if "draft_model." in k and "embed" not in k.lower()
+        }
+        if dist.get_rank() == 0:
+            eagle3_model.draft_model.config.save_pretrained(epoch_output_dir)
+        checkpointer.save(
+            epoch_output_dir, draft_model_state_dict, rank_state, state_to_save
+        )
+        print_on_rank0(f"Saving sharded checkpoint to {epoch_output_dir}")
+        return
+
     if dist.get_rank() == 0:
         os.makedirs(epoch_output_dir, exist_ok=True)
-    dist.barrier()
+    dist.barrier(group=get_draft_group())
+
+    torch.save(
+        rank_state,
+        os.path.join(epoch_output_dir, RANK_STATE_NAME.format(rank=dist.get_rank())),
+    )
 
     with FSDP.state_dict_type(eagle3_model, StateDictType.FULL_STATE_DICT):
         model_state_dict = eagle3_model.state_dict()
-        state_to_save = {
-            "epoch": epoch,
-            "global_step": step,
-            "args": args,
-        }
-        state_to_save.update(optimizer.state_dict())
         draft_model_state_dict = {
             k.replace("draft_model.", ""): v
             for k, v in model_state_dict.items()
@@ -483,19 +797,161 @@ def save_checkpoints(
         }
 
         if dist.get_rank() == 0:
-            torch.save(
-                state_to_save,
-                os.path.join(epoch_output_dir, "training_state.pt"),
-            )
-            print_on_rank0(
-                f"Saved full training state to {epoch_output_dir}/training_state.pt"
-            )
             eagle3_model.draft_model.save_pretrained(
                 epoch_output_dir,
                 state_dict=draft_model_state_dict,
             )
             print_on_rank0(f"Saved model configuration to {epoch_output_dir}")
-        dist.barrier()
+            # the training state marks the checkpoint as complete
+            torch.save(
+                state_to_save,
+                os.path.join(epoch_output_dir, TRAINING_STATE_NAME),
+            )
+            print_on_rank0(
+                f"Saved full training state to {epoch_output_dir}/{TRAINING_STATE_NAME}"
+            )
+            if args.max_checkpoints is not None:
+                remove_old_checkpoints(args.output_dir, args.max_checkpoints)
+        dist.barrier(group=get_draft_group())
+
+
+def load_training_state(
+    args: Namespace, optimizer: Optimizer, steps_per_epoch: Optional[int]
+) -> Tuple[int, int, int]:
+    """
+    Restore the optimizer, the scheduler and the RNG states of the last checkpoint of
+    the output directory, whose draft weights are loaded by `build_draft_model`.
+
+    Args:
+        args: The arguments for the training script.
+        optimizer: The optimizer to restore.
+        steps_per_epoch: The number of batches of an epoch, None if it is unknown.
+
+    Returns:
+        The global step, the epoch and the number of batches of the epoch to skip.
+    """
+    if not os.path.isdir(args.output_dir):
+        return 0, 0, 0
+    checkpoints = list_checkpoints(args.output_dir)
+    if len(checkpoints) == 0:
+        return 0, 0, 0
+    checkpoint_dir = checkpoints[-1]
+    rank_state_path = os.path.join(
+        checkpoint_dir, RANK_STATE_NAME.format(rank=dist.get_rank())
+    )
+    if not os.path.exists(rank_state_path):
+        print_on_rank0(
+            f"{checkpoint_dir} has no optimizer state, only the weights are resumed"
+        )
+        return 0, 0, 0
+
+    state = torch.load(
+        os.path.join(checkpoint_dir, TRAINING_STATE_NAME), weights_only=False
+    )
+    world_size = dist.get_world_size(get_draft_group())
+    if state["world_size"] != world_size:
+        raise ValueError(
+            f"{checkpoint_dir} was saved with {state['world_size']} processes, the "
+            "optimizer state is sharded and cannot be resumed with "
+            f"{world_size} processes"
+        )
+    rank_state = torch.load(
+        rank_state_path, map_location=torch.cuda.current_device(), weights_only=False
+    )
+    optimizer.load_state_dict(rank_state["optimizer"])
+    set_rng_state(rank_state["rng_state"])
+
+    epoch, epoch_step = state["epoch"], state["epoch_step"]
+    if steps_per_epoch is not None and epoch_step >= steps_per_epoch:
+        epoch, epoch_step = epoch + 1, 0
+    print_on_rank0(
+        f"Resuming from {checkpoint_dir} at step {state['global_step']}, "
+        f"epoch {epoch}, batch {epoch_step}"
+    )
+    return state["global_step"], epoch, epoch_step
+
+
+def generate_target_data(
+    target_model: Eagle3TargetModel, data: dict
+) -> Eagle3TargetOutput:
+    return target_model.generate_eagle3_data(
+        input_ids=data["input_ids"].cuda(),
+        attention_mask=data["attention_mask"].cuda(),
+        loss_mask=data["loss_mask"].cuda(),
+    )
+
+
+def get_disaggregated_steps(args: Namespace, num_batches: int) -> Tuple[int, int, int]:
+    """
+    Get the number of steps of the target and draft ranks with --num-target-ranks.
+
+    Args:
+        args: The arguments for the training script.
+        num_batches: The number of batches of an epoch of the target ranks.
+
+    Returns:
+        The number of batches of an epoch of the target ranks and of the draft ranks,
+        and the total number of batches of the draft ranks.
+    """
+    producer_steps, consumer_steps = get_num_transfer_steps(
+        num_batches, len(get_target_ranks()), len(get_draft_ranks())
+    )
+    if consumer_steps == 0:
+        raise ValueError(
+            f"The {num_batches} batches of an epoch are too few for {len(get_draft_ranks())} draft ranks"
+        )
+    max_steps = args.num_epochs * consumer_steps
+    if args.max_num_steps is not None:
+        max_steps = min(max_steps, args.max_num_steps)
+    return producer_steps, consumer_steps, max_steps
+
+
+def run_target_producer(
+    args: Namespace, target_model: Eagle3TargetModel, train_dataloader: DataLoader
+) -> None:
+    """
+    Run the target model over the batches of a target rank and send its outputs to the
+    draft ranks, see --num-target-ranks.
+    """
+    target_ranks, draft_ranks = get_target_ranks(), get_draft_ranks()
+    producer_steps, _, max_steps = get_disaggregated_steps(args, len(train_dataloader))
+    sender = Eagle3DataSender(
+        target_ranks.index(dist.get_rank()),
+        len(target_ranks),
+        draft_ranks,
+        max_in_flight=args.target_queue_size,
+    )
+    # the ranks of a TP group run the target model together, while the first one has
+    # outputs to send
+    first_index = sender.producer_index - dist.get_rank(get_tp_group())
+    num_steps = math.ceil(
+        (max_steps * len(draft_ranks) - first_index) / len(target_ranks)
+    )
+    step = 0
+    for epoch in range(args.num_epochs):
+        train_dataloader.sampler.set_epoch(epoch + 1)
+        for data in islice(train_dataloader, min(producer_steps, num_steps - step)):
+            eagle3_data = generate_target_data(target_model, data)
+            if sender.next_consumer_step < max_steps:
+                # each rank of the TP group sends its DP shard of the batch
+                sender.send(
+                    Eagle3TargetOutput(
+                        hidden_states=get_dp_data_shard_from_tp(
+                            eagle3_data.hidden_states
+                        ),
+                        target=get_dp_data_shard_from_tp(eagle3_data.target),
+                        loss_mask=get_dp_data_shard_from_tp(eagle3_data.loss_mask),
+                        input_ids=get_dp_data_shard_from_tp(eagle3_data.input_ids),
+                        attention_mask=get_dp_data_shard_from_tp(
+                            eagle3_data.attention_mask
+                        ),
+                    )
+                )
+        step += producer_steps
+        if step >= num_steps:
+            break
+    sender.flush()
+    print_with_rank(f"Sent {sender.num_sent} target model outputs")
 
 
 def run_forward(
@@ -504,6 +960,7 @@ def run_forward(
     data: dict,
     target_model: Optional[Eagle3TargetModel] = None,
     is_online: bool = True,
+    eagle3_data: Optional[Eagle3TargetOutput] = None,
 ) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
     if args.is_vlm:
         plosses, _, acces = eagle3_model(
@@ -515,28 +972,61 @@ def run_forward(
         )
     else:
         if is_online:
-            # we generate the eagle3 using the target model in an online fashion
-            eagle3_data = target_model.generate_eagle3_data(
-                input_ids=data["input_ids"].cuda(),
-                attention_mask=data["attention_mask"].cuda(),
-                loss_mask=data["loss_mask"].cuda(),
-            )
+            # we generate the eagle3 using the target model in an online fashion,
+            # unless it was generated ahead, see --target-prefetch-batches
+            if eagle3_data is None:
+                eagle3_data = generate_target_data(target_model, data)
 
             input_ids = get_dp_data_shard_from_tp(eagle3_data.input_ids)
             attention_mask = get_dp_data_shard_from_tp(eagle3_data.attention_mask)
             loss_mask = get_dp_data_shard_from_tp(eagle3_data.loss_mask)
             target = get_dp_data_shard_from_tp(eagle3_data.target)
             hidden_states = get_dp_data_shard_from_tp(eagle3_data.hidden_states)
+            target_topk = {}
+            position_ids = None
         else:
             # we generate the logits using the hidden states loaded from disk
             input_ids = data["input_ids"].cuda()
             attention_mask = data["attention_mask"].cuda()
             loss_mask = data["loss_mask"].cuda()
             hidden_states = data["hidden_state"].cuda()
-            target = target_model(data["target"].cuda())
-            input_ids, target, loss_mask = target_model.preprocess(
-                input_ids, target, loss_mask
-            )
+            target_topk = {}
+            position_ids, document_end = None, None
+            if data.get("position_ids") is not None:
+                # the rows pack several samples, see --pack-sequences
+                position_ids = data["position_ids"].cuda()
+                document_end = get_document_end_mask(position_ids)
+            # quantized hidden states are dequantized after the H2D copy
+            if data.get("hidden_state_scale") is not None:
+                hidden_states = dequantize_hidden_states(
+                    hidden_states, data["hidden_state_scale"].cuda()
+                )
+            if data.get("target_topk_probs") is not None:
+                # the sparse teacher distributions are stored, apply the same
+                # padding as TargetHead.preprocess
+                target = None
+                target_topk = {
+                    key: padding(
+                        data[key].cuda(), left=False, document_end=document_end
+                    )
+                    for key in [
+                        "target_topk_probs",
+                        "target_topk_indices",
+                        "target_in_draft",
+                    ]
+                }
+                input_ids = padding(input_ids, left=False, document_end=document_end)
+                loss_mask = loss_mask[..., None]
+            else:
+                target = data["target"].cuda()
+                if data.get("target_scale") is not None:
+                    target = dequantize_hidden_states(
+                        target, data["target_scale"].cuda()
+                    )
+                target = target_model(target)
+                input_ids, target, loss_mask = target_model.preprocess(
+                    input_ids, target, loss_mask, document_end=document_end
+                )
 
         plosses, _, acces = eagle3_model(
             input_ids=input_ids,
@@ -544,52 +1034,63 @@ def run_forward(
             loss_mask=loss_mask,
             target=target,
             hidden_states=hidden_states,
+            position_ids=position_ids,
+            **target_topk,
         )
     return plosses, acces
 
 
 def run_backward_and_update(
-    args: Namespace, plosses: List[torch.Tensor], optimizer: Optimizer, global_step: int
+    args: Namespace,
+    plosses: List[torch.Tensor],
+    optimizer: Optimizer,
+    global_step: int,
+    num_tokens: Optional[int] = None,
+    window_tokens: Optional[int] = None,
 ) -> None:
     ploss_weight = [0.8**i for i in range(len(plosses))]
-    ploss = (
-        sum([ploss_weight[i] * plosses[i] for i in range(len(plosses))])
-        / args.draft_accumulation_steps
-    )
+    ploss = sum([ploss_weight[i] * plosses[i] for i in range(len(plosses))])
+    if num_tokens is None:
+        ploss = ploss / args.draft_accumulation_steps
+    else:
+        # The batches have different sizes and the losses are means over their
+        # positions, the gradients of the sums are divided by the number of positions
+        # of the accumulation window when it ends.
+        ploss = ploss * num_tokens
     ploss.backward()
 
     if global_step % args.draft_accumulation_steps == 0:
+        if num_tokens is not None:
+            # the gradients are averaged over the DP ranks, whose windows have
+            # different numbers of positions
+            total_tokens = torch.tensor(
+                window_tokens, dtype=torch.float32, device=ploss.device
+            )
+            dist.all_reduce(total_tokens, group=get_dp_group())
+            grad_scale = dist.get_world_size(get_dp_group()) / total_tokens
+            for param in optimizer.model_params:
+                if param.grad is not None:
+                    param.grad.mul_(grad_scale.to(param.grad.dtype))
         optimizer.step()
 
 
 def record_metrcs(
     args: Namespace,
-    accuracies: List[torch.Tensor],
-    plosses: List[torch.Tensor],
-    global_step: int,
+    metrics: ReducedMetrics,
     tracker: Tracker,
-    optimizer: Optional[Optimizer] = None,
     mode: str = "train",
 ) -> None:
     logdict = {}
+    global_step = metrics.step
+    accuracies, plosses = metrics.accuracies, metrics.plosses
 
-    if mode == "train" and optimizer is not None:
-        logdict["train/lr"] = optimizer.get_learning_rate()
-
-    accuracies = torch.stack(accuracies)
-    plosses = torch.stack(plosses)
-
-    assert accuracies.shape[0] == args.ttt_length
-    dist.all_reduce(accuracies, op=dist.ReduceOp.AVG)
-    accuracies = accuracies.cpu().tolist()
+    assert len(accuracies) == args.ttt_length
     for i in range(len(accuracies)):
         logdict[f"{mode}/acc_{i}"] = accuracies[i]
         print_on_rank0(
             f"Eval - Step {global_step} [{global_step + 1}/{args.num_epochs}], position {i},  Acc: {accuracies[i]:.2f}"
         )
 
-    dist.all_reduce(plosses, op=dist.ReduceOp.AVG)
-    plosses = plosses.cpu().tolist()
     for i in range(len(plosses)):
         logdict[f"{mode}/ploss_{i}"] = plosses[i]
         print_on_rank0(
@@ -613,7 +1114,11 @@ def main():
     # ================================================
     parser, args = parse_args()
     set_seed(args.seed)
-    init_distributed(timeout=args.dist_timeout, tp_size=args.tp_size)
+    init_distributed(
+        timeout=args.dist_timeout,
+        tp_size=args.tp_size,
+        num_target_ranks=args.num_target_ranks,
+    )
     is_online = (
         args.train_data_path is not None and args.train_hidden_states_path is None
     )
@@ -624,8 +1129,18 @@ def main():
     # ================================================
     # 2. Build models
     # ================================================
-    draft_model_config, draft_model = build_draft_model(args)
-    target_model, processor = build_target_model(args, draft_model_config, is_online)
+    # the target ranks only run the target model, see --num-target-ranks
+    is_producer = is_disaggregated() and is_target_rank()
+    if is_producer:
+        draft_model_config, draft_model = build_draft_model_config(args), None
+    else:
+        draft_model_config, draft_model = build_draft_model(args)
+    if is_disaggregated() and not is_producer:
+        target_model, processor = None, None
+    else:
+        target_model, processor = build_target_model(
+            args, draft_model_config, is_online
+        )
 
     # ================================================
     # 3. Build dataloader
@@ -634,10 +1149,37 @@ def main():
         args, draft_model_config, processor
     )
 
+    if is_disaggregated():
+        # the draft ranks receive the outputs of the batches of the target ranks
+        num_batches = [len(train_dataloader)]
+        dist.broadcast_object_list(num_batches, src=get_target_ranks()[0])
+        if is_producer:
+            run_target_producer(args, target_model, train_dataloader)
+            destroy_distributed()
+            return
+        _, steps_per_epoch, max_steps = get_disaggregated_steps(args, num_batches[0])
+        train_dataloader = Eagle3DataReceiver(
+            get_draft_ranks().index(dist.get_rank()),
+            len(get_draft_ranks()),
+            get_target_ranks(),
+            num_steps=steps_per_epoch,
+            max_steps=max_steps,
+            max_in_flight=args.target_queue_size,
+        )
+
     # we load the vocab mapping then
     draft_model.load_vocab_mapping(vocab_mapping_path)
     print_with_rank("Loaded vocab mapping")
 
+    if args.target_prefetch_batches > 0:
+        # the SGLang backend synchronizes with the host while running the target model
+        train_dataloader = TargetPrefetcher(
+            train_dataloader,
+            partial(generate_target_data, target_model),
+            num_prefetch=args.target_prefetch_batches,
+            use_thread=args.target_model_backend == "sglang",
+        )
+
     # Calculate total steps if not provided
     if args.total_steps is None:
         steps_per_epoch = math.ceil(
@@ -679,7 +1221,7 @@ def main():
             buffer_dtype=torch.bfloat16,
         ),
         sharding_strategy=ShardingStrategy.SHARD_GRAD_OP,
-        process_group=dist.group.WORLD,  # the draft model should run dp for all processes
+        process_group=get_draft_group(),  # the draft model runs dp on the draft ranks
     )
     print_with_rank("Initialized Eagle3 FSDP model")
 
@@ -695,13 +1237,30 @@ def main():
     )
     print_with_rank("Initialized optimizer and scheduler")
 
+    checkpointer = None
+    if args.checkpoint_format == "sharded":
+        checkpointer = AsyncCheckpointer(
+            args.max_checkpoints, get_draft_ranks() if is_disaggregated() else None
+        )
+
     # ================================================
     # 6. Build tracker
     # ================================================
     tracker = build_tracker(args, parser)
     global_step = 0
     start_epoch = 0
-    dist.barrier()
+    # the number of batches of the first epoch which were trained on before resuming
+    num_skipped_batches = 0
+    if args.resume:
+        steps_per_epoch = None if args.streaming else len(train_dataloader)
+        global_step, start_epoch, num_skipped_batches = load_training_state(
+            args, optimizer, steps_per_epoch
+        )
+    # the number of positions of the accumulation window, see run_backward_and_update
+    window_tokens = 0
+    # the metrics are averaged over the steps of each log interval on the device
+    train_metrics = MetricAccumulator(args.ttt_length, get_draft_group())
+    dist.barrier(group=get_draft_group())
 
     last_time = time.time()
 
@@ -712,18 +1271,51 @@ def main():
 
     for epoch in range(start_epoch, args.num_epochs):
         # Run training
-        train_dataloader.sampler.set_epoch(epoch + 1)
+        if is_disaggregated():
+            # the target ranks shuffle the batches, see run_target_producer
+            pass
+        elif args.streaming:
+            train_dataloader.dataset.set_epoch(epoch + 1)
+        elif args.pack_sequences or args.max_tokens_per_batch is not None:
+            train_dataloader.batch_sampler.set_epoch(epoch + 1)
+        else:
+            train_dataloader.sampler.set_epoch(epoch + 1)
+        epoch_step = 0
+        if epoch == start_epoch and num_skipped_batches > 0:
+            if args.streaming:
+                # the stream cannot be sought, the epoch is resumed from its start
+                print_on_rank0(
+                    f"Streaming epoch {epoch} is resumed from its first batch"
+                )
+            elif args.pack_sequences or args.max_tokens_per_batch is not None:
+                train_dataloader.batch_sampler.skip_batches(num_skipped_batches)
+                epoch_step = num_skipped_batches
+            else:
+                train_dataloader.sampler.skip_batches(num_skipped_batches)
+                epoch_step = num_skipped_batches
+        if args.group_by_length and not is_disaggregated() and dist.get_rank() == 0:
+            padding_ratio = train_dataloader.sampler.get_padding_ratio()
+            print_on_rank0(f"Padding ratio of epoch {epoch}: {padding_ratio:.2%}")
         draft_model.train()
 
         if dist.get_rank() == 0:
             progress_bar = tqdm(
-                train_dataloader, desc=f"Training Epoch {epoch}", leave=True
+                train_dataloader,
+                desc=f"Training Epoch {epoch}",
+                leave=True,
+                initial=epoch_step,
             )
         else:
             progress_bar = train_dataloader
 
         for data in progress_bar:
             global_step += 1
+            epoch_step += 1
+            eagle3_data = None
+            if isinstance(train_dataloader, TargetPrefetcher):
+                data, eagle3_data = data
+            elif isinstance(train_dataloader, Eagle3DataReceiver):
+                data, eagle3_data = None, data
 
             # ================================================
             # 7.0 Profiling
@@ -754,28 +1346,52 @@ def main():
             # 7.1 Training Step
             # ================================================
             plosses, acces = run_forward(
-                args, eagle3_model, data, target_model, is_online
+                args, eagle3_model, data, target_model, is_online, eagle3_data
             )
-            run_backward_and_update(args, plosses, optimizer, global_step)
-
-            # log training metrics
+            num_tokens = None
+            if args.max_tokens_per_batch is not None:
+                # the number of positions the losses are averaged over
+                num_tokens = data["attention_mask"].numel()
+                window_tokens += num_tokens
+            run_backward_and_update(
+                args, plosses, optimizer, global_step, num_tokens, window_tokens
+            )
+            if global_step % args.draft_accumulation_steps == 0:
+                window_tokens = 0
+
+            # log training metrics, the reduced metrics of the last log step are read
+            # once this step is queued, the device copied them to the host meanwhile
+            train_metrics.update(plosses, acces)
+            reduced_metrics = train_metrics.collect()
+            if reduced_metrics is not None:
+                record_metrcs(args, reduced_metrics, tracker, mode="train")
             if global_step % args.log_interval == 0:
-                record_metrcs(
-                    args, acces, plosses, global_step, tracker, optimizer, mode="train"
-                )
+                train_metrics.reduce(global_step)
+                logdict = {"train/lr": optimizer.get_learning_rate()}
+                if isinstance(train_dataloader, BatchPrefetcher):
+                    logdict["train/data_wait_time"] = train_dataloader.last_wait_time
+                if isinstance(train_dataloader, TargetPrefetcher):
+                    logdict["train/target_overlap"] = train_dataloader.overlap
+                tracker.log(logdict, step=global_step)
 
             if dist.get_rank() == 0:
                 time_per_step = time.time() - last_time
                 last_time = time.time()
-                avg_loss = sum(pl for pl in plosses) / len(plosses)
-                avg_acc = sum(acces) / len(acces)
-                progress_bar.set_postfix(
-                    {
-                        "loss": f"{avg_loss:.2f}",
-                        "acc": f"{avg_acc:.2f}",
-                        "time": f"{time_per_step:.2f}s",
-                    }
-                )
+                postfix = {}
+                last_metrics = train_metrics.last
+                if last_metrics is not None:
+                    # the averages of the last log interval, over all the ranks
+                    num_positions = len(last_metrics.plosses)
+                    avg_loss = sum(last_metrics.plosses) / num_positions
+                    avg_acc = sum(last_metrics.accuracies) / num_positions
+                    postfix["loss"] = f"{avg_loss:.2f}"
+                    postfix["acc"] = f"{avg_acc:.2f}"
+                postfix["time"] = f"{time_per_step:.2f}s"
+                if isinstance(train_dataloader, BatchPrefetcher):
+                    postfix["data_wait"] = f"{train_dataloader.last_wait_time:.2f}s"
+                if isinstance(train_dataloader, TargetPrefetcher):
+                    postfix["overlap"] = f"{train_dataloader.overlap:.0%}"
+                progress_bar.set_postfix(postfix)
 
             # ================================================
             # 7.2 Evaluation Step
@@ -786,47 +1402,61 @@ def main():
             ):
                 # Run evaluation
                 draft_model.eval()
-                eval_acces = [[] for _ in range(eagle3_model.length)]
-                eval_plosses = [[] for _ in range(eagle3_model.length)]
+                eval_metrics = MetricAccumulator(eagle3_model.length, get_draft_group())
 
                 for data in tqdm(eval_dataloader, desc=f"Evaluating Epoch {epoch}"):
                     with torch.no_grad():
                         plosses, acces = run_forward(
                             args, eagle3_model, data, target_model, is_online
                         )
-                        eval_acces = [
-                            eval_acces[i] + [acces[i]] for i in range(len(acces))
-                        ]
-                        eval_plosses = [
-                            eval_plosses[i] + [plosses[i]] for i in range(len(plosses))
-                        ]
+                        eval_metrics.update(plosses, acces)
 
                 # compute average over all minibatches
-                eval_acces = [torch.stack(acc).mean() for acc in eval_acces]
-                eval_plosses = [torch.stack(pl).mean() for pl in eval_plosses]
-
-                record_metrcs(
-                    args,
-                    eval_acces,
-                    eval_plosses,
-                    global_step,
-                    tracker,
-                    mode="eval",
-                )
+                eval_metrics.reduce(global_step)
+                record_metrcs(args, eval_metrics.collect(), tracker, mode="eval")
 
             # ================================================
             # 7.3 Save Checkpoints
             # ================================================
             if global_step % args.save_interval == 0:
                 # Save the model
-                save_checkpoints(args, epoch, global_step, eagle3_model, optimizer)
+                save_checkpoints(
+                    args,
+                    epoch,
+                    global_step,
+                    eagle3_model,
+                    optimizer,
+                    epoch_step,
+                    checkpointer,
+                )
 
             if args.max_num_steps is not None and global_step >= args.max_num_steps:
                 break
 
+        if isinstance(train_dataloader, TargetPrefetcher):
+            print_on_rank0(
+                f"Target forward overlap of epoch {epoch}: "
+                f"{train_dataloader.overlap:.2%}"
+            )
+
         if args.max_num_steps is not None and global_step >= args.max_num_steps:
             break
 
+    # the metrics of the last log step
+    reduced_metrics = train_metrics.collect()
+    if reduced_metrics is not None:
+        record_metrcs(args, reduced_metrics, tracker, mode="train")
+
+    if checkpointer is not None:
+        checkpointer.close()
+        # the last checkpoint is converted to the save_pretrained format for serving
+        checkpoints = list_checkpoints(args.output_dir)
+        if dist.get_rank() == 0 and checkpoints:
+            if not is_consolidated(checkpoints[-1]):
+                consolidate_checkpoint(checkpoints[-1])
+                print_on_rank0(f"Consolidated {checkpoints[-1]}")
+        dist.barrier(group=get_draft_group())
+
     # Close the tracker
     tracker.close()
     destroy_distributed()
@@ -0,0 +1,97 @@
+"""
+Fidelity report for the quantized storage of the offline hidden states.
+
+It compares the dequantized hidden states with the bf16 originals for every supported
+dtype and granularity, and reports the relative error, the max absolute error, the
+per-token cosine similarity and the compression ratio.
+
+Usage:
+    # on hidden states generated by scripts/prepare_hidden_states.py without quantization
+    python specforge/benchmarks/benchmark_hidden_states_quantization.py \
+        --hidden-states-path ./cache/hidden_states/sharegpt_train_Llama-3.1-8B-Instruct \
+        --num-samples 32
+
+    # on synthetic hidden states with a few outlier channels
+    python specforge/benchmarks/benchmark_hidden_states_quantization.py --hidden-size 4096
+"""
+
+import argparse
+from collections import defaultdict
+
+import torch
+
+from specforge.data.preprocessing import build_offline_eagle3_dataset
+from specforge.data.quantization import (
+    QUANT_DTYPES,
+    QUANT_GRANULARITIES,
+    compute_quantization_error,
+    quantize_hidden_states,
+)
+
+
+def load_samples(args):
+    """Yield (aux_hidden_state, hidden_state) pairs of shape (seq_len, *)."""
+    if args.hidden_states_path is not None:
+        dataset = build_offline_eagle3_dataset(args.hidden_states_path)
+        for i in range(min(args.num_samples, len(dataset))):
+            data = dataset._open_file(i)
+            assert (
+                data.get("aux_hidden_state_scale") is None
+            ), "The hidden states must be stored without quantization"
+            yield data["aux_hidden_state"].squeeze(0), data["hidden_state"].squeeze(0)
+    else:
+        for _ in range(args.num_samples):
+            hidden_states = torch.randn(
+                args.seq_len, args.hidden_size * 4, dtype=torch.bfloat16
+            )
+            # hidden states of LLMs have a few channels with massive activations
+            outliers = torch.randint(0, hidden_states.shape[-1], (8,))
+            hidden_states[:, outliers] *= 100
+            yield hidden_states.split([args.hidden_size * 3, args.hidden_size], dim=-1)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the fidelity of the quantized offline hidden states"
+    )
+    parser.add_argument("--hidden-states-path", type=str, default=None)
+    parser.add_argument("--num-samples", type=int, default=16)
+    parser.add_argument("--seq-len", type=int, default=2048)
+    parser.add_argument("--hidden-size", type=int, default=4096)
+    parser.add_argument(
+        "--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    args = parser.parse_args()
+
+    results = defaultdict(lambda: defaultdict(list))
+    for aux_hidden_state, hidden_state in load_samples(args):
+        aux_hidden_state = aux_hidden_state.to(args.device)
+        hidden_state = hidden_state.to(args.device)
+        for dtype in QUANT_DTYPES:
+            for granularity in QUANT_GRANULARITIES:
+                for name, tensor, num_groups in [
+                    ("aux_hidden_state", aux_hidden_state, 3),
+                    ("hidden_state", hidden_state, 1),
+                ]:
+                    q, scale = quantize_hidden_states(
+                        tensor, dtype, granularity, num_groups=num_groups
+                    )
+                    error = compute_quantization_error(tensor, q, scale)
+                    for metric, value in error.items():
+                        results[(name, dtype, granularity)][metric].append(value)
+
+    print(f"\n=== Quantization Fidelity Report ({args.num_samples} samples) ===")
+    print(
+        f"{'Tensor':<18} {'Dtype':<6} {'Granularity':<12} {'Rel Error':<12} {'Max Abs Error':<15} {'Cosine Sim':<12} {'Compression':<12}"
+    )
+    print("-" * 90)
+    for (name, dtype, granularity), metrics in results.items():
+        avg = {k: sum(v) / len(v) for k, v in metrics.items()}
+        max_abs_error = max(metrics["max_abs_error"])
+        print(
+            f"{name:<18} {dtype:<6} {granularity:<12} {avg['relative_error']:<12.4e} {max_abs_error:<15.4e} {avg['cosine_similarity']:<12.6f} {avg['compression_ratio']:<12.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
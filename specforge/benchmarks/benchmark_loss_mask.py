@@ -0,0 +1,132 @@
+"""
+Micro-benchmark of the loss mask computation of the preprocessing.
+
+It compares the per-token Python loop which used to map the assistant spans to the
+tokens with `get_span_loss_mask`, which uses a binary search over the token offsets,
+on ShareGPT-sized multi-turn conversations, and checks that both give the same mask.
+
+Usage:
+    # with a whitespace tokenizer, no download needed
+    python specforge/benchmarks/benchmark_loss_mask.py --num-turns 4 8 16
+
+    # with the offsets of a real tokenizer
+    python specforge/benchmarks/benchmark_loss_mask.py \
+        --tokenizer-path meta-llama/Llama-3.1-8B-Instruct --chat-template llama3
+"""
+
+import argparse
+import random
+import re
+import time
+
+import torch
+
+from specforge.data.parse import get_span_loss_mask
+from specforge.data.template import TEMPLATE_REGISTRY
+
+WORDS = "the of and to in is you that it he was for on are as with his they at".split()
+
+
+def loss_mask_loop(offsets, spans):
+    """The per-token loop, kept as the reference."""
+    loss_mask = torch.zeros(len(offsets), dtype=torch.long)
+    for start, end in spans:
+        for idx, (token_start, token_end) in enumerate(offsets):
+            if token_end <= start:
+                continue
+            if token_start > end:
+                continue
+            loss_mask[idx] = 1
+    return loss_mask
+
+
+def build_conversation(chat_template, num_turns, words_per_turn):
+    text = chat_template.system_prompt or ""
+    for _ in range(num_turns):
+        for header in [chat_template.user_header, chat_template.assistant_header]:
+            text += f"{chat_template.end_of_turn_token or ''}{header}"
+            text += " ".join(random.choices(WORDS, k=words_per_turn))
+    return text
+
+
+def get_offsets(text, tokenizer):
+    if tokenizer is None:
+        offsets = [match.span() for match in re.finditer(r"\s*\S+", text)]
+        return torch.tensor(offsets, dtype=torch.long)
+    encoding = tokenizer(
+        text,
+        return_offsets_mapping=True,
+        return_tensors="pt",
+        add_special_tokens=False,
+    )
+    return encoding.offset_mapping[0]
+
+
+def get_spans(text, chat_template):
+    end_of_turn_token = chat_template.end_of_turn_token or ""
+    assistant_pattern = (
+        re.escape(f"{end_of_turn_token}{chat_template.assistant_header}")
+        + r"(.*?)(?="
+        + re.escape(f"{end_of_turn_token}{chat_template.user_header}")
+        + "|$)"
+    )
+    return [
+        (match.start(1), match.end(1))
+        for match in re.finditer(assistant_pattern, text, re.DOTALL)
+    ]
+
+
+def benchmark(fn, inputs):
+    start = time.perf_counter()
+    masks = [fn(offsets, spans) for offsets, spans in inputs]
+    return masks, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the loss mask computation of the preprocessing"
+    )
+    parser.add_argument("--tokenizer-path", type=str, default=None)
+    parser.add_argument("--chat-template", type=str, default="llama3")
+    parser.add_argument("--num-conversations", type=int, default=20)
+    parser.add_argument("--num-turns", type=int, nargs="+", default=[2, 8, 16])
+    parser.add_argument("--words-per-turn", type=int, default=200)
+    args = parser.parse_args()
+
+    random.seed(0)
+    chat_template = TEMPLATE_REGISTRY.get(args.chat_template)
+    tokenizer = None
+    if args.tokenizer_path is not None:
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+
+    print(
+        f"\n=== Loss Mask Benchmark ({args.num_conversations} conversations, "
+        f"{args.words_per_turn} words per turn) ==="
+    )
+    print(
+        f"{'Turns':<8} {'Tokens':<10} {'Loop (ms)':<12} {'Searchsorted (ms)':<20} {'Speedup':<10}"
+    )
+    print("-" * 64)
+    for num_turns in args.num_turns:
+        inputs = []
+        for _ in range(args.num_conversations):
+            text = build_conversation(chat_template, num_turns, args.words_per_turn)
+            spans = get_spans(text, chat_template)
+            inputs.append((get_offsets(text, tokenizer), spans))
+
+        loop_masks, loop_time = benchmark(loss_mask_loop, inputs)
+        masks, searchsorted_time = benchmark(get_span_loss_mask, inputs)
+        for loop_mask, mask in zip(loop_masks, masks):
+            assert torch.equal(loop_mask, mask), "The loss masks differ"
+
+        num_tokens = sum(len(offsets) for offsets, _ in inputs) // len(inputs)
+        print(
+            f"{num_turns:<8} {num_tokens:<10} {loop_time / len(inputs) * 1000:<12.3f} "
+            f"{searchsorted_time / len(inputs) * 1000:<20.3f} {loop_time / searchsorted_time:<10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
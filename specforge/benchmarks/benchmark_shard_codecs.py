@@ -0,0 +1,177 @@
+"""
+Read throughput versus compression ratio of the packed offline hidden states.
+
+It writes the same samples into packed shards with every available codec, evicts the
+shard files from the page cache, and reads them back with a DataLoader, so that the
+decompression is spread over the worker processes as during training. The throughput
+is reported in uncompressed MB/s, i.e. the rate at which hidden states reach the trainer.
+Point --output-dir to the filesystem used for training (e.g. the shared NFS mount) to
+measure the read bandwidth that matters.
+
+Usage:
+    # on hidden states generated by scripts/prepare_hidden_states.py
+    python specforge/benchmarks/benchmark_shard_codecs.py \
+        --hidden-states-path ./cache/hidden_states/sharegpt_train_Llama-3.1-8B-Instruct \
+        --output-dir /mnt/nfs/tmp/shard_benchmark \
+        --num-samples 256 --num-workers 8
+
+    # on synthetic bf16 hidden states
+    python specforge/benchmarks/benchmark_shard_codecs.py --hidden-size 4096
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from specforge.data.preprocessing import build_offline_eagle3_dataset
+from specforge.data.shard import SHARD_CODECS, ShardReader, ShardWriter, list_shard_dirs
+
+
+def load_samples(args):
+    """Yield the token-major fields of the samples, as stored in the shards."""
+    if args.hidden_states_path is not None:
+        dataset = build_offline_eagle3_dataset(args.hidden_states_path)
+        for i in range(min(args.num_samples, len(dataset))):
+            data = dataset._open_file(i)
+            sample = {
+                "input_ids": data["input_ids"],
+                "loss_mask": data["loss_mask"],
+            }
+            for key in ["hidden_state", "aux_hidden_state"]:
+                if data.get(key) is not None:
+                    sample[key] = data[key].squeeze(0)
+            yield sample
+    else:
+        for _ in range(args.num_samples):
+            hidden_states = torch.randn(
+                args.seq_len, args.hidden_size * 4, dtype=torch.bfloat16
+            )
+            yield {
+                "input_ids": torch.randint(0, 128000, (args.seq_len,)),
+                "loss_mask": torch.randint(0, 2, (args.seq_len,)),
+                "hidden_state": hidden_states[:, : args.hidden_size].contiguous(),
+                "aux_hidden_state": hidden_states[:, args.hidden_size :].contiguous(),
+            }
+
+
+class ShardDataset(Dataset):
+    def __init__(self, shard_dirs):
+        readers = [ShardReader(shard_dir) for shard_dir in shard_dirs]
+        self.samples = [
+            (reader, index) for reader in readers for index in range(len(reader))
+        ]
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        reader, local_index = self.samples[index]
+        return reader[local_index]
+
+
+def get_dir_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def drop_page_cache(path):
+    # the files are fsynced by the writer, so their pages are clean and can be evicted
+    for root, _, names in os.walk(path):
+        for name in names:
+            fd = os.open(os.path.join(root, name), os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the read throughput of the compressed offline shards"
+    )
+    parser.add_argument("--hidden-states-path", type=str, default=None)
+    parser.add_argument("--output-dir", type=str, default=None)
+    parser.add_argument("--num-samples", type=int, default=64)
+    parser.add_argument("--seq-len", type=int, default=2048)
+    parser.add_argument("--hidden-size", type=int, default=4096)
+    parser.add_argument("--samples-per-shard", type=int, default=32)
+    parser.add_argument("--num-workers", type=int, default=4)
+    parser.add_argument("--compression-level", type=int, default=None)
+    args = parser.parse_args()
+
+    samples = list(load_samples(args))
+    raw_bytes = sum(
+        tensor.numel() * tensor.element_size()
+        for sample in samples
+        for tensor in sample.values()
+    )
+    output_dir = tempfile.mkdtemp(dir=args.output_dir)
+
+    results = []
+    try:
+        for codec in SHARD_CODECS:
+            codec_dir = os.path.join(output_dir, codec)
+            start = time.perf_counter()
+            try:
+                writer = ShardWriter(
+                    codec_dir,
+                    samples_per_shard=args.samples_per_shard,
+                    codec=codec,
+                    compression_level=args.compression_level,
+                )
+            except ImportError as e:
+                print(f"Skipping {codec}: {e}")
+                continue
+            for sample_id, sample in enumerate(samples):
+                writer.write(sample_id, sample)
+            writer.close()
+            write_time = time.perf_counter() - start
+
+            drop_page_cache(codec_dir)
+            dataloader = DataLoader(
+                ShardDataset(list_shard_dirs(codec_dir)),
+                batch_size=None,
+                num_workers=args.num_workers,
+            )
+            start = time.perf_counter()
+            for _ in dataloader:
+                pass
+            read_time = time.perf_counter() - start
+
+            results.append(
+                (
+                    codec,
+                    raw_bytes / get_dir_size(codec_dir),
+                    raw_bytes / write_time / 1024**2,
+                    raw_bytes / read_time / 1024**2,
+                    len(samples) / read_time,
+                )
+            )
+            shutil.rmtree(codec_dir)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    print(
+        f"\n=== Shard Codec Report ({len(samples)} samples, {raw_bytes / 1024**2:.1f} MB, "
+        f"{args.num_workers} workers) ==="
+    )
+    print(
+        f"{'Codec':<8} {'Compression':<12} {'Write MB/s':<12} {'Read MB/s':<12} {'Samples/s':<12}"
+    )
+    print("-" * 60)
+    for codec, ratio, write_throughput, read_throughput, samples_per_s in results:
+        print(
+            f"{codec:<8} {ratio:<12.2f} {write_throughput:<12.1f} {read_throughput:<12.1f} {samples_per_s:<12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
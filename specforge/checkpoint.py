@@ -0,0 +1,245 @@
+"""
+Sharded asynchronous checkpoints of the draft model training.
+
+The checkpoints are saved to the output directory as epoch_<epoch>_step_<step>:
+
+    epoch_<epoch>_step_<step>/
+        model/                  # the draft weights, sharded across the ranks with DCP
+        rank_<rank>_state.pt    # the optimizer shard and the RNG states of each rank
+        config.json             # the draft model config
+        training_state.pt       # written last, once every rank has flushed its files
+
+Each rank copies its shards to host memory and writes them from a background thread,
+so the training goes on while the files are flushed. `consolidate_checkpoint` gathers
+the sharded weights into the `save_pretrained` format of the full checkpoints, which the
+training can also resume from.
+"""
+
+import os
+import re
+import shutil
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import torch
+import torch.distributed as dist
+import torch.distributed.checkpoint as dcp
+from torch.distributed.checkpoint.format_utils import dcp_to_torch_save
+from transformers.utils import SAFE_WEIGHTS_INDEX_NAME, SAFE_WEIGHTS_NAME, WEIGHTS_NAME
+
+from specforge.modeling.auto import AutoDraftModelConfig, AutoEagle3DraftModel
+
+SHARDED_MODEL_DIR = "model"
+RANK_STATE_NAME = "rank_{rank}_state.pt"
+TRAINING_STATE_NAME = "training_state.pt"
+
+_CHECKPOINT_RE = re.compile(r"^epoch_(\d+)(?:_step_(\d+))?$")
+
+
+def list_checkpoints(output_dir: str) -> List[str]:
+    """
+    List the complete checkpoints of an output directory, i.e. those whose training
+    state was written, from the oldest to the latest.
+
+    Args:
+        output_dir: The output directory of the training.
+
+    Returns:
+        The paths of the checkpoints.
+    """
+    checkpoints = []
+    for name in os.listdir(output_dir):
+        match = _CHECKPOINT_RE.match(name)
+        training_state_path = os.path.join(output_dir, name, TRAINING_STATE_NAME)
+        if match is not None and os.path.exists(training_state_path):
+            epoch, step = (int(group or 0) for group in match.groups())
+            checkpoints.append((epoch, step, os.path.join(output_dir, name)))
+    return [path for _, _, path in sorted(checkpoints)]
+
+
+def remove_old_checkpoints(output_dir: str, max_checkpoints: int) -> None:
+    """
+    Delete the oldest complete checkpoints of an output directory, keeping the latest
+    max_checkpoints ones.
+
+    Args:
+        output_dir: The output directory of the training.
+        max_checkpoints: The number of checkpoints to keep.
+    """
+    checkpoints = list_checkpoints(output_dir)
+    for path in checkpoints[: max(len(checkpoints) - max_checkpoints, 0)]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def is_consolidated(checkpoint_dir: str) -> bool:
+    """Whether a checkpoint holds the draft weights in the `save_pretrained` format."""
+    return any(
+        os.path.exists(os.path.join(checkpoint_dir, name))
+        for name in (SAFE_WEIGHTS_NAME, SAFE_WEIGHTS_INDEX_NAME, WEIGHTS_NAME)
+    )
+
+
+def consolidate_checkpoint(
+    checkpoint_dir: str, output_dir: Optional[str] = None
+) -> None:
+    """
+    Gather the sharded draft weights of a checkpoint and save them with
+    `save_pretrained`. It runs in a single process, without the training ranks.
+
+    Args:
+        checkpoint_dir: The directory of the sharded checkpoint.
+        output_dir: The directory to save the draft model to, the checkpoint directory
+            if None.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        state_dict_path = os.path.join(tmp_dir, "model.pt")
+        dcp_to_torch_save(
+            os.path.join(checkpoint_dir, SHARDED_MODEL_DIR), state_dict_path
+        )
+        state_dict = torch.load(state_dict_path, weights_only=True)
+    config = AutoDraftModelConfig.from_file(os.path.join(checkpoint_dir, "config.json"))
+    draft_model = AutoEagle3DraftModel.from_config(config, torch_dtype=torch.bfloat16)
+    draft_model.save_pretrained(output_dir or checkpoint_dir, state_dict=state_dict)
+
+
+class AsyncCheckpointer:
+    """
+    Save sharded checkpoints from a background thread, see the module docstring. A save
+    first waits for the previous one to be written, so a single checkpoint is held in
+    host memory at a time.
+    """
+
+    def __init__(
+        self, max_checkpoints: Optional[int] = None, ranks: Optional[List[int]] = None
+    ):
+        """
+        Args:
+            max_checkpoints: The number of checkpoints to keep in the output directory,
+                all of them if None.
+            ranks: The ranks which save the checkpoints, all of them if None. Only these
+                ranks create the checkpointer.
+        """
+        # the background writes cannot use the NCCL communicator of the training, whose
+        # collectives are issued from the main thread
+        self.process_group = dist.new_group(
+            ranks=ranks, backend="gloo", use_local_synchronization=ranks is not None
+        )
+        self.max_checkpoints = max_checkpoints
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._future: Optional[Future] = None
+        # the pinned host buffers are reused by the next checkpoints
+        self._host_buffers: List[torch.Tensor] = []
+        self._stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+
+    def _copy_to_host(self, state: Any) -> Any:
+        num_tensors = 0
+
+        def copy(obj: Any) -> Any:
+            nonlocal num_tensors
+            if isinstance(obj, torch.Tensor):
+                if num_tensors == len(self._host_buffers):
+                    self._host_buffers.append(None)
+                buffer = self._host_buffers[num_tensors]
+                if (
+                    buffer is None
+                    or buffer.shape != obj.shape
+                    or buffer.dtype != obj.dtype
+                ):
+                    buffer = torch.empty(
+                        obj.shape, dtype=obj.dtype, pin_memory=obj.is_cuda
+                    )
+                    self._host_buffers[num_tensors] = buffer
+                num_tensors += 1
+                return buffer.copy_(obj, non_blocking=True)
+            if isinstance(obj, dict):
+                return {key: copy(value) for key, value in obj.items()}
+            if type(obj) in (list, tuple):
+                return type(obj)(copy(value) for value in obj)
+            return obj
+
+        return copy(state)
+
+    def save(
+        self,
+        checkpoint_dir: str,
+        model_state_dict: Dict[str, Any],
+        rank_state: Dict[str, Any],
+        training_state: Dict[str, Any],
+    ) -> None:
+        """
+        Start saving a checkpoint, its files are written in the background.
+
+        Args:
+            checkpoint_dir: The directory of the checkpoint.
+            model_state_dict: The sharded state dict of the draft model, e.g. the
+                SHARDED_STATE_DICT of FSDP.
+            rank_state: The state of this rank, e.g. its optimizer shard.
+            training_state: The state saved by rank 0 once all the files are written.
+        """
+        self.wait()
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        # DCP copies the shards of the weights to host memory before returning
+        model_future = dcp.async_save(
+            model_state_dict,
+            checkpoint_id=os.path.join(checkpoint_dir, SHARDED_MODEL_DIR),
+            process_group=self.process_group,
+        )
+
+        copied = None
+        if self._stream is not None:
+            self._stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(self._stream):
+                rank_state = self._copy_to_host(rank_state)
+            copied = self._stream.record_event()
+            # the next optimizer steps update the state in place after it is copied
+            torch.cuda.current_stream().wait_stream(self._stream)
+        else:
+            rank_state = self._copy_to_host(rank_state)
+
+        self._future = self._executor.submit(
+            self._write,
+            checkpoint_dir,
+            model_future,
+            rank_state,
+            copied,
+            training_state,
+        )
+
+    def _write(
+        self,
+        checkpoint_dir: str,
+        model_future: Future,
+        rank_state: Dict[str, Any],
+        copied: Optional[torch.cuda.Event],
+        training_state: Dict[str, Any],
+    ) -> None:
+        if copied is not None:
+            copied.synchronize()
+        rank = dist.get_rank()
+        torch.save(
+            rank_state, os.path.join(checkpoint_dir, RANK_STATE_NAME.format(rank=rank))
+        )
+        model_future.result()
+        # the training state marks the checkpoint as complete
+        dist.barrier(group=self.process_group)
+        if rank == 0:
+            torch.save(
+                training_state, os.path.join(checkpoint_dir, TRAINING_STATE_NAME)
+            )
+            if self.max_checkpoints is not None:
+                remove_old_checkpoints(
+                    os.path.dirname(os.path.normpath(checkpoint_dir)),
+                    self.max_checkpoints,
+                )
+
+    def wait(self) -> None:
+        """Wait for the last checkpoint to be written, and raise its error if any."""
+        if self._future is not None:
+            future, self._future = self._future, None
+            future.result()
+
+    def close(self) -> None:
+        """Wait for the last checkpoint and stop the background thread."""
+        self.wait()
+        self._executor.shutdown()
@@ -29,7 +29,7 @@ from transformers.cache_utils import DynamicCache
 
 from specforge.core.loss import LogSoftmaxLoss
 from specforge.modeling.draft import Eagle3DraftModel
-from specforge.utils import padding
+from specforge.utils import get_document_end_mask, padding
 
 
 class Eagle3Model(nn.Module):
@@ -74,6 +74,9 @@ class OnlineEagle3Model(Eagle3Model):
         hidden_states: torch.Tensor,
         past_key_values: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
         position_ids: Optional[torch.Tensor] = None,
+        target_topk_probs: Optional[torch.Tensor] = None,
+        target_topk_indices: Optional[torch.Tensor] = None,
+        target_in_draft: Optional[torch.Tensor] = None,
         **kwargs,
     ) -> Tuple[List[torch.Tensor], List[torch.Tensor], List[torch.Tensor]]:
         """
@@ -84,15 +87,28 @@ class OnlineEagle3Model(Eagle3Model):
             attention_mask: (batch, seq_len)
             loss_mask: (batch, seq_len)
             past_key_values: We dont use this past_key_values in eagle3, but keep it for compatibility. We control kvcache by cache_hidden.
-            position_ids: (batch, seq_len)
+            position_ids: (batch, seq_len), they restart at 0 at the start of each document of packed rows.
+            target_topk_probs: (batch, seq_len, topk), the sparse teacher distribution over the draft vocab. If given, target is ignored.
+            target_topk_indices: (batch, seq_len, topk), the draft token ids of target_topk_probs.
+            target_in_draft: (batch, seq_len), whether the target argmax token is in the draft vocab.
         """
         # Step 1: handle vocab size
-        target_p_padded, position_mask = _compute_target_p_padded(
-            target=target,
-            t2d=self.draft_model.t2d,
-            loss_mask=loss_mask,
-            length=self.length,
-        )
+        if target_topk_probs is not None:
+            target_p_padded, position_mask = _compute_target_p_padded_from_topk(
+                topk_probs=target_topk_probs,
+                topk_indices=target_topk_indices,
+                target_in_draft=target_in_draft,
+                draft_vocab_size=self.draft_model.d2t.shape[0],
+                loss_mask=loss_mask,
+                length=self.length,
+            )
+        else:
+            target_p_padded, position_mask = _compute_target_p_padded(
+                target=target,
+                t2d=self.draft_model.t2d,
+                loss_mask=loss_mask,
+                length=self.length,
+            )
         del target
 
         # basic info
@@ -107,6 +123,7 @@ class OnlineEagle3Model(Eagle3Model):
         if past_key_values is not None:
             past_key_values_length = past_key_values[0][0].shape[2]
             seq_length_with_past = seq_length_with_past + past_key_values_length
+        document_end = None
         if position_ids is None:
             device = hidden_states.device
             position_ids = torch.arange(
@@ -118,6 +135,8 @@ class OnlineEagle3Model(Eagle3Model):
             position_ids = position_ids.unsqueeze(0).view(-1, seq_length)
         else:
             position_ids = position_ids.view(-1, seq_length).long()
+            # the rows may pack several documents, which are shifted separately
+            document_end = get_document_end_mask(position_ids)
 
         # Step 4: handle attention mask
         if attention_mask is None:
@@ -188,9 +207,11 @@ class OnlineEagle3Model(Eagle3Model):
 
             if not is_last:
                 # Step 5.7: we need to update the loss mask
-                input_ids = padding(input_ids, left=False)
-                position_mask = padding(position_mask, left=False)
-                loss_mask = padding(loss_mask, left=False)
+                input_ids = padding(input_ids, left=False, document_end=document_end)
+                position_mask = padding(
+                    position_mask, left=False, document_end=document_end
+                )
+                loss_mask = padding(loss_mask, left=False, document_end=document_end)
                 # Flex attention mask shirnking is handled inside attention module
         return plosses, vlosses, acces
 
@@ -506,6 +527,29 @@ def _compute_target_p_padded(target, t2d, loss_mask, length):
         return target_p_padded, position_mask
 
 
+def _compute_target_p_padded_from_topk(
+    topk_probs, topk_indices, target_in_draft, draft_vocab_size, loss_mask, length
+):
+    with torch.no_grad():
+        # scatter the sparse teacher distribution back to a dense one over the draft vocab
+        target_p = torch.zeros(
+            *topk_probs.shape[:-1],
+            draft_vocab_size,
+            dtype=torch.float32,
+            device=topk_probs.device,
+        )
+        target_p.scatter_(-1, topk_indices.long(), topk_probs.float())
+        position_mask = target_in_draft[..., None].int() * loss_mask
+
+        target_p_padded = F.pad(
+            target_p,
+            pad=(0, 0, 0, length),
+            mode="constant",
+            value=1 / draft_vocab_size,
+        )
+        return target_p_padded, position_mask
+
+
 @torch.compile(dynamic=None)
 def _compute_target_p(target, t2d, loss_mask):
     target_head = target
@@ -520,6 +564,35 @@ def _compute_target_p(target, t2d, loss_mask):
     return target_p, position_mask
 
 
+@torch.no_grad()
+def compute_topk_target_p(
+    target: torch.Tensor, t2d: torch.Tensor, topk: int
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Compute the sparse teacher distribution used by offline training, this is the
+    top-k of the target_p computed by `_compute_target_p`.
+
+    Args:
+        target: The target logits of shape (..., vocab_size).
+        t2d: The boolean mask of the target tokens which are in the draft vocab.
+        topk: The number of probabilities to keep for each token.
+
+    Returns:
+        A tuple of:
+            - topk_probs: (..., topk), float16 probabilities over the draft vocab.
+            - topk_indices: (..., topk), int32 draft token ids.
+            - target_in_draft: (...), uint8, whether the target argmax token is in the draft vocab.
+    """
+    target_in_draft = t2d[target.argmax(-1)]
+    target_p = nn.Softmax(dim=-1)(target[..., t2d].float())
+    topk_probs, topk_indices = target_p.topk(topk, dim=-1)
+    return (
+        topk_probs.to(torch.float16),
+        topk_indices.to(torch.int32),
+        target_in_draft.to(torch.uint8),
+    )
+
+
 @torch.compile(dynamic=None)
 def _compute_metric_acc(logits, target_p, position_mask, loss_mask):
     return (
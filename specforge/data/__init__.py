@@ -2,6 +2,7 @@ from .preprocessing import (
     build_eagle3_dataset,
     build_offline_eagle3_dataset,
     generate_vocab_mapping_file,
+    get_offline_vocab_mapping_path,
 )
 from .utils import prepare_dp_dataloaders
 
@@ -9,5 +10,6 @@ __all__ = [
     "build_eagle3_dataset",
     "build_offline_eagle3_dataset",
     "generate_vocab_mapping_file",
+    "get_offline_vocab_mapping_path",
     "prepare_dp_dataloaders",
 ]
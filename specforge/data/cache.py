@@ -0,0 +1,275 @@
+"""
+Content-addressed cache of the processed (tokenized) training dataset.
+
+The processed rows are keyed by a hash of the content of their input row, and grouped
+by a fingerprint of everything else the processing depends on, i.e. the tokenizer
+files, the chat template definition, the max length and the input format:
+
+    <cache_dir>/<fingerprint>/
+        shard_00000/    # processed rows with their row_hash, saved with save_to_disk
+        shard_00001/    # the rows which were new in a later run
+        ...
+        skipped_hashes.npy  # the hashes of the rows skipped by the processing
+
+When a dataset is built, the rows whose hash is not in the cache yet are processed
+and saved as a new shard, and the dataset is assembled from the shards in the order of
+the input rows. The rows which the processing skips, e.g. the empty conversations, have
+no processed row, their hashes are recorded so that they are not processed again. Editing or appending rows only processes the changed rows, and the
+scripts which process the same dataset with the same tokenizer share the cache. The
+key of the assembled dataset, see `get_dataset_key`, also identifies the caches
+derived from it, e.g. the vocab mapping and the compact dataset.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import pyarrow as pa
+from datasets import Dataset as HFDataset
+from datasets import concatenate_datasets, load_from_disk
+from transformers import ImageProcessingMixin, PreTrainedTokenizer
+
+from .template import ChatTemplate
+
+ROW_HASH_COLUMN = "row_hash"
+SKIPPED_HASHES_FILE = "skipped_hashes.npy"
+# the lookup results of the rows which are not in the cache or were skipped
+MISSING_ROW = -1
+SKIPPED_ROW = -2
+
+# bump it when the output of the processing changes for the same inputs
+CACHE_FORMAT_VERSION = 1
+
+
+def _hash_rows(batch: pa.Table) -> Dict[str, list]:
+    # a 64-bit hash of the JSON of each row, the keys are sorted so that the hash does
+    # not depend on the column order
+    row_hashes = []
+    for row in batch.to_pylist():
+        digest = hashlib.blake2b(
+            json.dumps(row, sort_keys=True, default=str).encode(), digest_size=8
+        ).digest()
+        row_hashes.append(int.from_bytes(digest, "little", signed=True))
+    return {ROW_HASH_COLUMN: row_hashes}
+
+
+def hash_rows(dataset: HFDataset, num_proc: Optional[int] = None) -> np.ndarray:
+    """
+    Hash the content of each row of a dataset.
+
+    Args:
+        dataset: The raw dataset.
+        num_proc: The number of processes hashing the dataset shards in parallel.
+
+    Returns:
+        An int64 array with the hash of each row.
+    """
+    row_hashes = dataset.with_format("arrow").map(
+        _hash_rows,
+        batched=True,
+        batch_size=1000,
+        num_proc=num_proc,
+        remove_columns=dataset.column_names,
+        desc="Hashing rows",
+    )
+    return row_hashes.with_format("arrow")[:][ROW_HASH_COLUMN].to_numpy()
+
+
+def _get_row_hashes(shard: HFDataset) -> np.ndarray:
+    return shard.with_format("arrow")[:][ROW_HASH_COLUMN].to_numpy()
+
+
+def get_processing_fingerprint(
+    tokenizer: PreTrainedTokenizer,
+    chat_template: ChatTemplate,
+    max_length: int,
+    is_preformatted: bool,
+    processor: Optional[ImageProcessingMixin] = None,
+) -> str:
+    """
+    Fingerprint everything the processing of a row depends on besides its content.
+
+    Args:
+        tokenizer: The tokenizer to use for tokenization.
+        chat_template: The chat template definition.
+        max_length: The maximum length of the tokenized input.
+        is_preformatted: Whether the rows contain preformatted text.
+        processor: The image processor of VLM datasets.
+
+    Returns:
+        The hex digest of the fingerprint.
+    """
+    fingerprint = hashlib.blake2b(digest_size=16)
+    # the saved files capture the vocab, the merges and the special tokens, whatever
+    # the tokenizer was loaded from
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        (processor if processor is not None else tokenizer).save_pretrained(tmp_dir)
+        for name in sorted(os.listdir(tmp_dir)):
+            fingerprint.update(name.encode())
+            with open(os.path.join(tmp_dir, name), "rb") as f:
+                fingerprint.update(f.read())
+    fingerprint.update(chat_template.model_dump_json().encode())
+    params = {
+        "version": CACHE_FORMAT_VERSION,
+        "max_length": max_length,
+        "is_preformatted": is_preformatted,
+        "is_vlm": processor is not None,
+    }
+    fingerprint.update(json.dumps(params, sort_keys=True).encode())
+    return fingerprint.hexdigest()
+
+
+def get_dataset_key(fingerprint: str, row_hashes: np.ndarray) -> str:
+    """The key of the processed dataset made of the given rows, in this order."""
+    key = hashlib.blake2b(fingerprint.encode(), digest_size=16)
+    key.update(np.ascontiguousarray(row_hashes, dtype=np.int64).tobytes())
+    return key.hexdigest()
+
+
+class ProcessedDatasetCache:
+    """
+    The shards of processed rows sharing a processing fingerprint, see the module
+    docstring.
+    """
+
+    def __init__(self, cache_dir: str, fingerprint: str):
+        self.path = os.path.join(cache_dir, fingerprint)
+        os.makedirs(self.path, exist_ok=True)
+        # the shards are renamed into place once saved, so the listed ones are complete
+        self.shards: List[HFDataset] = [
+            load_from_disk(os.path.join(self.path, name))
+            for name in sorted(os.listdir(self.path))
+            if name.startswith("shard_") and not name.endswith(".tmp")
+        ]
+        if len(self.shards) > 0:
+            self.row_hashes = np.concatenate(
+                [_get_row_hashes(shard) for shard in self.shards]
+            )
+        else:
+            self.row_hashes = np.zeros(0, dtype=np.int64)
+        self._order = np.argsort(self.row_hashes, kind="stable")
+        skipped_path = os.path.join(self.path, SKIPPED_HASHES_FILE)
+        if os.path.exists(skipped_path):
+            self.skipped_hashes = np.load(skipped_path)
+        else:
+            self.skipped_hashes = np.zeros(0, dtype=np.int64)
+
+    def lookup(self, row_hashes: np.ndarray) -> np.ndarray:
+        """
+        Find the processed rows of the given row hashes.
+
+        Args:
+            row_hashes: The hashes of the input rows.
+
+        Returns:
+            The index of each processed row in the concatenated shards, SKIPPED_ROW if
+            the row was skipped by the processing, or MISSING_ROW if the row is not in
+            the cache.
+        """
+        indices = np.full(len(row_hashes), MISSING_ROW, dtype=np.int64)
+        if len(self.row_hashes) > 0:
+            sorted_hashes = self.row_hashes[self._order]
+            positions = np.searchsorted(sorted_hashes, row_hashes)
+            positions = np.minimum(positions, len(sorted_hashes) - 1)
+            found = sorted_hashes[positions] == row_hashes
+            indices[found] = self._order[positions[found]]
+        skipped = np.isin(row_hashes, self.skipped_hashes)
+        indices[skipped & (indices == MISSING_ROW)] = SKIPPED_ROW
+        return indices
+
+    def add_shard(self, processed: HFDataset) -> None:
+        """
+        Save processed rows, with their row_hash column, as a new shard.
+
+        Args:
+            processed: The processed rows.
+        """
+        shard_path = os.path.join(self.path, f"shard_{len(self.shards):05d}")
+        tmp_path = f"{shard_path}.tmp"
+        if os.path.exists(tmp_path):
+            # a previous run was interrupted while saving the shard
+            shutil.rmtree(tmp_path)
+        processed.save_to_disk(tmp_path)
+        os.replace(tmp_path, shard_path)
+        shard = load_from_disk(shard_path)
+        self.shards.append(shard)
+        self.row_hashes = np.concatenate([self.row_hashes, _get_row_hashes(shard)])
+        self._order = np.argsort(self.row_hashes, kind="stable")
+
+    def add_skipped(self, row_hashes: np.ndarray) -> None:
+        """
+        Record the hashes of rows which the processing skipped.
+
+        Args:
+            row_hashes: The hashes of the skipped rows.
+        """
+        self.skipped_hashes = np.union1d(self.skipped_hashes, row_hashes)
+        skipped_path = os.path.join(self.path, SKIPPED_HASHES_FILE)
+        # np.save appends .npy to the paths without it
+        tmp_path = f"{skipped_path}.tmp.npy"
+        np.save(tmp_path, self.skipped_hashes)
+        os.replace(tmp_path, skipped_path)
+
+    def process(
+        self,
+        dataset: HFDataset,
+        function: Callable,
+        row_hashes: np.ndarray,
+        **map_kwargs,
+    ) -> None:
+        """
+        Process rows with `dataset.map` and save the output as a new shard. The output
+        of the function must have a row_hash column, the rows whose hash is missing from
+        it are recorded as skipped.
+
+        Args:
+            dataset: The rows to process.
+            function: The batched processing function.
+            row_hashes: The hashes of the rows.
+            map_kwargs: The other arguments of `dataset.map`.
+        """
+        # the output of the map is written next to the shards and deleted once saved
+        processed = dataset.map(
+            function,
+            batched=True,
+            cache_file_name=os.path.join(self.path, "processing.arrow"),
+            load_from_cache_file=False,
+            **map_kwargs,
+        )
+        if len(processed) > 0:
+            self.add_shard(processed)
+            processed_hashes = _get_row_hashes(processed)
+        else:
+            # e.g. all the rows are empty conversations
+            processed_hashes = np.zeros(0, dtype=np.int64)
+        skipped_hashes = np.setdiff1d(row_hashes, processed_hashes)
+        if len(skipped_hashes) > 0:
+            self.add_skipped(skipped_hashes)
+        del processed
+        for name in os.listdir(self.path):
+            if name.startswith("processing") and name.endswith(".arrow"):
+                os.remove(os.path.join(self.path, name))
+
+    def select(self, row_hashes: np.ndarray) -> Optional[HFDataset]:
+        """
+        Assemble the processed dataset of the given rows, in their order. The rows which
+        are not in the cache, e.g. the empty conversations which are skipped by the
+        processing, are left out.
+
+        Args:
+            row_hashes: The hashes of the input rows.
+
+        Returns:
+            The processed dataset, without the row_hash column, or None if the cache has
+            no shard, the schema of the processed rows is then unknown.
+        """
+        if len(self.shards) == 0:
+            return None
+        indices = self.lookup(row_hashes)
+        dataset = concatenate_datasets(self.shards)
+        dataset = dataset.select(indices[indices >= 0])
+        return dataset.remove_columns(ROW_HASH_COLUMN)
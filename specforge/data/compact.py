@@ -0,0 +1,185 @@
+"""
+Compact storage format for the processed (tokenized) training dataset.
+
+`build_eagle3_dataset` stores every sample as nested int64 lists for ``input_ids``,
+``loss_mask`` and ``attention_mask`` in Arrow. The compact format stores the same data
+in a directory of flat files instead:
+
+    <cache_key>.compact/
+        input_ids.bin   # the concatenated token ids of the samples, uint32
+        loss_mask.bin   # the concatenated loss masks of the samples, 1 bit per token
+        offsets.bin     # the start of each sample in the buffers, num_samples + 1 int64
+        index.json      # written last, a directory without it is incomplete
+
+The attention mask is all ones and is not stored. The files are memory-mapped lazily,
+so the dataset can be pickled into the DataLoader workers and all the ranks and workers
+share the same pages of the page cache. Reading a sample only slices the buffers.
+"""
+
+import json
+import os
+import shutil
+from typing import Dict, List
+
+import numpy as np
+import pyarrow.compute as pc
+import torch
+from datasets import Dataset as HFDataset
+
+from .utils import flatten_batch_dim
+
+COMPACT_INDEX_FILE = "index.json"
+
+# the number of samples converted at once when writing a compact dataset
+_WRITE_BATCH_SIZE = 10000
+# the number of tokens counted at once by `count_masked_tokens`, a multiple of 8
+_COUNT_CHUNK_SIZE = 1 << 26
+
+
+def is_compact_dataset(path: str) -> bool:
+    return os.path.exists(os.path.join(path, COMPACT_INDEX_FILE))
+
+
+def write_compact_dataset(dataset: HFDataset, output_dir: str) -> str:
+    """
+    Convert a dataset processed by `build_eagle3_dataset` to the compact format.
+
+    Args:
+        dataset: The processed dataset with the input_ids and loss_mask columns.
+        output_dir: The directory to write the compact dataset to.
+
+    Returns:
+        The output directory.
+    """
+    if os.path.exists(output_dir):
+        # a previous conversion was interrupted
+        shutil.rmtree(output_dir)
+    os.makedirs(output_dir)
+
+    offsets = [0]
+    # the bits which do not fill a byte yet are carried over to the next batch
+    pending_bits = np.zeros(0, dtype=np.uint8)
+    with open(os.path.join(output_dir, "input_ids.bin"), "wb") as input_ids_file, open(
+        os.path.join(output_dir, "loss_mask.bin"), "wb"
+    ) as loss_mask_file:
+        for batch in dataset.with_format("arrow").iter(batch_size=_WRITE_BATCH_SIZE):
+            input_ids = flatten_batch_dim(batch["input_ids"])
+            lengths = pc.list_value_length(input_ids).to_numpy()
+            input_ids = pc.list_flatten(input_ids).to_numpy()
+            loss_mask = pc.list_flatten(flatten_batch_dim(batch["loss_mask"]))
+            loss_mask = loss_mask.to_numpy().astype(np.uint8)
+
+            assert (
+                len(input_ids) == 0 or input_ids.max() <= np.iinfo(np.uint32).max
+            ), "The token ids do not fit in uint32"
+            input_ids_file.write(input_ids.astype(np.uint32).tobytes())
+
+            bits = np.concatenate([pending_bits, loss_mask])
+            num_full_bytes = len(bits) // 8 * 8
+            loss_mask_file.write(
+                np.packbits(bits[:num_full_bytes], bitorder="little").tobytes()
+            )
+            pending_bits = bits[num_full_bytes:]
+
+            offsets.extend((offsets[-1] + np.cumsum(lengths)).tolist())
+
+        loss_mask_file.write(np.packbits(pending_bits, bitorder="little").tobytes())
+        for f in [input_ids_file, loss_mask_file]:
+            f.flush()
+            os.fsync(f.fileno())
+
+    np.asarray(offsets, dtype=np.int64).tofile(os.path.join(output_dir, "offsets.bin"))
+    index = {"num_samples": len(offsets) - 1, "num_tokens": offsets[-1]}
+    tmp_index_path = os.path.join(output_dir, f"{COMPACT_INDEX_FILE}.tmp")
+    with open(tmp_index_path, "w") as f:
+        json.dump(index, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_index_path, os.path.join(output_dir, COMPACT_INDEX_FILE))
+    return output_dir
+
+
+class CompactEagle3Dataset(torch.utils.data.Dataset):
+    """
+    Processed training dataset stored in the compact format, see
+    `write_compact_dataset`.
+    The samples have the same layout as the rows of the dataset returned by
+    `build_eagle3_dataset`, i.e. tensors of shape (1, seq_len).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, COMPACT_INDEX_FILE), "r") as f:
+            index = json.load(f)
+        self.num_tokens = index["num_tokens"]
+        self.offsets = np.fromfile(os.path.join(path, "offsets.bin"), dtype=np.int64)
+        assert len(self.offsets) == index["num_samples"] + 1
+        self.lengths: List[int] = np.diff(self.offsets).tolist()
+        self._input_ids = None
+        self._loss_mask = None
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_input_ids"] = None
+        state["_loss_mask"] = None
+        return state
+
+    def _open_buffers(self) -> None:
+        # np.memmap cannot map empty files
+        if self.num_tokens == 0:
+            self._input_ids = np.zeros(0, dtype=np.uint32)
+            self._loss_mask = np.zeros(0, dtype=np.uint8)
+            return
+        self._input_ids = np.memmap(
+            os.path.join(self.path, "input_ids.bin"), dtype=np.uint32, mode="r"
+        )
+        self._loss_mask = np.memmap(
+            os.path.join(self.path, "loss_mask.bin"), dtype=np.uint8, mode="r"
+        )
+
+    def _get_loss_mask(self, start: int, end: int) -> np.ndarray:
+        bits = np.unpackbits(
+            self._loss_mask[start // 8 : (end + 7) // 8], bitorder="little"
+        )
+        return bits[start % 8 : start % 8 + end - start]
+
+    def __getitem__(self, index: int) -> Dict[str, torch.Tensor]:
+        if self._input_ids is None:
+            self._open_buffers()
+        start, end = int(self.offsets[index]), int(self.offsets[index + 1])
+        input_ids = torch.from_numpy(self._input_ids[start:end].astype(np.int64))
+        loss_mask = torch.from_numpy(self._get_loss_mask(start, end).astype(np.int64))
+        return {
+            "input_ids": input_ids[None, :],
+            "loss_mask": loss_mask[None, :],
+            "attention_mask": torch.ones_like(loss_mask)[None, :],
+        }
+
+    def count_masked_tokens(self, vocab_size: int) -> torch.Tensor:
+        """
+        Count the frequency of each token in the loss mask of the dataset.
+
+        Args:
+            vocab_size: The minimum size of the returned tensor.
+
+        Returns:
+            A tensor of shape (vocab_size,) with the number of occurrences of each
+            token.
+        """
+        if self._input_ids is None:
+            self._open_buffers()
+        token_counts = np.zeros(vocab_size, dtype=np.int64)
+        for start in range(0, self.num_tokens, _COUNT_CHUNK_SIZE):
+            end = min(start + _COUNT_CHUNK_SIZE, self.num_tokens)
+            input_ids = self._input_ids[start:end]
+            loss_mask = self._get_loss_mask(start, end).astype(bool)
+            counts = np.bincount(input_ids[loss_mask], minlength=vocab_size)
+            if len(counts) > len(token_counts):
+                counts[: len(token_counts)] += token_counts
+                token_counts = counts
+            else:
+                token_counts[: len(counts)] += counts
+        return torch.from_numpy(token_counts)
@@ -0,0 +1,239 @@
+"""
+Manifest of the offline hidden states.
+
+`scripts/prepare_hidden_states.py` records every saved sample in a manifest so that the
+training script can build the offline dataset by reading a single file instead of walking
+the directory tree, which can take minutes on network filesystems with millions of files.
+
+Each DP rank appends to its own partial manifest while generating, the partial manifests
+are then merged into ``manifest.jsonl`` at the root of the hidden states path. Each line
+is a JSON object describing one sample:
+
+    {"sample_id": 0, "path": "rows_0-2000/data_0.ckpt", "index": null,
+     "num_tokens": 2048, "num_loss_tokens": 731, "checksum": 1735921461}
+
+``path`` is relative to the root of the hidden states path. For the packed format it is
+the shard directory and ``index`` is the local index of the sample in the shard.
+``checksum`` is the CRC32 of the ``.ckpt`` file, or of the sample bytes in the shard.
+
+The partial manifests are append-only and also serve as the completion journals of the
+DP ranks: a resumed generation skips the samples recorded in its journal without probing
+the filesystem, and only verifies the checksums of the trailing entries which may not
+have reached the disk before a crash.
+"""
+
+import json
+import os
+import threading
+import zlib
+from dataclasses import asdict, dataclass
+from typing import Dict, Iterable, List, Optional
+
+import torch
+
+from .shard import ShardReader
+
+MANIFEST_FILE = "manifest.jsonl"
+
+
+@dataclass
+class ManifestEntry:
+    sample_id: int
+    path: str
+    num_tokens: int
+    num_loss_tokens: int
+    checksum: int
+    index: Optional[int] = None
+
+
+def get_partial_manifest_path(output_path: str, dp_rank: int) -> str:
+    return os.path.join(output_path, f"manifest_dp_rank_{dp_rank}.jsonl")
+
+
+def compute_tensors_checksum(tensors: Iterable[torch.Tensor], checksum: int = 0) -> int:
+    """
+    Compute the CRC32 of the raw bytes of the given tensors.
+
+    Args:
+        tensors: The tensors to checksum, in order.
+        checksum: The running checksum to start from.
+
+    Returns:
+        The CRC32 checksum.
+    """
+    for tensor in tensors:
+        tensor = tensor.detach().cpu().contiguous().reshape(-1)
+        checksum = zlib.crc32(tensor.view(torch.uint8).numpy(), checksum)
+    return checksum
+
+
+def _read_manifest_file(manifest_path: str) -> List[ManifestEntry]:
+    entries = []
+    with open(manifest_path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entries.append(ManifestEntry(**json.loads(line)))
+            except json.JSONDecodeError:
+                # the last line may be truncated if the writer crashed
+                continue
+    return entries
+
+
+class ManifestWriter:
+    """
+    Append the manifest entries of the saved samples to a partial manifest. Entries of a
+    previous run are kept, so the generation can be resumed. The file is fsynced every
+    `sync_interval` entries and when `sync` is called, an entry is only added once the
+    data it refers to is fsynced. This class is thread-safe.
+    """
+
+    def __init__(self, manifest_path: str, sync_interval: int = 1000):
+        """
+        Args:
+            manifest_path: The path to the partial manifest.
+            sync_interval: The number of entries after which the file is fsynced.
+        """
+        self.manifest_path = manifest_path
+        self.sync_interval = sync_interval
+        # the entries in the order they were recorded
+        self.entries: Dict[int, ManifestEntry] = {}
+        if os.path.exists(manifest_path):
+            self._truncate_partial_line()
+            for entry in _read_manifest_file(manifest_path):
+                self.entries[entry.sample_id] = entry
+        os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+        self._file = open(manifest_path, "a")
+        self._lock = threading.Lock()
+        self._num_unsynced = 0
+
+    def _truncate_partial_line(self) -> None:
+        # a crash in the middle of a write leaves a line without newline, it must be
+        # removed before appending
+        with open(self.manifest_path, "rb+") as f:
+            data = f.read()
+            if len(data) > 0 and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+
+    def add(self, entry: ManifestEntry) -> None:
+        with self._lock:
+            self._file.write(json.dumps(asdict(entry)) + "\n")
+            self._file.flush()
+            self.entries[entry.sample_id] = entry
+            self._num_unsynced += 1
+            if self._num_unsynced >= self.sync_interval:
+                self._sync()
+
+    def _sync(self) -> None:
+        os.fsync(self._file.fileno())
+        self._num_unsynced = 0
+
+    def sync(self) -> None:
+        """Flush the recorded entries to disk."""
+        with self._lock:
+            self._sync()
+
+    def discard(self, sample_ids: Iterable[int]) -> None:
+        """
+        Remove entries from the manifest, e.g. the ones whose sample is corrupted, so that
+        the samples are generated again.
+
+        Args:
+            sample_ids: The ids of the samples to remove.
+        """
+        with self._lock:
+            for sample_id in sample_ids:
+                self.entries.pop(sample_id, None)
+            self._file.close()
+            tmp_manifest_path = f"{self.manifest_path}.tmp"
+            with open(tmp_manifest_path, "w") as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(asdict(entry)) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_manifest_path, self.manifest_path)
+            self._file = open(self.manifest_path, "a")
+            self._num_unsynced = 0
+
+    def close(self) -> None:
+        with self._lock:
+            if not self._file.closed:
+                self._sync()
+                self._file.close()
+
+
+def merge_manifests(partial_manifest_paths: List[str], output_path: str) -> str:
+    """
+    Merge the partial manifests of all the DP ranks into a single manifest sorted by sample id.
+
+    Args:
+        partial_manifest_paths: The paths to the partial manifests.
+        output_path: The root directory of the hidden states.
+
+    Returns:
+        The path to the merged manifest.
+    """
+    entries = {}
+    for partial_manifest_path in partial_manifest_paths:
+        if not os.path.exists(partial_manifest_path):
+            continue
+        for entry in _read_manifest_file(partial_manifest_path):
+            entries[entry.sample_id] = entry
+
+    manifest_path = os.path.join(output_path, MANIFEST_FILE)
+    tmp_manifest_path = f"{manifest_path}.tmp"
+    with open(tmp_manifest_path, "w") as f:
+        for sample_id in sorted(entries):
+            f.write(json.dumps(asdict(entries[sample_id])) + "\n")
+    os.replace(tmp_manifest_path, manifest_path)
+    return manifest_path
+
+
+def load_manifest(hidden_states_path: str) -> Optional[List[ManifestEntry]]:
+    """
+    Load the manifest of the offline hidden states.
+
+    Args:
+        hidden_states_path: The root directory of the offline hidden states.
+
+    Returns:
+        The manifest entries sorted by sample id, or None if there is no manifest.
+    """
+    manifest_path = os.path.join(hidden_states_path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    return _read_manifest_file(manifest_path)
+
+
+def verify_manifest(
+    hidden_states_path: str, entries: List[ManifestEntry]
+) -> List[ManifestEntry]:
+    """
+    Verify the checksums of the samples listed in the manifest.
+
+    Args:
+        hidden_states_path: The root directory of the offline hidden states.
+        entries: The manifest entries to verify.
+
+    Returns:
+        The entries whose file is missing or whose checksum does not match.
+    """
+    corrupted = []
+    readers = {}
+    for entry in entries:
+        path = os.path.join(hidden_states_path, entry.path)
+        if not os.path.exists(path):
+            corrupted.append(entry)
+            continue
+        if entry.index is None:
+            with open(path, "rb") as f:
+                checksum = zlib.crc32(f.read())
+        else:
+            if path not in readers:
+                readers[path] = ShardReader(path)
+            checksum = compute_tensors_checksum(readers[path][entry.index].values())
+        if checksum != entry.checksum:
+            corrupted.append(entry)
+    return corrupted
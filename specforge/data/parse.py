@@ -1,16 +1,130 @@
 import re
 import warnings
 from abc import ABC, abstractmethod
-from typing import Dict, List, Tuple
+from itertools import chain
+from typing import Dict, List, Optional, Tuple
 
 import torch
 from transformers import PreTrainedTokenizer
 
-from .template import ChatTemplate
+from .template import ChatTemplate, SeparatorTokenIds
 
 __all__ = ["GeneralParser", "HarmonyParser"]
 
 
+def get_span_loss_mask(
+    offsets: torch.Tensor, spans: List[Tuple[int, int]]
+) -> torch.Tensor:
+    """
+    Mark the tokens overlapping with the given character spans. A token
+    (token_start, token_end) overlaps with the span (start, end) if
+    token_end > start and token_start <= end.
+
+    The offsets of a tokenizer are sorted, so the first and last tokens of each span
+    are found with a binary search and the tokens in between are marked with a slice
+    assignment. If the offsets are not sorted (e.g. some tokens are mapped to (0, 0)),
+    the overlap is computed for every token instead, which gives the same mask.
+
+    Args:
+        offsets: The token offset mapping of shape (num_tokens, 2) from the tokenizer.
+        spans: The (start, end) character spans.
+
+    Returns:
+        A tensor indicating which tokens overlap with any of the spans (1) or not (0).
+    """
+    loss_mask = torch.zeros(len(offsets), dtype=torch.long)
+    if len(offsets) == 0 or len(spans) == 0:
+        return loss_mask
+
+    token_starts = offsets[:, 0].contiguous()
+    token_ends = offsets[:, 1].contiguous()
+    span_starts = torch.tensor([start for start, _ in spans], dtype=offsets.dtype)
+    span_ends = torch.tensor([end for _, end in spans], dtype=offsets.dtype)
+    if (token_starts[1:] >= token_starts[:-1]).all() and (
+        token_ends[1:] >= token_ends[:-1]
+    ).all():
+        # the first token ending after the span start, and the first token starting
+        # after the span end
+        first = torch.searchsorted(token_ends, span_starts, right=True).tolist()
+        last = torch.searchsorted(token_starts, span_ends, right=True).tolist()
+        for first_idx, last_idx in zip(first, last):
+            loss_mask[first_idx:last_idx] = 1
+    else:
+        for start, end in zip(span_starts, span_ends):
+            loss_mask[(token_ends > start) & (token_starts <= end)] = 1
+    return loss_mask
+
+
+def _find_subsequence(input_ids: torch.Tensor, pattern: List[int]) -> torch.Tensor:
+    if len(input_ids) < len(pattern):
+        return torch.zeros(0, dtype=torch.long)
+    # the candidates are the occurrences of the first token, which is a special token
+    candidates = torch.nonzero(
+        input_ids[: len(input_ids) - len(pattern) + 1] == pattern[0]
+    ).flatten()
+    if len(candidates) == 0 or len(pattern) == 1:
+        return candidates
+    windows = input_ids[candidates[:, None] + torch.arange(len(pattern))]
+    return candidates[(windows == torch.tensor(pattern)).all(dim=1)]
+
+
+def get_token_loss_mask(
+    input_ids: torch.Tensor,
+    separator_token_ids: SeparatorTokenIds,
+    truncated: bool = False,
+) -> Optional[torch.Tensor]:
+    """
+    Mark the tokens of the assistant messages by scanning the token ids for the
+    separators of the chat template, which gives the same mask as matching the rendered
+    text: every token after an assistant separator is marked, up to and including the
+    first token of the next user separator, or up to the end of the conversation.
+
+    Args:
+        input_ids: The token ids of the conversation, of shape (num_tokens,).
+        separator_token_ids: The separators from `ChatTemplate.get_separator_token_ids`.
+        truncated: Whether the conversation was truncated, in which case a user
+            separator can be cut at the end of the token ids.
+
+    Returns:
+        A tensor indicating which tokens should contribute to the loss (1) or not (0),
+        or None if no assistant separator is found in the token ids.
+    """
+    assistant, assistant_suffix, user = separator_token_ids
+    assistant_positions = _find_subsequence(input_ids, assistant).tolist()
+    if len(assistant_positions) == 0:
+        return None
+    user_positions = _find_subsequence(input_ids, user)
+    if truncated:
+        # the beginning of a user separator cut by the truncation also ends the message
+        for position in range(max(len(input_ids) - len(user) + 1, 0), len(input_ids)):
+            if input_ids[position:].tolist() == user[: len(input_ids) - position]:
+                user_positions = torch.cat([user_positions, torch.tensor([position])])
+                break
+
+    num_tokens = len(input_ids)
+    suffix = torch.tensor(assistant_suffix, dtype=input_ids.dtype)
+    loss_mask = torch.zeros(num_tokens, dtype=torch.long)
+    # like the regex, the next assistant separator is searched after the current message
+    search_start = 0
+    for position in assistant_positions:
+        if position < search_start:
+            continue
+        start = position + len(assistant)
+        # the whitespace at the end of the header is not part of the message, unless it
+        # is merged with the first token of the message
+        if torch.equal(input_ids[start : start + len(suffix)], suffix):
+            start += len(suffix)
+        index = torch.searchsorted(user_positions, start).item()
+        if index < len(user_positions):
+            end = user_positions[index].item()
+            loss_mask[start : end + 1] = 1
+            search_start = end
+        else:
+            loss_mask[start:] = 1
+            search_start = num_tokens
+    return loss_mask
+
+
 class Parser(ABC):
 
     def __init__(self, tokenizer: PreTrainedTokenizer, chat_template: ChatTemplate):
@@ -18,8 +132,47 @@ class Parser(ABC):
         self.chat_template = chat_template
 
     @abstractmethod
+    def format(
+        self, conversation: "Conversation", preformatted: bool = False, **kwargs
+    ) -> str:
+        """
+        Render the conversation into the text to tokenize.
+
+        Args:
+            conversation: The conversation to render.
+            preformatted: Whether the conversation is already a formatted text string.
+
+        Returns:
+            The rendered conversation.
+        """
+
+    @abstractmethod
+    def get_loss_mask(
+        self,
+        text: str,
+        input_ids: torch.Tensor,
+        offsets: torch.Tensor,
+        max_length: int,
+    ) -> torch.Tensor:
+        """
+        Compute the loss mask of a tokenized conversation.
+
+        Args:
+            text: The rendered conversation.
+            input_ids: The token ids of the conversation.
+            offsets: The token offset mapping of shape (num_tokens, 2) from the tokenizer.
+            max_length: The maximum length the conversation was truncated to.
+
+        Returns:
+            A tensor indicating which tokens should contribute to the loss (1) or not (0).
+        """
+
     def parse(
-        self, conversation: "Conversation", max_length: int
+        self,
+        conversation: "Conversation",
+        max_length: int,
+        preformatted: bool = False,
+        **kwargs,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """
         Parse the conversation into a list of tensors.
@@ -30,6 +183,65 @@ class Parser(ABC):
         Returns:
             A list of tensors: [input_ids, loss_mask]
         """
+        return self.parse_batch([conversation], max_length, preformatted, [kwargs])[0]
+
+    def parse_batch(
+        self,
+        conversations: List["Conversation"],
+        max_length: int,
+        preformatted: bool = False,
+        kwargs_list: Optional[List[Dict]] = None,
+    ) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+        """
+        Parse a batch of conversations. All the conversations are rendered first and then
+        tokenized with a single call to the tokenizer, which tokenizes them in parallel.
+
+        Args:
+            conversations: The conversations to parse.
+            max_length: The maximum length of the tokenized conversations.
+            preformatted: Whether the conversations are already formatted text strings.
+            kwargs_list: The keyword arguments of the chat template of each conversation.
+
+        Returns:
+            The [input_ids, loss_mask] tensors of each conversation.
+        """
+        if len(conversations) == 0:
+            return []
+        kwargs_list = kwargs_list or [{} for _ in conversations]
+        texts = [
+            self.format(conversation, preformatted=preformatted, **kwargs)
+            for conversation, kwargs in zip(conversations, kwargs_list)
+        ]
+
+        if not self.tokenizer.pad_token_id:
+            self.tokenizer.pad_token_id = self.tokenizer.unk_token_id
+
+        encoding = self.tokenizer(
+            texts,
+            return_offsets_mapping=True,
+            max_length=max_length,
+            truncation=True,
+            add_special_tokens=False,
+        )
+        # build the tensors of the whole batch at once and slice the samples out of them
+        lengths = [len(input_ids) for input_ids in encoding["input_ids"]]
+        input_ids = torch.tensor(
+            list(chain.from_iterable(encoding["input_ids"])), dtype=torch.long
+        ).split(lengths)
+        offsets = (
+            torch.tensor(
+                list(chain.from_iterable(encoding["offset_mapping"])), dtype=torch.long
+            )
+            .view(-1, 2)
+            .split(lengths)
+        )
+        return [
+            (
+                sample_input_ids,
+                self.get_loss_mask(text, sample_input_ids, sample_offsets, max_length),
+            )
+            for text, sample_input_ids, sample_offsets in zip(texts, input_ids, offsets)
+        ]
 
 
 _harmony_encoding = None
@@ -46,79 +258,73 @@ class GeneralParser(Parser):
         self.assistant_message_separator = (
             f"{chat_template.end_of_turn_token or ''}{chat_template.assistant_header}"
         )
+        self.separator_token_ids = chat_template.get_separator_token_ids(tokenizer)
 
-    def parse(
-        self,
-        conversation: "Conversation",
-        max_length: int,
-        preformatted: bool = False,
-        **kwargs,
-    ) -> Dict[str, List[torch.Tensor]]:
-        if not preformatted:
-            messages = []
+    def format(
+        self, conversation: "Conversation", preformatted: bool = False, **kwargs
+    ) -> str:
+        if preformatted:
+            return conversation
+
+        messages = []
 
-            if conversation[0]["role"] == "system":
+        if conversation[0]["role"] == "system":
+            warnings.warn(
+                f"The first message is from system, we will use the system prompt from the data and ignore the system prompt from the template"
+            )
+            messages.append({"role": "system", "content": conversation[0]["content"]})
+            conversation = conversation[1:]
+        else:
+            if self.system_prompt:
+                messages.append({"role": "system", "content": self.system_prompt})
+
+        convroles = ["user", "assistant"]
+        for j, sentence in enumerate(conversation):
+            role = sentence["role"]
+            if role != convroles[j % 2]:
                 warnings.warn(
-                    f"The first message is from system, we will use the system prompt from the data and ignore the system prompt from the template"
+                    f"Conversation truncated due to unexpected role '{role}'. Expected '{convroles[j % 2]}'."
                 )
-                messages.append(
-                    {"role": "system", "content": conversation[0]["content"]}
-                )
-                conversation = conversation[1:]
-            else:
-                if self.system_prompt:
-                    messages.append({"role": "system", "content": self.system_prompt})
-
-            convroles = ["user", "assistant"]
-            for j, sentence in enumerate(conversation):
-                role = sentence["role"]
-                if role != convroles[j % 2]:
-                    warnings.warn(
-                        f"Conversation truncated due to unexpected role '{role}'. Expected '{convroles[j % 2]}'."
-                    )
-                    break
-                messages.append(sentence)
-
-            conversation = self.tokenizer.apply_chat_template(
-                messages, tokenize=False, add_generation_prompt=False, **kwargs
-            )
-
-        if not self.tokenizer.pad_token_id:
-            self.tokenizer.pad_token_id = self.tokenizer.unk_token_id
+                break
+            messages.append(sentence)
 
-        encoding = self.tokenizer(
-            conversation,
-            return_offsets_mapping=True,
-            max_length=max_length,
-            truncation=True,
-            return_tensors="pt",
-            add_special_tokens=False,
+        return self.tokenizer.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=False, **kwargs
         )
-        input_ids = encoding.input_ids[0]
-        offsets = encoding.offset_mapping[0]
-        loss_mask = torch.zeros(len(input_ids), dtype=torch.long)
 
-        # Find spans of assistant responses using regex
+    def get_loss_mask(
+        self,
+        text: str,
+        input_ids: torch.Tensor,
+        offsets: torch.Tensor,
+        max_length: int,
+    ) -> torch.Tensor:
+        # Find the assistant responses in the token ids
+        if self.separator_token_ids is not None:
+            loss_mask = get_token_loss_mask(
+                input_ids,
+                self.separator_token_ids,
+                truncated=len(input_ids) >= max_length,
+            )
+            if loss_mask is not None:
+                return loss_mask
+
+        # Fall back to the rendered text if the separators cannot be found in the token
+        # ids, e.g. because their tokenization depends on the surrounding text
         assistant_pattern = (
             re.escape(self.assistant_message_separator)
             + r"(.*?)(?="
             + re.escape(self.user_message_separator)
             + "|$)"
         )
-        for match in re.finditer(assistant_pattern, conversation, re.DOTALL):
-            # Assistant response text span (excluding assistant_header itself)
-            assistant_start_char = match.start(1)
-            assistant_end_char = match.end(1)
-
-            # Mark tokens overlapping with assistant response
-            for idx, (token_start, token_end) in enumerate(offsets):
-                # Token is part of the assistant response span
-                if token_end <= assistant_start_char:
-                    continue  # token before assistant text
-                if token_start > assistant_end_char:
-                    continue  # token after assistant text
-                loss_mask[idx] = 1
-        return input_ids, loss_mask
+        # Assistant response text spans (excluding assistant_header itself)
+        spans = [
+            (match.start(1), match.end(1))
+            for match in re.finditer(assistant_pattern, text, re.DOTALL)
+        ]
+
+        # Mark tokens overlapping with assistant response
+        return get_span_loss_mask(offsets, spans)
 
 
 class HarmonyParser(Parser):
@@ -145,63 +351,54 @@ class HarmonyParser(Parser):
             )
         return prompt_text
 
-    def parse(
-        self, conversation: "Conversation", max_length: int, preformatted: bool = False
-    ) -> List[torch.Tensor]:
-        if not preformatted:
-            user_message = None
-            analysis_message = None
-            commentary_message = None
-            final_message = None
-            reasoning_level = "Low"
-
-            for j, message in enumerate(conversation):
-                if message["role"] == "user":
-                    user_message = message["content"]
-                if message["role"] == "assistant_analysis":
-                    analysis_message = message["content"]
-                elif message["role"] == "assistant_commentary":
-                    commentary_message = message["content"]
-                elif message["role"] == "assistant_final":
-                    final_message = message["content"]
-                elif message["role"] == "assistant_reasoning_effort":
-                    reasoning_level = message["content"]
-
-            conversation = self.build_single_turn_prompt(
-                user_message,
-                analysis_message,
-                commentary_message,
-                final_message,
-                reasoning_level,
-            )
-
-        if not self.tokenizer.pad_token_id:
-            self.tokenizer.pad_token_id = self.tokenizer.unk_token_id
-
-        encoding = self.tokenizer(
-            conversation,
-            return_offsets_mapping=True,
-            max_length=max_length,
-            truncation=True,
-            return_tensors="pt",
-            add_special_tokens=False,
+    def format(
+        self, conversation: "Conversation", preformatted: bool = False, **kwargs
+    ) -> str:
+        if preformatted:
+            return conversation
+
+        user_message = None
+        analysis_message = None
+        commentary_message = None
+        final_message = None
+        reasoning_level = "Low"
+
+        for j, message in enumerate(conversation):
+            if message["role"] == "user":
+                user_message = message["content"]
+            if message["role"] == "assistant_analysis":
+                analysis_message = message["content"]
+            elif message["role"] == "assistant_commentary":
+                commentary_message = message["content"]
+            elif message["role"] == "assistant_final":
+                final_message = message["content"]
+            elif message["role"] == "assistant_reasoning_effort":
+                reasoning_level = message["content"]
+
+        return self.build_single_turn_prompt(
+            user_message,
+            analysis_message,
+            commentary_message,
+            final_message,
+            reasoning_level,
         )
-        input_ids = encoding.input_ids[0]
-        offsets = encoding.offset_mapping[0]
+
+    def get_loss_mask(
+        self,
+        text: str,
+        input_ids: torch.Tensor,
+        offsets: torch.Tensor,
+        max_length: int,
+    ) -> torch.Tensor:
         loss_mask = torch.zeros(len(input_ids), dtype=torch.long)
 
         # Find spans of assistant responses using regex
         response = "<|end|>".join(
-            conversation.split("<|end|><|start|>user<|message|>")[1].split("<|end|>")[
-                1:
-            ]
+            text.split("<|end|><|start|>user<|message|>")[1].split("<|end|>")[1:]
         )
         num_response_chars = len(response)
-        num_system_chars = len(conversation) - num_response_chars
+        num_system_chars = len(text) - num_response_chars
 
         # Mark tokens overlapping with assistant response
-        for idx, (char_start, char_end) in enumerate(offsets):
-            if char_end <= num_system_chars:
-                continue
-            loss_mask[idx] = 1
-        return input_ids, loss_mask
+        loss_mask[offsets[:, 1] > num_system_chars] = 1
+        return loss_mask
@@ -0,0 +1,315 @@
+import dataclasses
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Iterator, Optional, Tuple, Union
+
+import torch
+from torch.utils.data import DataLoader
+
+
+class BatchPrefetcher:
+    """
+    Wrap a DataLoader to copy the next batches to the device while the current batch is
+    being trained on.
+
+    On CUDA, the batches are pinned (if the DataLoader did not already do it) and copied
+    with non-blocking transfers on a side stream, the main stream only waits for the copy
+    of a batch when the batch is consumed. Up to `num_prefetch` batches are in flight. On
+    CPU the batches are only queued, which keeps the same iteration order and makes the
+    class testable without GPU.
+
+    The time spent by the trainer waiting for the next batch on the host is recorded in
+    `last_wait_time` and accumulated over the current epoch in `wait_time`.
+    """
+
+    def __init__(
+        self,
+        dataloader: DataLoader,
+        device: Optional[Union[str, torch.device]] = None,
+        num_prefetch: int = 2,
+    ):
+        """
+        Args:
+            dataloader: The DataLoader to prefetch from.
+            device: The device to copy the batches to, defaults to the current CUDA device if available.
+            num_prefetch: The number of batches to copy ahead of the current one.
+        """
+        assert num_prefetch >= 1, "num_prefetch must be at least 1"
+        if device is None:
+            device = (
+                torch.device("cuda", torch.cuda.current_device())
+                if torch.cuda.is_available()
+                else torch.device("cpu")
+            )
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.num_prefetch = num_prefetch
+        self.stream = (
+            torch.cuda.Stream(device=self.device)
+            if self.device.type == "cuda"
+            else None
+        )
+        self.wait_time = 0.0
+        self.last_wait_time = 0.0
+
+    def __len__(self) -> int:
+        return len(self.dataloader)
+
+    @property
+    def sampler(self):
+        return self.dataloader.sampler
+
+    @property
+    def batch_sampler(self):
+        return self.dataloader.batch_sampler
+
+    def _to_device(self, data: Any) -> Any:
+        if isinstance(data, torch.Tensor):
+            if self.stream is None:
+                return data
+            if not data.is_pinned():
+                data = data.pin_memory()
+            return data.to(self.device, non_blocking=True)
+        if isinstance(data, dict):
+            return {k: self._to_device(v) for k, v in data.items()}
+        if isinstance(data, (list, tuple)):
+            return type(data)(self._to_device(v) for v in data)
+        return data
+
+    def _record_stream(self, data: Any) -> None:
+        # the tensors are allocated on the side stream but used on the current stream
+        if isinstance(data, torch.Tensor):
+            data.record_stream(torch.cuda.current_stream(self.device))
+        elif isinstance(data, dict):
+            for v in data.values():
+                self._record_stream(v)
+        elif isinstance(data, (list, tuple)):
+            for v in data:
+                self._record_stream(v)
+
+    def _preload(
+        self,
+        iterator: Iterator,
+        queue: Deque[Tuple[Any, Optional[torch.cuda.Event]]],
+    ) -> bool:
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return False
+
+        if self.stream is None:
+            queue.append((batch, None))
+        else:
+            with torch.cuda.stream(self.stream):
+                batch = self._to_device(batch)
+                event = torch.cuda.Event()
+                event.record(self.stream)
+            queue.append((batch, event))
+        return True
+
+    def __iter__(self):
+        self.wait_time = 0.0
+        iterator = iter(self.dataloader)
+        queue = deque()
+
+        start = time.perf_counter()
+        exhausted = False
+        while not exhausted and len(queue) < self.num_prefetch:
+            exhausted = not self._preload(iterator, queue)
+
+        while queue:
+            batch, event = queue.popleft()
+            if event is not None:
+                torch.cuda.current_stream(self.device).wait_event(event)
+                self._record_stream(batch)
+            # start the copy of the next batch before handing out the current one
+            if not exhausted:
+                exhausted = not self._preload(iterator, queue)
+
+            self.last_wait_time = time.perf_counter() - start
+            self.wait_time += self.last_wait_time
+            yield batch
+            start = time.perf_counter()
+
+
+class TargetPrefetcher:
+    """
+    Wrap an online DataLoader to run the target model on the next batches while the
+    draft model is being trained on the current one. It yields (batch, output) pairs,
+    where output is the return value of `generate_fn(batch)`.
+
+    On CUDA, the target forward of a batch is issued on a side stream before the draft
+    model is trained on the previous batch, so the GPU runs them concurrently, and the
+    main stream only waits for the output of a batch when the batch is consumed. With
+    `use_thread`, the forward is run from a background thread instead, for the backends
+    which synchronize with the host while issuing it, e.g. SGLang. Up to `num_prefetch`
+    outputs are held ahead of the current batch, which bounds the memory of the hidden
+    states and logits in flight. On CPU the outputs are computed in order, in the
+    background thread if any.
+
+    The GPU time of the target forwards of the current epoch is accumulated in
+    `target_time`, and the part the draft training waited for in `exposed_time`.
+    `overlap` is the fraction of the target time which was hidden behind the training.
+    The timings are read from CUDA events once they have completed, without
+    synchronizing the host.
+    """
+
+    def __init__(
+        self,
+        dataloader: DataLoader,
+        generate_fn: Callable[[Any], Any],
+        num_prefetch: int = 1,
+        use_thread: bool = False,
+        device: Optional[Union[str, torch.device]] = None,
+    ):
+        """
+        Args:
+            dataloader: The DataLoader to prefetch from.
+            generate_fn: The function running the target model on a batch.
+            num_prefetch: The number of outputs to compute ahead of the current one.
+            use_thread: Whether to run generate_fn in a background thread.
+            device: The device to run the target model on, defaults to the current CUDA device if available.
+        """
+        assert num_prefetch >= 1, "num_prefetch must be at least 1"
+        if device is None:
+            device = (
+                torch.device("cuda", torch.cuda.current_device())
+                if torch.cuda.is_available()
+                else torch.device("cpu")
+            )
+        self.dataloader = dataloader
+        self.generate_fn = generate_fn
+        self.num_prefetch = num_prefetch
+        self.device = torch.device(device)
+        self.stream = (
+            torch.cuda.Stream(device=self.device)
+            if self.device.type == "cuda"
+            else None
+        )
+        self.executor = ThreadPoolExecutor(max_workers=1) if use_thread else None
+        self.target_time = 0.0
+        self.exposed_time = 0.0
+        # the timings whose CUDA events may not have completed yet
+        self._timings: Deque[Tuple[Any, ...]] = deque()
+
+    def __len__(self) -> int:
+        return len(self.dataloader)
+
+    @property
+    def dataset(self):
+        return self.dataloader.dataset
+
+    @property
+    def sampler(self):
+        return self.dataloader.sampler
+
+    @property
+    def batch_sampler(self):
+        return self.dataloader.batch_sampler
+
+    @property
+    def overlap(self) -> float:
+        if self.target_time == 0:
+            return 0.0
+        return 1 - self.exposed_time / self.target_time
+
+    def _generate(self, batch: Any) -> Tuple[Any, Any]:
+        if self.stream is None:
+            start = time.perf_counter()
+            output = self.generate_fn(batch)
+            return output, time.perf_counter() - start
+
+        if self.executor is not None:
+            # the current device is set per thread
+            torch.cuda.set_device(self.device)
+        start = torch.cuda.Event(enable_timing=True)
+        end = torch.cuda.Event(enable_timing=True)
+        with torch.cuda.stream(self.stream):
+            start.record(self.stream)
+            output = self.generate_fn(batch)
+            end.record(self.stream)
+        if self.executor is not None:
+            # the trainer waits for the thread, the output must be ready then
+            end.synchronize()
+        return output, (start, end)
+
+    def _record_stream(self, data: Any) -> None:
+        # the tensors are allocated on the side stream but used on the current stream
+        if isinstance(data, torch.Tensor):
+            data.record_stream(torch.cuda.current_stream(self.device))
+        elif isinstance(data, dict):
+            for v in data.values():
+                self._record_stream(v)
+        elif isinstance(data, (list, tuple)):
+            for v in data:
+                self._record_stream(v)
+        elif dataclasses.is_dataclass(data):
+            for field in dataclasses.fields(data):
+                self._record_stream(getattr(data, field.name))
+
+    def _update_timings(self, wait: bool = False) -> None:
+        while self._timings:
+            start, end, requested, host_wait_time = self._timings[0]
+            if not wait and not (end.query() and requested.query()):
+                break
+            self._timings.popleft()
+            end.synchronize()
+            requested.synchronize()
+            target_time = start.elapsed_time(end) / 1000
+            if self.executor is not None:
+                # the host waited for the thread, which waited for the GPU
+                exposed_time = host_wait_time
+            else:
+                # the time the main stream waited for the target forward
+                exposed_time = max(requested.elapsed_time(end) / 1000, 0.0)
+            self.target_time += target_time
+            self.exposed_time += min(exposed_time, target_time)
+
+    def __iter__(self):
+        self.target_time = 0.0
+        self.exposed_time = 0.0
+        iterator = iter(self.dataloader)
+        queue = deque()
+
+        def preload() -> bool:
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return False
+            if self.executor is not None:
+                queue.append((batch, self.executor.submit(self._generate, batch)))
+            else:
+                queue.append((batch, self._generate(batch)))
+            return True
+
+        exhausted = False
+        while not exhausted and len(queue) < self.num_prefetch:
+            exhausted = not preload()
+
+        while queue:
+            batch, pending = queue.popleft()
+            start = time.perf_counter()
+            output, timing = pending.result() if self.executor is not None else pending
+            host_wait_time = time.perf_counter() - start
+            if self.stream is None:
+                self.target_time += timing
+                self.exposed_time += (
+                    min(host_wait_time, timing) if self.executor is not None else timing
+                )
+            else:
+                current_stream = torch.cuda.current_stream(self.device)
+                requested = torch.cuda.Event(enable_timing=True)
+                requested.record(current_stream)
+                current_stream.wait_event(timing[1])
+                self._record_stream(output)
+                self._timings.append((*timing, requested, host_wait_time))
+                self._update_timings()
+            # issue the target forward of the next batch before the draft model is
+            # trained on the current one
+            if not exhausted:
+                exhausted = not preload()
+            yield batch, output
+
+        if self.stream is not None:
+            self._update_timings(wait=True)
@@ -22,13 +22,14 @@
 
 import os
 import re
-import warnings
 from collections import Counter
 from typing import Dict, List, Optional, Tuple, Union
 
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 import torch
 from datasets import Dataset as HFDataset
-from tqdm import tqdm
 from transformers import ImageProcessingMixin, PreTrainedTokenizer
 
 try:
@@ -41,8 +42,20 @@ except ImportError:
 
 from specforge.utils import padding
 
-from .parse import GeneralParser, HarmonyParser
+from .cache import (
+    MISSING_ROW,
+    ROW_HASH_COLUMN,
+    ProcessedDatasetCache,
+    get_dataset_key,
+    get_processing_fingerprint,
+    hash_rows,
+)
+from .compact import CompactEagle3Dataset, is_compact_dataset, write_compact_dataset
+from .manifest import load_manifest
+from .parse import GeneralParser, HarmonyParser, get_span_loss_mask, get_token_loss_mask
+from .shard import ShardReader, list_shard_dirs
 from .template import TEMPLATE_REGISTRY, ChatTemplate
+from .utils import flatten_batch_dim
 
 # define a type called conversation
 Conversation = List[Dict[str, str]]
@@ -69,8 +82,6 @@ def _apply_loss_mask_from_chat_template(
     Returns:
         A tensor indicating which tokens should contribute to the loss (1) or not (0).
     """
-    loss_mask = torch.zeros(len(offsets), dtype=torch.long)
-
     user_message_separator = (
         f"{chat_template.end_of_turn_token}{chat_template.user_header}"
     )
@@ -86,24 +97,16 @@ def _apply_loss_mask_from_chat_template(
         + "|$)"
     )
 
-    matches_found = 0
-
-    for match in re.finditer(assistant_pattern, text, re.DOTALL):
-        matches_found += 1
-        # Assistant response text span (excluding assistant_header itself)
-        assistant_start_char = match.start(1)
-        assistant_end_char = match.end(1)
+    # Assistant response text spans (excluding assistant_header itself)
+    spans = [
+        (match.start(1), match.end(1))
+        for match in re.finditer(assistant_pattern, text, re.DOTALL)
+    ]
 
-        # Mark tokens overlapping with assistant response
-        for idx, (token_start, token_end) in enumerate(offsets):
-            # Token is part of the assistant response span
-            if token_end <= assistant_start_char:
-                continue  # token before assistant text
-            if token_start > assistant_end_char:
-                continue  # token after assistant text
-            loss_mask[idx] = 1
+    # Mark tokens overlapping with assistant response
+    loss_mask = get_span_loss_mask(offsets, spans)
 
-    if matches_found == 0:
+    if len(spans) == 0:
         print("WARNING: No assistant response spans found in the conversation text.")
 
     return loss_mask
@@ -150,13 +153,21 @@ def preprocess_conversations(
     for key, value_list in kwargs.items():
         for i, value in enumerate(value_list):
             kwargs_list[i][key] = value
+    sources, source_kwargs_list = [], []
     for source, kwargs_item in zip(conversations, kwargs_list):
         if not source:
             # if the source is None, skip it
             continue
-        input_ids, loss_mask = parser.parse(
-            source, max_length, preformatted=is_preformatted, **kwargs_item
-        )
+        sources.append(source)
+        source_kwargs_list.append(kwargs_item)
+    # the whole batch is tokenized with a single call
+    parsed = parser.parse_batch(
+        sources,
+        max_length,
+        preformatted=is_preformatted,
+        kwargs_list=source_kwargs_list,
+    )
+    for input_ids, loss_mask in parsed:
         results["input_ids"].append(input_ids[None, :])
         results["loss_mask"].append(loss_mask[None, :])
         results["attention_mask"].append(torch.ones_like(loss_mask)[None, :])
@@ -189,6 +200,7 @@ def preprocess_vlm_conversations(
             - image_grid_thw: List of image grid tensors.
     """
     system_prompt = chat_template.system_prompt
+    separator_token_ids = chat_template.get_separator_token_ids(processor.tokenizer)
 
     # prepare result
     results = {
@@ -261,15 +273,22 @@ def preprocess_vlm_conversations(
         pixel_values = encoding.pixel_values
         image_grid_thw = encoding.image_grid_thw[0]
 
-        # get conversation with image info for loss mask generation
-        decoded_conversation = processor.tokenizer.decode(
-            encoding.input_ids[0], skip_special_tokens=False
-        )
-
-        # Apply loss mask
-        loss_mask = _apply_loss_mask_from_chat_template(
-            decoded_conversation, offsets, chat_template
-        )
+        # Apply loss mask from the token ids
+        loss_mask = None
+        if separator_token_ids is not None:
+            loss_mask = get_token_loss_mask(
+                input_ids,
+                separator_token_ids,
+                truncated=len(input_ids) >= max_length,
+            )
+        if loss_mask is None:
+            # get conversation with image info for loss mask generation
+            decoded_conversation = processor.tokenizer.decode(
+                encoding.input_ids[0], skip_special_tokens=False
+            )
+            loss_mask = _apply_loss_mask_from_chat_template(
+                decoded_conversation, offsets, chat_template
+            )
 
         results["input_ids"].append(input_ids[None, :])
         results["loss_mask"].append(loss_mask[None, :])
@@ -287,11 +306,16 @@ def build_eagle3_dataset(
     shuffle_seed: Optional[int] = 42,
     num_proc: Optional[int] = 8,
     cache_dir: Optional[str] = None,
-    cache_key: Optional[str] = None,
     is_vlm: Optional[bool] = False,
     processor: Optional[ImageProcessingMixin] = None,
     is_preformatted: Optional[bool] = False,
-) -> HFDataset:
+    compact: Optional[bool] = False,
+    return_cache_key: Optional[bool] = False,
+) -> Union[
+    HFDataset,
+    CompactEagle3Dataset,
+    Tuple[Union[HFDataset, CompactEagle3Dataset], Optional[str]],
+]:
     """
     build eagle3 dataset
 
@@ -305,8 +329,10 @@ def build_eagle3_dataset(
         max_length: The maximum length of the tokenized input.
         shuffle_seed: The seed for shuffling the dataset.
         num_proc: The number of processes to use for multiprocessing.
-        cache_dir: The directory to use for caching the processed dataset.
-        cache_key: The key to use for caching the processed dataset.
+        cache_dir: The directory of the content-addressed cache of the processed
+                        rows, see `specforge.data.cache`. The rows which are not in
+                        the cache are processed and added to it. If None, the dataset
+                        is not cached.
         is_vlm: Whether the dataset is for VLM models.
         processor: The image processor to use for processing images.
         is_preformatted: Whether the dataset contains preformatted text of the conversation
@@ -316,13 +342,26 @@ def build_eagle3_dataset(
                         the assistant spans for loss mask generation.
                         If True, expects "text" column with ready-to-train text.
                         If False, expects "conversations" column with ShareGPT format.
+        compact: Whether to also store the processed dataset in the compact format of
+                        `specforge.data.compact` and return it. Requires cache_dir, not
+                        supported for VLM datasets.
+        return_cache_key: Whether to also return the key of the processed dataset,
+                        which changes with the content of the rows, their order and the
+                        processing. It is None if cache_dir is None.
 
     Returns:
-        The processed HF dataset.
+        The processed HF dataset, or a CompactEagle3Dataset if compact is True, and the
+        cache key if return_cache_key is True.
     """
     if is_vlm:
         assert processor is not None, "processor must be provided when is_vlm is True"
 
+    if compact:
+        assert not is_vlm, "The compact format is not supported for VLM datasets"
+        assert (
+            cache_dir is not None
+        ), "cache_dir must be provided to use the compact format"
+
     # Validate chat_template requirement
     if chat_template is None:
         raise ValueError("chat_template must be provided for all dataset types")
@@ -336,7 +375,16 @@ def build_eagle3_dataset(
     dataset = dataset.shuffle(seed=shuffle_seed)
     original_cols = dataset.column_names
 
-    def preprocess_function(examples):
+    def preprocess_function(examples, row_hashes=None):
+        if row_hashes is not None:
+            # the rows without conversation are skipped by the processing
+            sources = examples.get(
+                "text" if is_preformatted and not is_vlm else "conversations", []
+            )
+            row_hashes = [
+                int(row_hash) for row_hash, source in zip(row_hashes, sources) if source
+            ]
+
         # Handle different dataset formats
         if is_vlm:
             processed = preprocess_vlm_conversations(
@@ -376,23 +424,10 @@ def build_eagle3_dataset(
                 **examples,
             )
 
+        if row_hashes is not None:
+            processed[ROW_HASH_COLUMN] = row_hashes
         return processed
 
-    # Process dataset only once
-    if cache_dir and cache_key:
-        load_from_cache_file = True
-        os.makedirs(cache_dir, exist_ok=True)
-        cache_file_name = os.path.join(cache_dir, f"{cache_key}.pkl")
-        print(f"dataset is cached at {cache_file_name}")
-    elif cache_dir is None and cache_key is None:
-        load_from_cache_file = False
-        cache_file_name = None
-        print(f"dataset is not cached")
-    else:
-        warnings.warn(
-            f"cache_dir and cache_key must be provided together to make caching work"
-        )
-
     # adjust batch size based on dataset type
     if is_vlm:
         batch_size = (
@@ -400,19 +435,80 @@ def build_eagle3_dataset(
         )
     else:
         batch_size = 1000  # default for conversations
-    dataset = dataset.map(
-        preprocess_function,
-        batched=True,
-        num_proc=num_proc,
-        batch_size=batch_size,
-        remove_columns=original_cols,
-        # keep_in_memory=True,
-        load_from_cache_file=load_from_cache_file,
-        cache_file_name=cache_file_name,
+
+    if cache_dir is None:
+        print(f"dataset is not cached")
+        dataset = dataset.map(
+            preprocess_function,
+            batched=True,
+            num_proc=num_proc,
+            batch_size=batch_size,
+            remove_columns=original_cols,
+            load_from_cache_file=False,
+        )
+        dataset.set_format(type="torch")
+        return (dataset, None) if return_cache_key else dataset
+
+    os.makedirs(cache_dir, exist_ok=True)
+    fingerprint = get_processing_fingerprint(
+        tokenizer,
+        template,
+        max_length,
+        is_preformatted,
+        processor=processor if is_vlm else None,
     )
+    row_hashes = hash_rows(dataset, num_proc=num_proc)
+    cache_key = get_dataset_key(fingerprint, row_hashes)
+    if compact:
+        compact_path = os.path.join(cache_dir, f"{cache_key}.compact")
+        if is_compact_dataset(compact_path):
+            print(f"Loading the compact dataset from: {compact_path}")
+            dataset = CompactEagle3Dataset(compact_path)
+            return (dataset, cache_key) if return_cache_key else dataset
+
+    cache = ProcessedDatasetCache(cache_dir, fingerprint)
+    print(f"dataset is cached at {cache.path}")
+    new_rows = np.flatnonzero(cache.lookup(row_hashes) == MISSING_ROW)
+    # the duplicated rows are processed once
+    _, first_rows = np.unique(row_hashes[new_rows], return_index=True)
+    new_rows = np.sort(new_rows[first_rows])
+    if len(new_rows) > 0:
+        print(f"Processing {len(new_rows)} new rows out of {len(dataset)}")
+        new_row_hashes = row_hashes[new_rows]
+
+        def preprocess_new_rows(examples, indices):
+            return preprocess_function(examples, new_row_hashes[indices])
+
+        cache.process(
+            dataset.select(new_rows),
+            preprocess_new_rows,
+            new_row_hashes,
+            with_indices=True,
+            num_proc=num_proc,
+            batch_size=batch_size,
+            remove_columns=original_cols,
+        )
+    processed = cache.select(row_hashes)
+    if processed is None:
+        # the cache has no processed row, e.g. all the rows are empty conversations, and
+        # processing the rows again gives the empty dataset with the processed schema
+        processed = dataset.map(
+            preprocess_function,
+            batched=True,
+            num_proc=num_proc,
+            batch_size=batch_size,
+            remove_columns=original_cols,
+            load_from_cache_file=False,
+        )
+    dataset = processed
 
-    dataset.set_format(type="torch")
-    return dataset
+    if compact:
+        write_compact_dataset(dataset, compact_path)
+        print(f"Saved the compact dataset to: {compact_path}")
+        dataset = CompactEagle3Dataset(compact_path)
+    else:
+        dataset.set_format(type="torch")
+    return (dataset, cache_key) if return_cache_key else dataset
 
 
 # ==============================
@@ -430,19 +526,27 @@ def list_local_files(path, suffixes=[".ckpt"]):
     return datapaths
 
 
+# the fields of the sparse teacher distributions stored by
+# `scripts/prepare_hidden_states.py --store-topk`
+OFFLINE_TOPK_KEYS = ["target_topk_probs", "target_topk_indices", "target_in_draft"]
+# the vocab mapping used to compute the sparse teacher distributions
+OFFLINE_VOCAB_MAPPING_FILE = "vocab_mapping.pt"
+
+
 class OfflineEagle3Dataset(torch.utils.data.Dataset):
-    def __init__(self, datapath, transform=None, max_len=2048):
+    def __init__(self, datapath, transform=None, max_len=2048, lengths=None):
         self.datapaths = datapath
         self.transform = transform
         self._epoch = 0
         self.max_len = max_len
+        # the number of tokens of each sample, if known without loading the samples
+        self.lengths = lengths
 
     @staticmethod
     def process_data(data, max_len, transform=None):
         new_data = {}
         # Squeeze due to our data generation script adding a batch dimension
         hidden_state = data["aux_hidden_state"].squeeze(0)[:max_len][None, :]
-        target = data["hidden_state"].squeeze(0)[:max_len][None, :]
 
         input_ids = data["input_ids"][:max_len][None, :]
         loss_mask = data["loss_mask"][:max_len][None, :]
@@ -450,9 +554,34 @@ class OfflineEagle3Dataset(torch.utils.data.Dataset):
 
         new_data["attention_mask"] = torch.ones_like(loss_mask, dtype=torch.long)
         new_data["loss_mask"] = loss_mask
-        new_data["target"] = padding(target, left=False)
         new_data["hidden_state"] = hidden_state
         new_data["input_ids"] = padding(input_ids, left=False)
+
+        if data.get("target_topk_probs") is not None:
+            # The sparse teacher distributions are stored instead of the last hidden
+            # states, they have shape (seq_len, *) and are shifted like the target.
+            for key in OFFLINE_TOPK_KEYS:
+                new_data[key] = padding(data[key][:max_len][None, :], left=False)
+        else:
+            target = data["hidden_state"].squeeze(0)[:max_len][None, :]
+            new_data["target"] = padding(target, left=False)
+
+        # The hidden states are quantized, the scales are kept along with them and the
+        # dequantization happens after the batch is copied to the GPU.
+        # Per-token scales have shape (seq_len, num_groups) and are sliced and shifted
+        # like the hidden states, per-channel scales have shape (1, hidden_size). Both have
+        # a single row for a one-token sample, so the granularity recorded at generation
+        # time is passed along to the collators.
+        if data.get("aux_hidden_state_scale") is not None:
+            hidden_state_scale = data["aux_hidden_state_scale"].squeeze(0)
+            new_data["hidden_state_scale"] = hidden_state_scale[:max_len][None, :]
+        if data.get("hidden_state_scale") is not None:
+            target_scale = data["hidden_state_scale"].squeeze(0)[:max_len][None, :]
+            if data["quantize_granularity"] == "per_token":
+                target_scale = padding(target_scale, left=False)
+            new_data["target_scale"] = target_scale
+        if data.get("quantize_granularity") is not None:
+            new_data["quantize_granularity"] = data["quantize_granularity"]
         if transform:
             new_data = transform(new_data)
         return new_data
@@ -475,10 +604,109 @@ class OfflineEagle3Dataset(torch.utils.data.Dataset):
         self._epoch = epoch
 
 
+class PackedOfflineEagle3Dataset(OfflineEagle3Dataset):
+    """
+    Offline Eagle3 dataset backed by the packed shards written by
+    `scripts/prepare_hidden_states.py --output-format packed`. Samples are read
+    as zero-copy views on the memory-mapped shard files, or decompressed in the
+    DataLoader workers if the shards are compressed.
+    """
+
+    def __init__(self, shard_dirs, transform=None, max_len=2048, datapath=None):
+        """
+        Args:
+            shard_dirs: The shard directories to read from.
+            transform: The transform applied to each processed sample.
+            max_len: The maximum sequence length.
+            datapath: The (shard_dir, local_index) of the samples, defaults to all the samples of the shards.
+        """
+        self.readers = {shard_dir: ShardReader(shard_dir) for shard_dir in shard_dirs}
+        if datapath is None:
+            datapath = [
+                (shard_dir, local_index)
+                for shard_dir, reader in self.readers.items()
+                for local_index in range(len(reader))
+            ]
+        lengths = [
+            self.readers[shard_dir].offsets[local_index + 1]
+            - self.readers[shard_dir].offsets[local_index]
+            for shard_dir, local_index in datapath
+        ]
+        super().__init__(
+            datapath, transform=transform, max_len=max_len, lengths=lengths
+        )
+
+    def _open_file(self, index):
+        shard_dir, local_index = self.datapaths[index]
+        data = self.readers[shard_dir][local_index]
+        # keep the same layout as the .ckpt files which have a batch dimension
+        for key in [
+            "aux_hidden_state",
+            "hidden_state",
+            "aux_hidden_state_scale",
+            "hidden_state_scale",
+        ]:
+            if key in data:
+                data[key] = data[key].unsqueeze(0)
+        # the quantization granularity is shared by the samples of a shard
+        if "quantize_granularity" in self.readers[shard_dir].metadata:
+            data["quantize_granularity"] = self.readers[shard_dir].metadata[
+                "quantize_granularity"
+            ]
+        return data
+
+
+def get_offline_vocab_mapping_path(hidden_states_path: str) -> Optional[str]:
+    """
+    Get the vocab mapping stored along with the sparse teacher distributions.
+
+    Args:
+        hidden_states_path: The root directory of the offline hidden states.
+
+    Returns:
+        The path to the vocab mapping file, or None if the full last hidden states are stored.
+    """
+    vocab_mapping_path = os.path.join(hidden_states_path, OFFLINE_VOCAB_MAPPING_FILE)
+    if os.path.exists(vocab_mapping_path):
+        return vocab_mapping_path
+    return None
+
+
 def build_offline_eagle3_dataset(
     hidden_states_path: str,
     max_len: int = 2048,
 ) -> torch.utils.data.Dataset:
+    """
+    Build the offline Eagle3 dataset from the hidden states generated by `scripts/prepare_hidden_states.py`.
+    The samples are listed from the manifest if there is one, otherwise the directory is scanned.
+
+    Args:
+        hidden_states_path: The root directory of the offline hidden states.
+        max_len: The maximum sequence length.
+
+    Returns:
+        The offline Eagle3 dataset.
+    """
+    entries = load_manifest(hidden_states_path)
+    if entries:
+        if entries[0].index is not None:
+            datapath = [
+                (os.path.join(hidden_states_path, entry.path), entry.index)
+                for entry in entries
+            ]
+            shard_dirs = sorted(set(shard_dir for shard_dir, _ in datapath))
+            return PackedOfflineEagle3Dataset(
+                shard_dirs, max_len=max_len, datapath=datapath
+            )
+        return OfflineEagle3Dataset(
+            [os.path.join(hidden_states_path, entry.path) for entry in entries],
+            max_len=max_len,
+            lengths=[entry.num_tokens for entry in entries],
+        )
+
+    shard_dirs = list_shard_dirs(hidden_states_path)
+    if len(shard_dirs) > 0:
+        return PackedOfflineEagle3Dataset(shard_dirs, max_len=max_len)
     return OfflineEagle3Dataset(
         list_local_files(hidden_states_path),
         max_len=max_len,
@@ -488,12 +716,59 @@ def build_offline_eagle3_dataset(
 # ==============================
 # Vocab Mapping
 # ==============================
+def _count_masked_tokens(batch: pa.Table) -> Dict[str, list]:
+    # count the tokens in the loss mask of a batch of samples, only the tokens which
+    # appear are returned to keep the output of each batch small
+    input_ids = pc.list_flatten(flatten_batch_dim(batch["input_ids"])).to_numpy()
+    loss_mask = pc.list_flatten(flatten_batch_dim(batch["loss_mask"])).to_numpy()
+    counts = np.bincount(input_ids[loss_mask == 1])
+    token_ids = np.flatnonzero(counts)
+    return {"token_ids": [token_ids], "counts": [counts[token_ids]]}
+
+
+def count_masked_tokens(
+    dataset: Union[HFDataset, CompactEagle3Dataset],
+    vocab_size: int,
+    num_proc: Optional[int] = None,
+) -> torch.Tensor:
+    """
+    Count the frequency of each token in the loss mask of the dataset.
+
+    Args:
+        dataset: The dataset returned by `build_eagle3_dataset`, or a
+            `StreamingEagle3Dataset`.
+        vocab_size: The minimum size of the returned tensor.
+        num_proc: The number of processes counting the dataset shards in parallel.
+
+    Returns:
+        A tensor of shape (vocab_size,) with the number of occurrences of each token.
+    """
+    if not isinstance(dataset, HFDataset):
+        # the compact and streaming datasets count their own tokens
+        return dataset.count_masked_tokens(vocab_size)
+    batch_counts = dataset.with_format("arrow").map(
+        _count_masked_tokens,
+        batched=True,
+        batch_size=1000,
+        num_proc=num_proc,
+        remove_columns=dataset.column_names,
+        desc="Counting tokens for vocab mapping",
+    )
+    batch_counts = batch_counts.with_format("arrow")[:]
+    token_ids = pc.list_flatten(batch_counts["token_ids"]).to_numpy()
+    counts = pc.list_flatten(batch_counts["counts"]).to_numpy()
+    # the counts are summed as float64, which is exact below 2**53
+    token_counts = np.bincount(token_ids, weights=counts, minlength=vocab_size)
+    return torch.from_numpy(token_counts.astype(np.int64))
+
+
 def generate_vocab_mapping_file(
-    dataset: HFDataset,
+    dataset: Union[HFDataset, CompactEagle3Dataset],
     target_vocab_size: int,
     draft_vocab_size: int,
     cache_dir: str = "./cache/vocab_mapping",
     cache_key: str = "vocab_mapping",
+    num_proc: Optional[int] = None,
 ) -> str:
     """
     Generate a vocab mapping file for the dataset.
@@ -504,6 +779,7 @@ def generate_vocab_mapping_file(
         draft_vocab_size: The draft vocabulary size.
         cache_dir: The directory to use for caching the vocab mapping file.
         cache_key: The key to use for caching the vocab mapping file.
+        num_proc: The number of processes used to count the tokens.
 
     Returns:
         The path to the vocab mapping file.
@@ -516,19 +792,12 @@ def generate_vocab_mapping_file(
         print(f"Loading vocab mapping from the cached file at: {vocab_mapping_path}")
         return vocab_mapping_path
 
-    # we first count the frequency of effectiev tokens in the dataset
-    token_dict = Counter()
-    for item in tqdm(dataset, desc="Counting tokens for vocab mapping"):
-        input_ids = item["input_ids"]
-        loss_mask = item["loss_mask"]
-        masked_ids = input_ids[loss_mask == 1]
-        unique_ids, counts = masked_ids.unique(return_counts=True)
-        batch_token_dict = dict(zip(unique_ids.tolist(), counts.tolist()))
-        token_dict.update(batch_token_dict)
+    # we first count the frequency of effective tokens in the dataset
+    token_counts = count_masked_tokens(dataset, target_vocab_size, num_proc=num_proc)
 
     # generate the d2t and t2d mapping
     d2t, t2d = process_token_dict_to_mappings(
-        token_dict,
+        token_counts,
         draft_vocab_size,
         target_vocab_size,
     )
@@ -543,15 +812,16 @@ def generate_vocab_mapping_file(
 
 
 def process_token_dict_to_mappings(
-    token_dict: Counter,
+    token_dict: Union[Counter, torch.Tensor],
     draft_vocab_size: int,
     target_vocab_size: int,
 ) -> Tuple[torch.Tensor, torch.Tensor]:
     """
-    Process token_dict to create d2t and t2d mappings, with optional caching.
+    Process token_dict to create d2t and t2d mappings.
 
     Args:
-        token_dict: A Counter object mapping token ids to their frequencies.
+        token_dict: The frequency of each token, either a tensor indexed by token id or
+            a Counter object mapping token ids to their frequencies.
         draft_vocab_size: The size of the draft vocabulary.
         target_vocab_size: The size of the target vocabulary.
 
@@ -560,18 +830,23 @@ def process_token_dict_to_mappings(
             - d2t: A tensor mapping draft token ids to target token ids.
             - t2d: A tensor mapping target token ids to draft token ids.
     """
-    if len(token_dict) < draft_vocab_size:
-        existing_tokens = set(token_dict.keys())
-        missing_tokens = set(range(draft_vocab_size)) - existing_tokens
-        for token in missing_tokens:
-            token_dict[token] = 0
-            if len(token_dict) >= draft_vocab_size:
-                break
-    print(f"Added missing tokens to reach draft vocab size: {draft_vocab_size}")
-    print(f"Total tokens after addition: {len(token_dict)}")
-    total_frequency = sum(token_dict.values())
-    top_N = token_dict.most_common(draft_vocab_size)
-    top_N_frequency_sum = sum(freq for key, freq in top_N)
+    if isinstance(token_dict, Counter):
+        token_counts = torch.zeros(
+            max([target_vocab_size - 1, *token_dict.keys()]) + 1, dtype=torch.long
+        )
+        token_counts[list(token_dict.keys())] = torch.tensor(
+            list(token_dict.values()), dtype=torch.long
+        )
+    else:
+        token_counts = token_dict.long()
+    print(f"Number of unique tokens: {int((token_counts > 0).sum())}")
+
+    # The stable sort breaks ties by token id, so if there are less unique tokens than
+    # draft_vocab_size, the vocab is completed with the smallest unseen token ids.
+    top_N = torch.sort(token_counts, descending=True, stable=True).indices
+    top_N = top_N[:draft_vocab_size]
+    total_frequency = token_counts.sum().item()
+    top_N_frequency_sum = token_counts[top_N].sum().item()
 
     if total_frequency == 0:
         print(
@@ -582,12 +857,10 @@ def process_token_dict_to_mappings(
         top_N_ratio = top_N_frequency_sum / total_frequency
 
     print(f"top {draft_vocab_size} token frequency ratio: {top_N_ratio:.2%}")
-    used_tokens = [key for key, freq in top_N]
-    used_tokens.sort()
+    used_tokens = top_N.sort().values
 
-    d2t = [used_tokens[i] - i for i in range(len(used_tokens))]
-    t2d = [i in used_tokens for i in range(target_vocab_size)]
-    d2t = torch.tensor(d2t)
-    t2d = torch.tensor(t2d)
+    d2t = used_tokens - torch.arange(len(used_tokens))
+    t2d = torch.zeros(target_vocab_size, dtype=torch.bool)
+    t2d[used_tokens] = True
 
     return d2t, t2d
@@ -0,0 +1,122 @@
+"""
+Quantized storage of the offline hidden states.
+
+The hidden states are quantized to FP8 (e4m3) or INT8 with float32 scales before being
+written to disk, and dequantized back to bfloat16 after they are copied to the GPU.
+Two granularities are supported:
+    - per_token: one scale per token and per group of channels, scale shape (seq_len, num_groups).
+      For the aux hidden states, each group corresponds to one captured layer.
+    - per_channel: one scale per channel for the whole sample, scale shape (1, hidden_size).
+
+In both cases the scale has shape (seq_len or 1, num_groups) where num_groups divides
+the hidden size, so that a single `dequantize_hidden_states` handles both.
+"""
+
+from typing import Dict, Tuple
+
+import torch
+
+QUANT_DTYPES = {
+    "fp8": torch.float8_e4m3fn,
+    "int8": torch.int8,
+}
+QUANT_GRANULARITIES = ["per_token", "per_channel"]
+
+
+def quantize_hidden_states(
+    hidden_states: torch.Tensor,
+    dtype: str = "fp8",
+    granularity: str = "per_token",
+    num_groups: int = 1,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Quantize the hidden states of one sample.
+
+    Args:
+        hidden_states: The hidden states of shape (seq_len, hidden_size).
+        dtype: The quantized data type, one of "fp8" and "int8".
+        granularity: The granularity of the scales, one of "per_token" and "per_channel".
+        num_groups: The number of channel groups sharing a scale for per_token quantization.
+
+    Returns:
+        A tuple of the quantized hidden states of shape (seq_len, hidden_size) and the
+        float32 scales of shape (seq_len, num_groups) or (1, hidden_size).
+    """
+    assert dtype in QUANT_DTYPES, f"Unsupported quantization dtype {dtype}"
+    assert (
+        granularity in QUANT_GRANULARITIES
+    ), f"Unsupported quantization granularity {granularity}"
+    quant_dtype = QUANT_DTYPES[dtype]
+    if dtype == "fp8":
+        qmax = torch.finfo(quant_dtype).max
+    else:
+        qmax = torch.iinfo(quant_dtype).max
+
+    x = hidden_states.float()
+    if granularity == "per_token":
+        x = x.unflatten(-1, (num_groups, -1))
+        scale = x.abs().amax(dim=-1, keepdim=True) / qmax
+    else:
+        scale = x.abs().amax(dim=-2, keepdim=True) / qmax
+    # avoid dividing by zero for all-zero tokens or channels
+    scale = scale.clamp_min(torch.finfo(torch.float32).tiny)
+
+    q = x / scale
+    if dtype == "int8":
+        q = q.round()
+    q = q.clamp(-qmax, qmax).to(quant_dtype)
+
+    if granularity == "per_token":
+        q = q.flatten(-2)
+        scale = scale.squeeze(-1)
+    return q, scale
+
+
+def dequantize_hidden_states(
+    q: torch.Tensor, scale: torch.Tensor, dtype: torch.dtype = torch.bfloat16
+) -> torch.Tensor:
+    """
+    Dequantize the hidden states, this works for both a single sample and a batch.
+
+    Args:
+        q: The quantized hidden states of shape (..., seq_len, hidden_size).
+        scale: The scales of shape (..., seq_len or 1, num_groups).
+        dtype: The output data type.
+
+    Returns:
+        The dequantized hidden states of shape (..., seq_len, hidden_size).
+    """
+    num_groups = scale.shape[-1]
+    x = q.float().unflatten(-1, (num_groups, -1)) * scale.float().unsqueeze(-1)
+    return x.flatten(-2).to(dtype)
+
+
+@torch.no_grad()
+def compute_quantization_error(
+    hidden_states: torch.Tensor, q: torch.Tensor, scale: torch.Tensor
+) -> Dict[str, float]:
+    """
+    Compare the dequantized hidden states with the original ones.
+
+    Args:
+        hidden_states: The original hidden states of shape (seq_len, hidden_size).
+        q: The quantized hidden states.
+        scale: The scales returned by `quantize_hidden_states`.
+
+    Returns:
+        A dictionary with the relative error (||x - x'|| / ||x||), the max absolute error,
+        the mean per-token cosine similarity and the compression ratio against the original dtype.
+    """
+    x = hidden_states.float()
+    x_hat = dequantize_hidden_states(q, scale, dtype=torch.float32)
+    cos_sim = torch.nn.functional.cosine_similarity(x, x_hat, dim=-1)
+    original_bytes = hidden_states.numel() * hidden_states.element_size()
+    quantized_bytes = (
+        q.numel() * q.element_size() + scale.numel() * scale.element_size()
+    )
+    return {
+        "relative_error": ((x - x_hat).norm() / x.norm().clamp_min(1e-12)).item(),
+        "max_abs_error": (x - x_hat).abs().max().item(),
+        "cosine_similarity": cos_sim.mean().item(),
+        "compression_ratio": original_bytes / quantized_bytes,
+    }
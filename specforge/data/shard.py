@@ -0,0 +1,416 @@
+"""
+Packed shard format for the offline hidden states.
+
+Instead of writing one pickled ``.ckpt`` file per sample, the samples are appended to
+shards. A shard is a directory containing one flat binary file per field (e.g.
+``aux_hidden_state.bin``) and an ``index.json`` file. All fields are stored token-major,
+so sample ``i`` of a shard occupies the tokens ``[offsets[i], offsets[i + 1])`` in every
+field file. Fields that do not have a token dimension (e.g. per-channel quantization
+scales) are stored per sample with a fixed shape instead. The ``index.json`` file is only
+written once the shard is complete, a shard directory without it is considered partial
+and is discarded when the writer is reopened.
+
+Example layout:
+    output_path/
+        shard_000000/
+            aux_hidden_state.bin
+            hidden_state.bin
+            input_ids.bin
+            loss_mask.bin
+            index.json
+        shard_000001/
+            ...
+
+A shard can optionally be compressed with zstd or lz4. Each field of each sample is then
+compressed as an independent block after a byte shuffle, which groups the i-th byte of
+every element together (e.g. the exponent bytes of bf16 values) and makes the hidden
+states much more compressible. The byte offsets of the blocks are stored in the index so
+that a sample can still be read without decompressing the rest of the shard, and the
+decompression happens in the DataLoader worker processes reading the samples.
+"""
+
+import glob
+import json
+import mmap
+import os
+import re
+import shutil
+import zlib
+from typing import Any, Dict, List, Optional, Set
+
+import numpy as np
+import torch
+
+# optional dependencies, only required by their codecs
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+SHARD_INDEX_FILE = "index.json"
+SHARD_DIR_PREFIX = "shard_"
+SHARD_CODECS = ["none", "zstd", "lz4"]
+
+_SHARD_DIR_RE = re.compile(r"^" + SHARD_DIR_PREFIX + r"(\d+)$")
+
+
+def _dtype_to_str(dtype: torch.dtype) -> str:
+    return str(dtype).replace("torch.", "")
+
+
+def _str_to_dtype(name: str) -> torch.dtype:
+    return getattr(torch, name)
+
+
+def _check_codec(codec: str) -> None:
+    if codec not in SHARD_CODECS:
+        raise ValueError(f"Unknown shard codec {codec}, expected one of {SHARD_CODECS}")
+    if codec == "zstd" and zstandard is None:
+        raise ImportError(
+            "zstandard is not installed, please install it with `pip install zstandard`"
+        )
+    if codec == "lz4" and lz4 is None:
+        raise ImportError(
+            "lz4 is not installed, please install it with `pip install lz4`"
+        )
+
+
+def _compress(
+    data: torch.Tensor, element_size: int, codec: str, level: Optional[int]
+) -> bytes:
+    # byte shuffle: (numel, element_size) -> (element_size, numel)
+    if element_size > 1:
+        data = data.view(data.numel() // element_size, element_size).t().contiguous()
+    data = data.numpy()
+    if codec == "zstd":
+        return zstandard.compress(data, 3 if level is None else level)
+    return lz4.frame.compress(data, compression_level=0 if level is None else level)
+
+
+def _decompress(data: bytes, element_size: int, codec: str) -> torch.Tensor:
+    if codec == "zstd":
+        data = zstandard.decompress(data)
+    else:
+        data = lz4.frame.decompress(data)
+    data = np.frombuffer(data, dtype=np.uint8)
+    if element_size > 1:
+        data = data.reshape(element_size, -1).T
+    # the copy un-shuffles the bytes and makes the buffer writable
+    return torch.from_numpy(np.array(data, order="C"))
+
+
+def list_shard_dirs(path: str) -> List[str]:
+    """
+    List all the complete shards under the given path, sorted by their path.
+
+    Args:
+        path: The root directory of the packed hidden states.
+
+    Returns:
+        The list of shard directories which contain an index file.
+    """
+    index_files = glob.glob(
+        os.path.join(path, "**", SHARD_INDEX_FILE),
+        recursive=True,
+    )
+    return sorted(os.path.dirname(f) for f in index_files)
+
+
+class ShardWriter:
+    """
+    Append samples to packed shards. Each call to ``write`` streams the sample to the
+    field files of the current shard, so at most one sample is held in memory. Once
+    ``samples_per_shard`` samples have been written, the shard is flushed, fsynced and
+    its index is written.
+
+    This class is not thread-safe, the caller is expected to call it from a single thread.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        samples_per_shard: int = 1000,
+        codec: str = "none",
+        compression_level: Optional[int] = None,
+        metadata: Optional[Dict[str, Any]] = None,
+    ):
+        """
+        Args:
+            output_dir: The directory to write the shards to.
+            samples_per_shard: The number of samples in each shard.
+            codec: "none", "zstd" or "lz4", the codec used to compress the samples.
+            compression_level: The compression level of the codec, defaults to the codec's default.
+            metadata: JSON-serializable properties shared by all the samples, e.g. the
+                quantization granularity, stored in the index of each shard.
+        """
+        _check_codec(codec)
+        self.output_dir = output_dir
+        self.samples_per_shard = samples_per_shard
+        self.codec = codec
+        self.compression_level = compression_level
+        self.metadata = metadata or {}
+        os.makedirs(output_dir, exist_ok=True)
+
+        # recover the state from the shards written by a previous run
+        self.completed_sample_ids: Set[int] = set()
+        next_shard_id = 0
+        for name in os.listdir(output_dir):
+            match = _SHARD_DIR_RE.match(name)
+            if match is None:
+                continue
+            shard_dir = os.path.join(output_dir, name)
+            if not os.path.exists(os.path.join(shard_dir, SHARD_INDEX_FILE)):
+                # partially written shard, it will be regenerated
+                shutil.rmtree(shard_dir)
+                continue
+            with open(os.path.join(shard_dir, SHARD_INDEX_FILE), "r") as f:
+                self.completed_sample_ids.update(json.load(f)["sample_ids"])
+            next_shard_id = max(next_shard_id, int(match.group(1)) + 1)
+
+        self._next_shard_id = next_shard_id
+        self._shard_dir = None
+        self._files = {}
+        self._fields = None
+        self._offsets = [0]
+        self._sample_ids = []
+        self._checksums = []
+        self._block_offsets = {}
+
+    def _open_shard(
+        self,
+        tensors: Dict[str, torch.Tensor],
+        sample_tensors: Dict[str, torch.Tensor],
+    ) -> None:
+        self._shard_dir = os.path.join(
+            self.output_dir, f"{SHARD_DIR_PREFIX}{self._next_shard_id:06d}"
+        )
+        self._next_shard_id += 1
+        os.makedirs(self._shard_dir, exist_ok=True)
+        self._fields = {
+            name: {
+                "dtype": _dtype_to_str(tensor.dtype),
+                "shape": list(tensor.shape[1:]),
+                "per_sample": False,
+            }
+            for name, tensor in tensors.items()
+        }
+        self._fields.update(
+            {
+                name: {
+                    "dtype": _dtype_to_str(tensor.dtype),
+                    "shape": list(tensor.shape),
+                    "per_sample": True,
+                }
+                for name, tensor in sample_tensors.items()
+            }
+        )
+        self._files = {
+            name: open(os.path.join(self._shard_dir, f"{name}.bin"), "wb")
+            for name in self._fields
+        }
+        self._offsets = [0]
+        self._sample_ids = []
+        self._checksums = []
+        self._block_offsets = {name: [0] for name in self._fields}
+
+    def write(
+        self,
+        sample_id: int,
+        tensors: Dict[str, torch.Tensor],
+        sample_tensors: Optional[Dict[str, torch.Tensor]] = None,
+    ) -> Optional[str]:
+        """
+        Append one sample to the current shard.
+
+        Args:
+            sample_id: The global index of the sample.
+            tensors: A mapping from field name to a tensor whose first dimension is the
+                sequence length. All tensors of a sample must have the same sequence length.
+            sample_tensors: A mapping from field name to a tensor without token dimension,
+                its shape must be the same for all the samples in the shard.
+
+        Returns:
+            The directory of the shard if it was finalized by this sample, otherwise None.
+        """
+        sample_tensors = sample_tensors or {}
+        if self._shard_dir is None:
+            self._open_shard(tensors, sample_tensors)
+
+        assert set(tensors) | set(sample_tensors) == set(
+            self._fields
+        ), f"Expected fields {sorted(self._fields)}, got {sorted(tensors) + sorted(sample_tensors)}"
+        num_tokens = None
+        for name, tensor in tensors.items():
+            assert (
+                num_tokens is None or tensor.shape[0] == num_tokens
+            ), f"All fields must have the same sequence length, got {tensor.shape[0]} for {name}"
+            num_tokens = tensor.shape[0]
+        for name, tensor in sample_tensors.items():
+            assert (
+                list(tensor.shape) == self._fields[name]["shape"]
+            ), f"Expected shape {self._fields[name]['shape']} for {name}, got {list(tensor.shape)}"
+
+        # the fields are always written in the order of the index so that the checksum
+        # can be recomputed from the sample returned by the reader, the checksum is
+        # always computed on the uncompressed bytes
+        checksum = 0
+        for name in self._fields:
+            tensor = tensors[name] if name in tensors else sample_tensors[name]
+            data = tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8)
+            checksum = zlib.crc32(data.numpy(), checksum)
+            if self.codec == "none":
+                self._files[name].write(data.numpy())
+            else:
+                block = _compress(
+                    data, tensor.element_size(), self.codec, self.compression_level
+                )
+                self._files[name].write(block)
+                self._block_offsets[name].append(
+                    self._block_offsets[name][-1] + len(block)
+                )
+
+        self._offsets.append(self._offsets[-1] + num_tokens)
+        self._sample_ids.append(sample_id)
+        self._checksums.append(checksum)
+        self.completed_sample_ids.add(sample_id)
+
+        if len(self._sample_ids) >= self.samples_per_shard:
+            return self.flush()
+        return None
+
+    def flush(self) -> Optional[str]:
+        """
+        Finalize the current shard by syncing the field files to disk and writing the index.
+
+        Returns:
+            The directory of the finalized shard, or None if there is no pending shard.
+        """
+        if self._shard_dir is None:
+            return None
+
+        for f in self._files.values():
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+
+        index = {
+            "fields": self._fields,
+            "offsets": self._offsets,
+            "sample_ids": self._sample_ids,
+            "checksums": self._checksums,
+            "codec": self.codec,
+            "metadata": self.metadata,
+        }
+        if self.codec != "none":
+            index["block_offsets"] = self._block_offsets
+        # write the index atomically so that a shard is either complete or discarded
+        tmp_index_path = os.path.join(self._shard_dir, f"{SHARD_INDEX_FILE}.tmp")
+        with open(tmp_index_path, "w") as f:
+            json.dump(index, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_index_path, os.path.join(self._shard_dir, SHARD_INDEX_FILE))
+
+        shard_dir = self._shard_dir
+        self._shard_dir = None
+        self._files = {}
+        return shard_dir
+
+    def close(self) -> Optional[str]:
+        return self.flush()
+
+
+class ShardReader:
+    """
+    Read samples from a packed shard. The field files are memory-mapped lazily, so the
+    reader can be safely pickled into DataLoader worker processes, and samples are
+    returned as zero-copy views on the mapped files. The samples of a compressed shard
+    are decompressed into new tensors instead.
+    """
+
+    def __init__(self, shard_dir: str):
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, SHARD_INDEX_FILE), "r") as f:
+            index = json.load(f)
+        self.fields = {
+            name: (
+                _str_to_dtype(meta["dtype"]),
+                tuple(meta["shape"]),
+                meta.get("per_sample", False),
+            )
+            for name, meta in index["fields"].items()
+        }
+        self.offsets = index["offsets"]
+        self.sample_ids = index["sample_ids"]
+        # CRC32 of the bytes of each sample, in the order of the fields
+        self.checksums = index.get("checksums")
+        # shards written before compression was supported have no codec
+        self.codec = index.get("codec", "none")
+        self.block_offsets = index.get("block_offsets")
+        self.metadata = index.get("metadata", {})
+        _check_codec(self.codec)
+        self._buffers = None
+
+    def __len__(self) -> int:
+        return len(self.sample_ids)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_buffers"] = None
+        return state
+
+    def _open_buffers(self) -> Dict[str, mmap.mmap]:
+        buffers = {}
+        for name in self.fields:
+            with open(os.path.join(self.shard_dir, f"{name}.bin"), "rb") as f:
+                # ACCESS_COPY gives writable, copy-on-write views, the file is never modified
+                buffers[name] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        return buffers
+
+    def __getitem__(self, index: int) -> Dict[str, torch.Tensor]:
+        """
+        Args:
+            index: The local index of the sample in this shard.
+
+        Returns:
+            A mapping from field name to a tensor of shape (seq_len, *field_shape),
+            or of shape field_shape for the per-sample fields.
+        """
+        if self._buffers is None:
+            self._buffers = self._open_buffers()
+
+        start, end = self.offsets[index], self.offsets[index + 1]
+        sample = {}
+        for name, (dtype, shape, per_sample) in self.fields.items():
+            numel = 1
+            for dim in shape:
+                numel *= dim
+            element_size = torch.empty(0, dtype=dtype).element_size()
+            if self.codec != "none":
+                block_start, block_end = self.block_offsets[name][index : index + 2]
+                data = _decompress(
+                    self._buffers[name][block_start:block_end], element_size, self.codec
+                )
+                sample[name] = data.view(dtype).view(
+                    *(shape if per_sample else (end - start, *shape))
+                )
+            elif per_sample:
+                sample[name] = torch.frombuffer(
+                    self._buffers[name],
+                    dtype=dtype,
+                    count=numel,
+                    offset=index * numel * element_size,
+                ).view(*shape)
+            else:
+                sample[name] = torch.frombuffer(
+                    self._buffers[name],
+                    dtype=dtype,
+                    count=(end - start) * numel,
+                    offset=start * numel * element_size,
+                ).view(end - start, *shape)
+        return sample
@@ -0,0 +1,279 @@
+"""
+Streaming dataset which tokenizes JSONL conversations on the fly.
+
+`build_eagle3_dataset` shuffles and tokenizes the whole corpus before the first training
+step, which takes hours for corpora with tens of millions of conversations.
+`StreamingEagle3Dataset` reads the JSONL files directly instead:
+
+- the files are split into byte-range chunks, and the chunks are shuffled with the seed
+  and the epoch and dealt round-robin to the DataLoader workers of all the DP ranks, so
+  each conversation is read by exactly one worker;
+- each worker tokenizes its conversations in small batches with the chat template
+  parsers of `preprocess_conversations`;
+- the samples go through a shuffle buffer seeded by the seed, the epoch and the worker.
+
+The order of the samples only depends on the seed, the files, the number of DP ranks
+and the number of DataLoader workers. The stream is infinite: when a worker reaches
+the end of its chunks it starts the next epoch, so that all the ranks always have a
+next batch and the training is bounded by the number of steps.
+"""
+
+import glob
+import json
+import os
+import random
+from typing import Dict, Iterator, List, Tuple, Union
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+from transformers import PreTrainedTokenizer
+
+from .preprocessing import preprocess_conversations
+from .template import TEMPLATE_REGISTRY, ChatTemplate
+
+# a chunk of a JSONL file, as (path, start byte, end byte)
+Chunk = Tuple[str, int, int]
+
+
+def list_jsonl_files(data_files: Union[str, List[str]]) -> List[str]:
+    """Expand the paths, glob patterns and directories of JSONL files."""
+    if isinstance(data_files, str):
+        data_files = [data_files]
+    files = []
+    for pattern in data_files:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*.jsonl")
+        matches = sorted(glob.glob(pattern))
+        if len(matches) == 0:
+            raise FileNotFoundError(f"No data file found for {pattern}")
+        files.extend(matches)
+    return files
+
+
+def split_chunks(files: List[str], chunk_size: int) -> List[Chunk]:
+    """Split the files into byte ranges of at most chunk_size bytes."""
+    chunks = []
+    for path in files:
+        file_size = os.path.getsize(path)
+        for start in range(0, file_size, chunk_size):
+            chunks.append((path, start, min(start + chunk_size, file_size)))
+    return chunks
+
+
+def read_chunk(chunk: Chunk) -> Iterator[dict]:
+    """
+    Yield the records of the lines which start in the byte range of the chunk, so that
+    a line spanning two chunks is read by the first one only.
+    """
+    path, start, end = chunk
+    with open(path, "rb") as f:
+        if start > 0:
+            # skip the end of the line started in the previous chunk, if the previous
+            # byte is a newline this only consumes it
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def shuffle_buffer(
+    iterable: Iterator, buffer_size: int, rng: random.Random
+) -> Iterator:
+    """Shuffle a stream with a buffer of buffer_size items."""
+    buffer = []
+    for item in iterable:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        index = rng.randrange(buffer_size)
+        yield buffer[index]
+        buffer[index] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+class StreamingEagle3Dataset(IterableDataset):
+    """
+    Iterable dataset yielding the same samples as the rows of `build_eagle3_dataset`,
+    i.e. tensors of shape (1, seq_len), see the module docstring.
+    """
+
+    def __init__(
+        self,
+        data_files: Union[str, List[str]],
+        tokenizer: PreTrainedTokenizer,
+        chat_template: str,
+        max_length: int = 2048,
+        is_preformatted: bool = False,
+        seed: int = 0,
+        dp_rank: int = 0,
+        dp_size: int = 1,
+        shuffle_buffer_size: int = 10000,
+        chunk_size: int = 16 * 1024**2,
+        tokenize_batch_size: int = 64,
+        vocab_mapping_num_samples: int = 100000,
+    ):
+        """
+        Args:
+            data_files: The JSONL files, glob patterns or directories of JSONL files.
+            tokenizer: The tokenizer to use for tokenization.
+            chat_template: The name of the chat template.
+            max_length: The maximum length of the tokenized input.
+            is_preformatted: Whether the records contain preformatted text in a "text"
+                field instead of ShareGPT conversations in a "conversations" field.
+            seed: The seed of the chunk order and the shuffle buffers.
+            dp_rank: The data parallel rank of this process.
+            dp_size: The number of data parallel ranks.
+            shuffle_buffer_size: The number of samples in the shuffle buffer of each
+                worker, 0 disables the buffer.
+            chunk_size: The number of bytes of the chunks the files are split into.
+            tokenize_batch_size: The number of records tokenized with a single call.
+            vocab_mapping_num_samples: The number of samples the vocab mapping is
+                computed from, see `count_masked_tokens`.
+        """
+        assert (
+            chat_template in TEMPLATE_REGISTRY.get_all_template_names()
+        ), f"Chat template {chat_template} not found in TEMPLATE_REGISTRY, you may need to register it first"
+        self.files = list_jsonl_files(data_files)
+        self.chunks = split_chunks(self.files, chunk_size)
+        self.tokenizer = tokenizer
+        self.template: ChatTemplate = TEMPLATE_REGISTRY.get(chat_template)
+        self.max_length = max_length
+        self.is_preformatted = is_preformatted
+        self.seed = seed
+        self.dp_rank = dp_rank
+        self.dp_size = dp_size
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.tokenize_batch_size = tokenize_batch_size
+        self.vocab_mapping_num_samples = vocab_mapping_num_samples
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        """Set the epoch the stream starts from."""
+        self.epoch = epoch
+
+    def get_epoch_chunks(self, epoch: int, shard: int, num_shards: int) -> List[Chunk]:
+        """The chunks read by a shard, i.e. a worker of a DP rank, in an epoch."""
+        chunks = list(self.chunks)
+        if len(chunks) < num_shards:
+            # split the files finer so that every shard gets a chunk
+            total_size = sum(os.path.getsize(path) for path in self.files)
+            chunks = split_chunks(self.files, max(1, total_size // num_shards))
+        random.Random(self.seed + epoch).shuffle(chunks)
+        return chunks[shard::num_shards]
+
+    def iter_records(self, shard: int, num_shards: int, epoch: int) -> Iterator[dict]:
+        """Yield the shuffled JSON records of a shard in an epoch."""
+        records = (
+            record
+            for chunk in self.get_epoch_chunks(epoch, shard, num_shards)
+            for record in read_chunk(chunk)
+        )
+        if self.shuffle_buffer_size > 0:
+            rng = random.Random(f"{self.seed}-{epoch}-{shard}")
+            records = shuffle_buffer(records, self.shuffle_buffer_size, rng)
+        return records
+
+    def tokenize(self, records: List[dict]) -> Dict[str, List[torch.Tensor]]:
+        """Tokenize a batch of records like `build_eagle3_dataset` does."""
+        if self.is_preformatted:
+            return preprocess_conversations(
+                self.tokenizer,
+                [record.get("text") for record in records],
+                self.template,
+                self.max_length,
+                is_preformatted=True,
+            )
+        # the other fields are passed to the parser, e.g. the tools of the conversation
+        keys = sorted(
+            {key for record in records for key in record} - {"conversations", "id"}
+        )
+        return preprocess_conversations(
+            self.tokenizer,
+            [record.get("conversations") for record in records],
+            self.template,
+            self.max_length,
+            is_preformatted=False,
+            **{key: [record.get(key) for record in records] for key in keys},
+        )
+
+    def iter_epoch_samples(
+        self, shard: int, num_shards: int, epoch: int
+    ) -> Iterator[Dict[str, torch.Tensor]]:
+        """Yield the tokenized samples of a shard in an epoch."""
+        batch = []
+        for record in self.iter_records(shard, num_shards, epoch):
+            batch.append(record)
+            if len(batch) == self.tokenize_batch_size:
+                yield from self._split_samples(self.tokenize(batch))
+                batch = []
+        if len(batch) > 0:
+            yield from self._split_samples(self.tokenize(batch))
+
+    def iter_samples(
+        self, shard: int, num_shards: int
+    ) -> Iterator[Dict[str, torch.Tensor]]:
+        """Yield the tokenized samples of a shard from the current epoch, forever."""
+        epoch = self.epoch
+        while True:
+            num_samples = 0
+            for sample in self.iter_epoch_samples(shard, num_shards, epoch):
+                num_samples += 1
+                yield sample
+            if num_samples == 0:
+                raise ValueError(
+                    f"The shard {shard} of {num_shards} has no sample in the epoch "
+                    f"{epoch}, the dataset is too small for the number of DP ranks "
+                    "and DataLoader workers"
+                )
+            epoch += 1
+
+    @staticmethod
+    def _split_samples(
+        processed: Dict[str, List[torch.Tensor]],
+    ) -> Iterator[Dict[str, torch.Tensor]]:
+        for i in range(len(processed["input_ids"])):
+            yield {key: value[i] for key, value in processed.items()}
+
+    def __iter__(self) -> Iterator[Dict[str, torch.Tensor]]:
+        worker_info = get_worker_info()
+        worker_id, num_workers = (
+            (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        )
+        return self.iter_samples(
+            self.dp_rank * num_workers + worker_id, self.dp_size * num_workers
+        )
+
+    def count_masked_tokens(self, vocab_size: int) -> torch.Tensor:
+        """
+        Count the frequency of each token in the loss mask of the first
+        vocab_mapping_num_samples samples of the stream read by a single worker, which
+        are spread over the whole corpus by the chunk shuffling.
+
+        Args:
+            vocab_size: The minimum size of the returned tensor.
+
+        Returns:
+            A tensor of shape (vocab_size,) with the number of occurrences of each
+            token.
+        """
+        token_counts = np.zeros(vocab_size, dtype=np.int64)
+        num_samples = 0
+        for sample in self.iter_epoch_samples(shard=0, num_shards=1, epoch=0):
+            if num_samples == self.vocab_mapping_num_samples:
+                break
+            input_ids = sample["input_ids"][sample["loss_mask"] == 1].numpy()
+            counts = np.bincount(input_ids, minlength=vocab_size)
+            if len(counts) > len(token_counts):
+                counts[: len(token_counts)] += token_counts
+                token_counts = counts
+            else:
+                token_counts[: len(counts)] += counts
+            num_samples += 1
+        return torch.from_numpy(token_counts)
@@ -1,7 +1,24 @@
 # Adapted from: https://github.com/sgl-project/sglang/blob/main/python/sglang/lang/chat_template.py#L13
-from typing import List
+from typing import List, NamedTuple, Optional
 
 from pydantic import BaseModel
+from transformers import PreTrainedTokenizer
+
+
+class SeparatorTokenIds(NamedTuple):
+    """
+    The token ids of the separators which precede the assistant and user messages,
+    i.e. the end of turn token followed by the header.
+
+    Args:
+        assistant(List[int]): The assistant separator without its trailing whitespace.
+        assistant_suffix(List[int]): The trailing whitespace tokens of the assistant separator.
+        user(List[int]): The user separator without its trailing whitespace.
+    """
+
+    assistant: List[int]
+    assistant_suffix: List[int]
+    user: List[int]
 
 
 class ChatTemplate(BaseModel):
@@ -21,6 +38,49 @@ class ChatTemplate(BaseModel):
     end_of_turn_token: str | None
     parser_type: str = "general"
 
+    def get_separator_token_ids(
+        self, tokenizer: PreTrainedTokenizer
+    ) -> Optional[SeparatorTokenIds]:
+        """
+        Tokenize the separators of the assistant and user messages, so that the assistant
+        spans can be found in the token ids of a conversation without decoding it.
+
+        The trailing whitespace tokens of a separator can be merged with the beginning of
+        the message in the tokenized conversation (e.g. "\n\n" followed by "\n"), so they
+        are returned apart. The separators must start with a special token, which cannot
+        be merged with the end of the previous message.
+
+        Args:
+            tokenizer(PreTrainedTokenizer): The tokenizer of the target model.
+
+        Returns:
+            Optional[SeparatorTokenIds]: The token ids of the separators, or None if the
+            headers are not set or if the separators do not start with a special token.
+        """
+        if self.assistant_header is None or self.user_header is None:
+            return None
+        special_token_ids = set(tokenizer.all_special_ids)
+        special_token_ids.update(tokenizer.get_added_vocab().values())
+
+        separators = []
+        for header in [self.assistant_header, self.user_header]:
+            token_ids = tokenizer.encode(
+                f"{self.end_of_turn_token or ''}{header}", add_special_tokens=False
+            )
+            num_tokens = len(token_ids)
+            while (
+                num_tokens > 0
+                and tokenizer.decode(token_ids[num_tokens - 1 : num_tokens]).strip()
+                == ""
+            ):
+                num_tokens -= 1
+            if num_tokens == 0 or token_ids[0] not in special_token_ids:
+                return None
+            separators.append((token_ids[:num_tokens], token_ids[num_tokens:]))
+
+        (assistant, assistant_suffix), (user, _) = separators
+        return SeparatorTokenIds(assistant, assistant_suffix, user)
+
 
 class TemplateRegistry:
     """
@@ -18,53 +18,92 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Any, Dict, List, Optional
+import bisect
+import itertools
+import math
+import random
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
+import pyarrow as pa
+import pyarrow.compute as pc
 import torch
 import torch.distributed as dist
 from datasets import Dataset
-from torch.utils.data import DataLoader, DistributedSampler
+from torch.utils.data import (
+    DataLoader,
+    DistributedSampler,
+    IterableDataset,
+    Sampler,
+    get_worker_info,
+)
+
+
+def _get_quantize_granularity(features: List[Dict[str, Any]]) -> str:
+    """
+    Get the granularity of the quantization scales of a batch of features, which must be
+    the same for all the features.
+    """
+    granularities = {item["quantize_granularity"] for item in features}
+    if len(granularities) > 1:
+        raise ValueError(
+            "All the features of a batch must have the same quantization granularity"
+        )
+    return granularities.pop()
 
 
 class DataCollatorWithPadding:
     """
     Datacollator that will dynamically pad the inputs for batching.
+
+    Each field of the batch is allocated once and the samples are copied into it. In a
+    DataLoader worker the batch is allocated in shared memory, which is how the worker
+    sends it to the main process, otherwise it is allocated in pinned memory if
+    pin_memory is set, which saves the copies of the large offline hidden states.
     """
 
-    def paddingtensor(self, intensors: torch.Tensor, N: int) -> torch.Tensor:
+    def __init__(
+        self, pad_to_multiple_of: Optional[int] = None, pin_memory: bool = False
+    ):
         """
-        Pad to the longest sequence in the batch.
-
         Args:
-            intensors: (B, n, S)
-            N: the length to pad to, N >= n
-
-        Returns:
-            outtensors: (B, N, S)
+            pad_to_multiple_of: Round the padded length up to a multiple of this, e.g.
+                the block size of flex attention, which bounds the number of compiled
+                sequence lengths.
+            pin_memory: Whether to allocate the batches collated in the main process in
+                pinned memory.
         """
-        B, n, S = intensors.shape
-        padding_tensor = torch.zeros(
-            B, N - n, S, dtype=intensors.dtype, device=intensors.device
-        )
-        outtensors = torch.cat((intensors, padding_tensor), dim=1)
-        return outtensors
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.pin_memory = pin_memory
 
-    def paddingtensor2D(self, intensors: torch.Tensor, N: int) -> torch.Tensor:
+    def empty(self, shape: Tuple[int, ...], dtype: torch.dtype) -> torch.Tensor:
+        """Allocate an uninitialized tensor where the batch is sent to."""
+        if get_worker_info() is not None:
+            # like the default collate function of the DataLoader
+            elem = torch.empty(0, dtype=dtype)
+            storage = elem._typed_storage()._new_shared(math.prod(shape))
+            return elem.new(storage).resize_(shape)
+        if self.pin_memory and torch.cuda.is_available():
+            return torch.empty(shape, dtype=dtype, pin_memory=True)
+        return torch.empty(shape, dtype=dtype)
+
+    def paddingstack(self, intensors: List[torch.Tensor], N: int) -> torch.Tensor:
         """
-        Pad 2D tensor to the longest sequence in the batch.
+        Stack and pad the samples of a field.
 
         Args:
-            intensors: (B, n)
+            intensors: B tensors of shape (1, n, *S)
             N: the length to pad to, N >= n
 
         Returns:
-            outtensors: (B, N)
+            outtensors: (B, N, *S)
         """
-        B, n = intensors.shape
-        padding_tensor = torch.zeros(
-            B, N - n, dtype=intensors.dtype, device=intensors.device
+        outtensors = self.empty(
+            (len(intensors), N, *intensors[0].shape[2:]), intensors[0].dtype
         )
-        outtensors = torch.cat((intensors, padding_tensor), dim=1)
+        for i, intensor in enumerate(intensors):
+            n = intensor.shape[1]
+            outtensors[i, :n].copy_(intensor[0])
+            outtensors[i, n:].zero_()
         return outtensors
 
     def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, Any]:
@@ -73,49 +112,117 @@ class DataCollatorWithPadding:
 
         Args:
             features: A list of features, where each feature is a dictionary containing:
-                - input_ids: torch.Tensor of shape (n,)
-                - attention_mask: torch.Tensor of shape (n,)
-                - loss_mask: torch.Tensor of shape (n,)
+                - input_ids: torch.Tensor of shape (1, n)
+                - attention_mask: torch.Tensor of shape (1, n)
+                - loss_mask: torch.Tensor of shape (1, n)
+                - hidden_state/target (optional): torch.Tensor of shape (1, n, hidden_size)
+                - hidden_state_scale/target_scale (optional): scales of the quantized hidden states,
+                    torch.Tensor of shape (1, n, num_groups) or (1, 1, hidden_size)
+                - quantize_granularity (optional): "per_token" or "per_channel", the
+                    granularity of the scales
+                - target_topk_probs/target_topk_indices (optional): the sparse teacher distributions
+                    stored instead of the target, torch.Tensor of shape (1, n, topk)
+                - target_in_draft (optional): torch.Tensor of shape (1, n)
 
         Returns:
             A dictionary containing:
                 - input_ids: torch.Tensor of shape (B, N)
                 - attention_mask: torch.Tensor of shape (B, N)
                 - loss_mask: torch.Tensor of shape (B, N)
+                - the optional fields, padded to N or stacked for per-channel scales
         """
         max_length = max(item["input_ids"].shape[1] for item in features)
-        batch_input_ids = torch.cat(
-            [self.paddingtensor2D(item["input_ids"], max_length) for item in features]
-        )
-        batch_attention_mask = torch.cat(
-            [
-                self.paddingtensor2D(item["attention_mask"], max_length)
-                for item in features
-            ]
-        )
-        batch_loss_mask = torch.cat(
-            [self.paddingtensor2D(item["loss_mask"], max_length) for item in features]
-        )
+        if self.pad_to_multiple_of is not None:
+            max_length = math.ceil(max_length / self.pad_to_multiple_of)
+            max_length *= self.pad_to_multiple_of
         batch = {
-            "input_ids": batch_input_ids,
-            "attention_mask": batch_attention_mask,
-            "loss_mask": batch_loss_mask,
-            "hidden_state": None,
-            "target": None,
+            key: self.paddingstack([item[key] for item in features], max_length)
+            for key in ["input_ids", "attention_mask", "loss_mask"]
         }
+        batch["hidden_state"] = None
+        batch["target"] = None
         if all("hidden_state" in item for item in features):
             assert all(
-                "target" in item for item in features
+                "target" in item or "target_topk_probs" in item for item in features
             ), "target is required when hidden_state is provided"
-            batch["hidden_state"] = torch.cat(
-                [
-                    self.paddingtensor(item["hidden_state"], max_length)
-                    for item in features
-                ]
-            )
-            batch["target"] = torch.cat(
-                [self.paddingtensor(item["target"], max_length) for item in features]
+            batch["hidden_state"] = self.paddingstack(
+                [item["hidden_state"] for item in features], max_length
             )
+            if all("target" in item for item in features):
+                batch["target"] = self.paddingstack(
+                    [item["target"] for item in features], max_length
+                )
+        # sparse teacher distributions of the offline hidden states
+        if all("target_topk_probs" in item for item in features):
+            for key in ["target_topk_probs", "target_topk_indices", "target_in_draft"]:
+                batch[key] = self.paddingstack(
+                    [item[key] for item in features], max_length
+                )
+        # scales of the quantized offline hidden states
+        for key in ["hidden_state_scale", "target_scale"]:
+            if not all(key in item for item in features):
+                continue
+            if _get_quantize_granularity(features) == "per_channel":
+                # per-channel scales are shared by all the tokens of a sample
+                batch[key] = self.paddingstack([item[key] for item in features], 1)
+            else:
+                # the padded tokens are zeros, so their scale does not matter
+                batch[key] = self.paddingstack(
+                    [item[key] for item in features], max_length
+                )
+        return batch
+
+
+class DataCollatorWithPacking:
+    """
+    Datacollator that concatenates the samples of a batch into a single row, see
+    `PackedBatchSampler`. The position ids restart at 0 at the start of each sample so
+    that the draft model can tell the documents of the row apart.
+    """
+
+    # the per-token fields, which are concatenated along the sequence dimension
+    KEYS = [
+        "input_ids",
+        "attention_mask",
+        "loss_mask",
+        "hidden_state",
+        "target",
+        "target_topk_probs",
+        "target_topk_indices",
+        "target_in_draft",
+    ]
+
+    def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Collate a batch of features into a packed row.
+
+        Args:
+            features: A list of features, with the same fields as for
+                `DataCollatorWithPadding`.
+
+        Returns:
+            A dictionary with the same fields as `DataCollatorWithPadding`, of batch
+            size 1, and position_ids: torch.Tensor of shape (1, N).
+        """
+        batch = {"hidden_state": None, "target": None}
+        for key in self.KEYS:
+            if all(key in item for item in features):
+                batch[key] = torch.cat([item[key] for item in features], dim=1)
+        batch["position_ids"] = torch.cat(
+            [torch.arange(item["input_ids"].shape[1]) for item in features]
+        )[None, :]
+        for key in ["hidden_state_scale", "target_scale"]:
+            if not all(key in item for item in features):
+                continue
+            if (
+                _get_quantize_granularity(features) == "per_channel"
+                and len(features) > 1
+            ):
+                raise ValueError(
+                    "Per-channel quantized hidden states cannot be packed, "
+                    "regenerate them with per-token scales"
+                )
+            batch[key] = torch.cat([item[key] for item in features], dim=1)
         return batch
 
 
@@ -218,6 +325,331 @@ class VlmDataCollatorWithPadding:
         return batch
 
 
+def flatten_batch_dim(column: pa.ChunkedArray) -> pa.ChunkedArray:
+    """
+    Remove the batch dimension of an arrow column of the processed dataset, whose rows
+    are stored with shape (1, seq_len). Columns without batch dimension are returned as is.
+    """
+    if pa.types.is_list(column.type.value_type) or pa.types.is_large_list(
+        column.type.value_type
+    ):
+        return pc.list_flatten(column)
+    return column
+
+
+def get_sample_lengths(
+    dataset: Dataset, start: int = 0, end: Optional[int] = None
+) -> List[int]:
+    """
+    Get the number of tokens of the samples of a processed dataset without decoding them.
+
+    Args:
+        dataset: The dataset returned by `build_eagle3_dataset`.
+        start: The index of the first sample.
+        end: The index after the last sample, defaults to the length of the dataset.
+
+    Returns:
+        The number of tokens of the samples in [start, end).
+    """
+    end = len(dataset) if end is None else end
+    if getattr(dataset, "lengths", None) is not None:
+        # e.g. the compact dataset
+        return list(dataset.lengths[start:end])
+    if not isinstance(dataset, Dataset):
+        raise ValueError(
+            "The sample lengths are unknown, e.g. the offline hidden states have no "
+            "manifest"
+        )
+    input_ids = dataset.with_format("arrow")[start:end]["input_ids"]
+    return pc.list_value_length(flatten_batch_dim(input_ids)).to_pylist()
+
+
+class TokenBudgetBatchSampler(Sampler[List[int]]):
+    """
+    Batch sampler which groups samples of similar lengths into batches whose padded size,
+    i.e. the batch size times the longest sample, fits a token budget. The samples are
+    sorted by decreasing length so that the batch which needs the most memory comes
+    first, ties are broken by index so that the batches are deterministic.
+
+    For distributed training, all the ranks compute the same batches, which are
+    shuffled with the seed and the epoch and dealt round-robin to the ranks. The batches
+    which do not divide evenly between the ranks are dropped, so all the ranks run as
+    many steps.
+    """
+
+    def __init__(
+        self,
+        lengths: List[int],
+        max_tokens: int,
+        indices: Optional[List[int]] = None,
+        max_batch_size: Optional[int] = None,
+        num_replicas: int = 1,
+        rank: int = 0,
+        shuffle: bool = False,
+        seed: int = 0,
+    ):
+        """
+        Args:
+            lengths: The number of tokens of each sample.
+            max_tokens: The max number of padded tokens in a batch, a sample longer than
+                this is put in a batch of its own.
+            indices: The dataset indices of the samples, defaults to range(len(lengths)).
+            max_batch_size: The max number of samples in a batch.
+            num_replicas: The number of data parallel ranks.
+            rank: The data parallel rank of this process.
+            shuffle: Whether to shuffle the batches at each epoch.
+            seed: The seed of the shuffling.
+        """
+        indices = list(range(len(lengths))) if indices is None else list(indices)
+        assert len(indices) == len(
+            lengths
+        ), "lengths and indices must have the same size"
+
+        order = sorted(range(len(indices)), key=lambda i: (-lengths[i], indices[i]))
+        self.batches = []
+        batch, batch_max_len = [], 0
+        for i in order:
+            max_len = max(batch_max_len, lengths[i])
+            if len(batch) > 0 and (
+                max_len * (len(batch) + 1) > max_tokens
+                or (max_batch_size is not None and len(batch) >= max_batch_size)
+            ):
+                self.batches.append(batch)
+                batch, max_len = [], lengths[i]
+            batch.append(indices[i])
+            batch_max_len = max_len
+        if len(batch) > 0:
+            self.batches.append(batch)
+
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.num_batches = len(self.batches) // num_replicas
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[List[int]]:
+        batches = list(self.batches)
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(batches)
+        batches = batches[: self.num_batches * self.num_replicas]
+        return iter(batches[self.rank :: self.num_replicas])
+
+    def __len__(self) -> int:
+        return self.num_batches
+
+
+class PackedBatchSampler(Sampler[List[int]]):
+    """
+    Distributed batch sampler which packs samples into rows of at most max_tokens
+    tokens, to be concatenated by `DataCollatorWithPacking`. The samples are packed with
+    the best fit decreasing heuristic, which leaves little room in the rows. The packing
+    only depends on the lengths, so all the ranks compute the same rows, which are
+    shuffled with the seed and the epoch and dealt round-robin to the ranks. The rows
+    which do not divide evenly between the ranks are dropped, so all the ranks run as
+    many steps.
+    """
+
+    def __init__(
+        self,
+        lengths: List[int],
+        max_tokens: int,
+        num_replicas: int = 1,
+        rank: int = 0,
+        shuffle: bool = True,
+        seed: int = 0,
+    ):
+        """
+        Args:
+            lengths: The number of tokens of each sample, a sample longer than
+                max_tokens is put in a row of its own.
+            max_tokens: The max number of tokens in a row.
+            num_replicas: The number of data parallel ranks.
+            rank: The data parallel rank of this process.
+            shuffle: Whether to shuffle the rows at each epoch.
+            seed: The seed of the shuffling.
+        """
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+        order = sorted(range(len(lengths)), key=lambda i: (-lengths[i], i))
+        self.rows: List[List[int]] = []
+        # the (room left, row index) of the rows which can still take a sample, sorted
+        free_rows = []
+        for i in order:
+            position = bisect.bisect_left(free_rows, (lengths[i], -1))
+            if position < len(free_rows):
+                room, row = free_rows.pop(position)
+            else:
+                room, row = max_tokens, len(self.rows)
+                self.rows.append([])
+            self.rows[row].append(i)
+            room -= lengths[i]
+            if room > 0:
+                bisect.insort(free_rows, (room, row))
+        self.num_rows = len(self.rows) // num_replicas
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[List[int]]:
+        rows = list(self.rows)
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(rows)
+        rows = rows[: self.num_rows * self.num_replicas]
+        return iter(rows[self.rank :: self.num_replicas])
+
+    def __len__(self) -> int:
+        return self.num_rows
+
+
+class LengthGroupedDistributedSampler(Sampler[int]):
+    """
+    Distributed sampler which groups samples of similar lengths into the batches of the
+    same step, to cut the padding of the batches and the time the ranks wait for the
+    rank with the longest sample.
+
+    At each epoch, the samples are shuffled with the seed and the epoch and split into
+    megabatches of megabatch_multiplier global batches, a global batch being the batches
+    of all the ranks at one step. Each megabatch is sorted by decreasing length and
+    split into global batches, whose samples are dealt round-robin to the ranks so that
+    the ranks get as many tokens. The order of the global batches is then shuffled.
+    """
+
+    def __init__(
+        self,
+        lengths: List[int],
+        batch_size: int,
+        num_replicas: int = 1,
+        rank: int = 0,
+        shuffle: bool = True,
+        seed: int = 0,
+        megabatch_multiplier: int = 50,
+    ):
+        """
+        Args:
+            lengths: The number of tokens of each sample.
+            batch_size: The batch size of each rank.
+            num_replicas: The number of data parallel ranks.
+            rank: The data parallel rank of this process.
+            shuffle: Whether to shuffle the samples, otherwise the megabatches are made
+                of consecutive samples and are not shuffled.
+            seed: The seed of the shuffling.
+            megabatch_multiplier: The number of global batches of a megabatch, larger
+                megabatches give less padding and less randomness.
+        """
+        self.lengths = list(lengths)
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.megabatch_multiplier = megabatch_multiplier
+        self.epoch = 0
+        # the samples which do not fill a global batch are dropped
+        self.global_batch_size = batch_size * num_replicas
+        self.num_global_batches = len(self.lengths) // self.global_batch_size
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def get_global_batches(self) -> List[List[List[int]]]:
+        """Get the batches of all the ranks, as [step][rank][sample], of the epoch."""
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        if self.shuffle:
+            indices = torch.randperm(len(self.lengths), generator=generator).tolist()
+        else:
+            indices = list(range(len(self.lengths)))
+        indices = indices[: self.num_global_batches * self.global_batch_size]
+
+        megabatch_size = self.global_batch_size * self.megabatch_multiplier
+        global_batches = []
+        for start in range(0, len(indices), megabatch_size):
+            megabatch = sorted(
+                indices[start : start + megabatch_size],
+                key=lambda i: -self.lengths[i],
+            )
+            for batch_start in range(0, len(megabatch), self.global_batch_size):
+                global_batch = megabatch[
+                    batch_start : batch_start + self.global_batch_size
+                ]
+                global_batches.append(
+                    [
+                        global_batch[rank :: self.num_replicas]
+                        for rank in range(self.num_replicas)
+                    ]
+                )
+        if self.shuffle:
+            order = torch.randperm(len(global_batches), generator=generator).tolist()
+            global_batches = [global_batches[i] for i in order]
+        return global_batches
+
+    def get_padding_ratio(self) -> float:
+        """
+        Get the fraction of the tokens of the padded batches of all the ranks which are
+        padding in the epoch, where a step is padded to its longest sample since the
+        ranks wait for each other.
+        """
+        num_tokens, num_padded_tokens = 0, 0
+        for global_batch in self.get_global_batches():
+            step_lengths = [self.lengths[i] for batch in global_batch for i in batch]
+            num_tokens += sum(step_lengths)
+            num_padded_tokens += max(step_lengths) * len(step_lengths)
+        return 1 - num_tokens / max(num_padded_tokens, 1)
+
+    def __iter__(self) -> Iterator[int]:
+        for global_batch in self.get_global_batches():
+            yield from global_batch[self.rank]
+
+    def __len__(self) -> int:
+        return self.num_global_batches * self.batch_size
+
+
+class ResumableSampler(Sampler):
+    """
+    Wrap a sampler or a batch sampler so that its next iteration can start after the
+    batches which were consumed before the training was interrupted. The skipped batches
+    are sliced off the indices, the samples are not loaded. The other attributes, e.g.
+    set_epoch, are those of the wrapped sampler.
+    """
+
+    def __init__(self, sampler: Sampler, batch_size: int = 1):
+        """
+        Args:
+            sampler: The sampler to wrap.
+            batch_size: The number of items of the sampler in a batch, 1 for a batch
+                sampler.
+        """
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.num_skipped_batches = 0
+
+    def skip_batches(self, num_batches: int) -> None:
+        """Skip the first num_batches batches of the next iteration only."""
+        self.num_skipped_batches = num_batches
+
+    def __getattr__(self, name: str) -> Any:
+        # only called for the attributes which are not found on the wrapper
+        if name == "sampler":
+            raise AttributeError(name)
+        return getattr(self.sampler, name)
+
+    def __iter__(self) -> Iterator:
+        num_skipped = self.num_skipped_batches * self.batch_size
+        self.num_skipped_batches = 0
+        return itertools.islice(iter(self.sampler), num_skipped, None)
+
+    def __len__(self) -> int:
+        return len(self.sampler)
+
+
 def prepare_dp_dataloaders(
     dataset: Dataset,
     batch_size: int,
@@ -227,6 +659,10 @@ def prepare_dp_dataloaders(
     shuffle: Optional[bool] = False,
     is_vlm: Optional[bool] = False,
     prefetch_factor: Optional[int] = 2,
+    pack_max_tokens: Optional[int] = None,
+    group_by_length: bool = False,
+    max_tokens_per_batch: Optional[int] = None,
+    pad_to_multiple_of: Optional[int] = None,
     **dataloader_kwargs
 ) -> DataLoader:
     """
@@ -240,20 +676,81 @@ def prepare_dp_dataloaders(
         pin_memory: Whether to pin memory for data loading.
         shuffle: Whether to shuffle the dataset.
         is_vlm: Whether the dataset is a vision-language model dataset.
+        prefetch_factor: The number of batches loaded in advance by each worker.
+        pack_max_tokens: If set, the samples are packed into rows of at most this many
+            tokens, see `PackedBatchSampler`, and batch_size is ignored.
+        group_by_length: Whether to group the samples of similar lengths into the
+            batches of the same step, see `LengthGroupedDistributedSampler`.
+        max_tokens_per_batch: If set, the batches hold a variable number of samples
+            whose padded size fits this many tokens, see `TokenBudgetBatchSampler`, and
+            batch_size is ignored.
+        pad_to_multiple_of: Round the padded length of the batches of text datasets up
+            to a multiple of this.
         **dataloader_kwargs: Additional keyword arguments for the DataLoader.
 
     Returns:
-        A DataLoader for the dataset.
+        A DataLoader for the dataset, whose sampler, or batch sampler if any, is a
+        `ResumableSampler`.
     """
     world_size = dist.get_world_size(process_group)
     rank = dist.get_rank(process_group)
-    sampler = DistributedSampler(
-        dataset, num_replicas=world_size, rank=rank, shuffle=shuffle
-    )
     if is_vlm:
-        datacollator_cls = VlmDataCollatorWithPadding
+        datacollator = VlmDataCollatorWithPadding()
     else:
-        datacollator_cls = DataCollatorWithPadding
+        datacollator = DataCollatorWithPadding(
+            pad_to_multiple_of=pad_to_multiple_of, pin_memory=pin_memory
+        )
+
+    batch_sampler = None
+    if pack_max_tokens is not None:
+        # the samples longer than the max length are truncated by the dataset
+        lengths = [
+            min(length, pack_max_tokens) for length in get_sample_lengths(dataset)
+        ]
+        batch_sampler = PackedBatchSampler(
+            lengths,
+            pack_max_tokens,
+            num_replicas=world_size,
+            rank=rank,
+            shuffle=shuffle,
+        )
+        datacollator = DataCollatorWithPacking()
+    elif max_tokens_per_batch is not None:
+        batch_sampler = TokenBudgetBatchSampler(
+            get_sample_lengths(dataset),
+            max_tokens_per_batch,
+            num_replicas=world_size,
+            rank=rank,
+            shuffle=shuffle,
+        )
+    if batch_sampler is not None:
+        return DataLoader(
+            dataset,
+            batch_sampler=ResumableSampler(batch_sampler),
+            num_workers=num_workers,
+            pin_memory=pin_memory,
+            prefetch_factor=prefetch_factor,
+            collate_fn=datacollator,
+            **dataloader_kwargs
+        )
+
+    if isinstance(dataset, IterableDataset):
+        # e.g. the streaming dataset, which shards and shuffles the data itself
+        sampler = None
+    elif group_by_length:
+        sampler = LengthGroupedDistributedSampler(
+            get_sample_lengths(dataset),
+            batch_size,
+            num_replicas=world_size,
+            rank=rank,
+            shuffle=shuffle,
+        )
+    else:
+        sampler = DistributedSampler(
+            dataset, num_replicas=world_size, rank=rank, shuffle=shuffle
+        )
+    if sampler is not None:
+        sampler = ResumableSampler(sampler, batch_size)
     dataloader = DataLoader(
         dataset,
         batch_size=batch_size,
@@ -261,7 +758,7 @@ def prepare_dp_dataloaders(
         num_workers=num_workers,
         pin_memory=pin_memory,
         prefetch_factor=prefetch_factor,
-        collate_fn=datacollator_cls(),
+        collate_fn=datacollator,
         drop_last=True,
         **dataloader_kwargs
     )
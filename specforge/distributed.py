@@ -10,6 +10,9 @@ _TP_DEVICE_MESH = None
 _TP_GROUP = None
 _DP_DEVICE_MESH = None
 _DP_GROUP = None
+_DRAFT_GROUP = None
+_DRAFT_RANKS = None
+_TARGET_RANKS = None
 
 
 def get_tp_group():
@@ -37,12 +40,82 @@ def get_dp_device_mesh():
     return _DP_DEVICE_MESH
 
 
-def init_distributed(timeout: int = 10, tp_size: int = 1):
+def get_draft_group():
+    """The process group of the ranks which train the draft model."""
+    global _DRAFT_GROUP
+    return _DRAFT_GROUP
+
+
+def get_draft_ranks():
+    global _DRAFT_RANKS
+    return _DRAFT_RANKS
+
+
+def get_target_ranks():
+    global _TARGET_RANKS
+    return _TARGET_RANKS
+
+
+def is_disaggregated():
+    """Return True if the target and draft models run on separate ranks."""
+    return get_draft_ranks() != get_target_ranks()
+
+
+def is_target_rank():
+    """Return True if current process runs the target model."""
+    return dist.get_rank() in get_target_ranks()
+
+
+def _init_disaggregated_mesh(num_target_ranks: int, tp_size: int):
+    """
+    Split the world into the draft ranks, the first world_size - num_target_ranks ones,
+    which form a (dp, 1) mesh, and the target ranks, which form a (dp, tp) mesh.
+    """
+    world_size = dist.get_world_size()
+    num_draft_ranks = world_size - num_target_ranks
+    assert num_draft_ranks > 0, "at least one rank must train the draft model"
+    assert (
+        num_target_ranks % tp_size == 0
+    ), "the number of target ranks must be divisible by tp size"
+    draft_mesh = torch.arange(num_draft_ranks).view(num_draft_ranks, 1)
+    target_mesh = torch.arange(num_draft_ranks, world_size).view(-1, tp_size)
+
+    # every rank creates every group in the same order
+    rank = dist.get_rank()
+    dp_group = tp_group = None
+    for mesh in [draft_mesh, target_mesh]:
+        for ranks in mesh.t().tolist():
+            group = dist.new_group(ranks)
+            if rank in ranks:
+                dp_group = group
+        for ranks in mesh.tolist():
+            group = dist.new_group(ranks)
+            if rank in ranks:
+                tp_group = group
+    mesh = draft_mesh if rank < num_draft_ranks else target_mesh
+    device_mesh = dist.DeviceMesh.from_group(
+        [dp_group, tp_group],
+        device_type="cuda",
+        mesh=mesh,
+        mesh_dim_names=["dp", "tp"],
+    )
+
+    global _DRAFT_GROUP, _DRAFT_RANKS, _TARGET_RANKS
+    _DRAFT_GROUP = dp_group if rank < num_draft_ranks else None
+    _DRAFT_RANKS = draft_mesh.view(-1).tolist()
+    _TARGET_RANKS = target_mesh.view(-1).tolist()
+    return device_mesh, tp_group, dp_group
+
+
+def init_distributed(timeout: int = 10, tp_size: int = 1, num_target_ranks: int = 0):
     """Initialize distributed training.
 
     Args:
         timeout(int): Timeout for collective communication in minutes
         tp_size(int): The degree of tensor parallelism
+        num_target_ranks(int): The number of ranks which only run the target model and
+            send its outputs to the other ranks, which only train the draft model. If 0,
+            every rank runs both models. The tp size only applies to the target ranks.
     """
     dist.init_process_group(backend="nccl", timeout=timedelta(minutes=timeout))
     local_rank = dist.get_rank() % torch.cuda.device_count()
@@ -50,14 +123,24 @@ def init_distributed(timeout: int = 10, tp_size: int = 1):
     print_with_rank(f"bind to device {local_rank}")
 
     world_size = dist.get_world_size()
-    dp_size = world_size // tp_size
-    assert world_size == tp_size * dp_size, "world size must be divisible by tp size"
-    device_mesh = dist.device_mesh.init_device_mesh(
-        "cuda", (dp_size, tp_size), mesh_dim_names=["dp", "tp"]
-    )
+    if num_target_ranks > 0:
+        device_mesh, tp_group, dp_group = _init_disaggregated_mesh(
+            num_target_ranks, tp_size
+        )
+    else:
+        dp_size = world_size // tp_size
+        assert (
+            world_size == tp_size * dp_size
+        ), "world size must be divisible by tp size"
+        device_mesh = dist.device_mesh.init_device_mesh(
+            "cuda", (dp_size, tp_size), mesh_dim_names=["dp", "tp"]
+        )
+        tp_group = device_mesh.get_group("tp")
+        dp_group = device_mesh.get_group("dp")
+        global _DRAFT_GROUP, _DRAFT_RANKS, _TARGET_RANKS
+        _DRAFT_GROUP = dist.group.WORLD
+        _DRAFT_RANKS = _TARGET_RANKS = list(range(world_size))
     print_with_rank(f"device mesh: {device_mesh}")
-    tp_group = device_mesh.get_group("tp")
-    dp_group = device_mesh.get_group("dp")
 
     # we need to create a 1D submesh
     tp_device_mesh = dist.DeviceMesh.from_group(tp_group, device_type="cuda")
@@ -0,0 +1,119 @@
+"""
+Accumulation of the training metrics on the device.
+
+Reading a metric with `.item()` or `.tolist()` waits for the device to run all the
+kernels queued before it, so the host stops queueing the next step meanwhile.
+`MetricAccumulator` sums the losses and accuracies of the steps on the device, and reads
+them once per log interval, after a single all_reduce, from a host copy made by the
+device while the next step is queued.
+"""
+
+from dataclasses import dataclass
+from typing import List, Optional, Tuple, Union
+
+import torch
+import torch.distributed as dist
+
+
+@dataclass
+class ReducedMetrics:
+    step: int
+    plosses: List[float]
+    accuracies: List[float]
+
+
+class MetricAccumulator:
+    """
+    Accumulate the losses and accuracies of each TTT position over the steps, on the
+    device. `reduce` starts averaging them over the steps and the ranks, and `collect`
+    reads the averages.
+    """
+
+    def __init__(
+        self,
+        length: int,
+        process_group: Optional[dist.ProcessGroup] = None,
+        device: Optional[Union[str, torch.device]] = None,
+    ):
+        """
+        Args:
+            length: The number of TTT positions.
+            process_group: The process group to average the metrics over.
+            device: The device of the metrics, the current CUDA device if available.
+        """
+        if device is None:
+            device = (
+                torch.device("cuda", torch.cuda.current_device())
+                if torch.cuda.is_available()
+                else torch.device("cpu")
+            )
+        self.length = length
+        self.process_group = process_group
+        self.device = torch.device(device)
+        # the sums of the losses and of the accuracies of each position
+        self._sums = torch.zeros(2, length, dtype=torch.float32, device=self.device)
+        self._num_steps = 0
+        self._host_buffer = torch.empty(
+            2, length, dtype=torch.float32, pin_memory=self.device.type == "cuda"
+        )
+        self._pending: Optional[Tuple[int, Optional[torch.cuda.Event]]] = None
+        # the averages of the last collected reduce
+        self.last: Optional[ReducedMetrics] = None
+
+    @torch.no_grad()
+    def update(
+        self, plosses: List[torch.Tensor], accuracies: List[torch.Tensor]
+    ) -> None:
+        """
+        Add the metrics of a step, without waiting for the device.
+
+        Args:
+            plosses: The loss of each position.
+            accuracies: The accuracy of each position.
+        """
+        assert len(plosses) == len(accuracies) == self.length
+        self._sums[0].add_(torch.stack(plosses).float())
+        self._sums[1].add_(torch.stack(accuracies).float())
+        self._num_steps += 1
+
+    def reduce(self, step: int) -> None:
+        """
+        Start averaging the metrics added since the last reduce over the steps and the
+        ranks, with a single all_reduce, and copying them to the host. Every rank of the
+        process group must call it after as many updates.
+
+        Args:
+            step: The step the metrics are logged at.
+        """
+        assert self._num_steps > 0, "no metrics were added since the last reduce"
+        assert self._pending is None, "the last reduced metrics were not collected"
+        # gloo has no average reduction
+        world_size = dist.get_world_size(self.process_group)
+        averages = self._sums / (self._num_steps * world_size)
+        dist.all_reduce(averages, group=self.process_group)
+        self._sums.zero_()
+        self._num_steps = 0
+
+        self._host_buffer.copy_(averages, non_blocking=True)
+        copied = None
+        if self.device.type == "cuda":
+            copied = torch.cuda.Event()
+            copied.record(torch.cuda.current_stream(self.device))
+        self._pending = (step, copied)
+
+    def collect(self) -> Optional[ReducedMetrics]:
+        """
+        Read the averages of the last reduce, once. It waits for the host copy, which
+        the device made while the next step was queued if the reduce started then.
+
+        Returns:
+            The averages, or None if they were collected or nothing was reduced.
+        """
+        if self._pending is None:
+            return None
+        (step, copied), self._pending = self._pending, None
+        if copied is not None:
+            copied.synchronize()
+        plosses, accuracies = self._host_buffer.tolist()
+        self.last = ReducedMetrics(step, plosses, accuracies)
+        return self.last
@@ -125,3 +125,52 @@ def generate_eagle3_mask(
     mask_mod = or_masks(causal_mask, suffix_mask)
     mask_mod.__name__ = f"eagle3_mask_Q_{Q_LEN}_KV_{KV_LEN}_lck_{lck}"
     return mask_mod
+
+
+def generate_packed_eagle3_mask(
+    position_ids: torch.Tensor,
+    attention_mask: torch.Tensor,
+    Q_LEN: int,
+    KV_LEN: int,
+    lck: int = 0,
+):
+    """
+    The eagle3 mask of rows packing several documents, a token only attends to the
+    tokens of its own document. On rows holding a single document this is the mask of
+    `generate_eagle3_mask`.
+
+    Args:
+        position_ids: (B, Q_LEN), they restart at 0 at the start of each document.
+        attention_mask: (B, Q_LEN), the padding mask.
+        Q_LEN: The length of the queries.
+        KV_LEN: The length of the keys, including the suffixes of the previous steps.
+        lck: The index of the TTT step.
+    """
+    document_ids = (position_ids == 0).long().cumsum(dim=-1) - 1
+    document_lengths = torch.zeros_like(document_ids).scatter_add_(
+        1, document_ids, attention_mask.long()
+    )
+    # Shrink each document by lck tokens to align with the padding to the right, like
+    # seq_lengths -= lck for rows which are not packed.
+    remaining_lengths = document_lengths.gather(1, document_ids) - position_ids
+    valid_mask = remaining_lengths > lck
+
+    def causal_mask(b, h, q_idx, kv_idx):
+        # kv_idx < Q_LEN when q_idx >= kv_idx, the modulo only keeps the indexing
+        # in bounds for the suffix keys
+        kv_pos = kv_idx % Q_LEN
+        causal_mask = q_idx >= kv_idx
+        document_mask = document_ids[b, q_idx] == document_ids[b, kv_pos]
+        padding_mask = valid_mask[b, q_idx] & valid_mask[b, kv_pos]
+        return causal_mask & document_mask & padding_mask
+
+    def suffix_mask(b, h, q_idx, kv_idx):
+        # the diagonal only matches the same position, hence the same document
+        suffix_mask = kv_idx >= Q_LEN
+        padding_mask = valid_mask[b, kv_idx % Q_LEN]
+        diagnol_mask = (kv_idx - q_idx) % Q_LEN == 0
+        return suffix_mask & padding_mask & diagnol_mask
+
+    mask_mod = or_masks(causal_mask, suffix_mask)
+    mask_mod.__name__ = f"packed_eagle3_mask_Q_{Q_LEN}_KV_{KV_LEN}_lck_{lck}"
+    return mask_mod
@@ -14,6 +14,7 @@ from specforge.modeling.draft.flex_attention import (
     compile_friendly_create_block_mask,
     compile_friendly_flex_attention,
     generate_eagle3_mask,
+    generate_packed_eagle3_mask,
 )
 from specforge.utils import print_with_rank
 
@@ -736,7 +737,7 @@ class LlamaFlexAttention(LlamaAttention):
     The used parameters are:
         - hidden_states: input hidden states
         - attention_mask: attention mask not expanded, straight from data loader.
-        - position_ids: position ids
+        - position_ids: position ids, they restart at 0 at the start of each document of packed rows.
         - past_key_values: dynamic cache used for storing past key and value states.
     """
 
@@ -801,10 +802,27 @@ class LlamaFlexAttention(LlamaAttention):
             cache_kwargs=cache_kwargs,
         )
 
-        seq_lengths = attention_mask.sum(dim=-1)
-        # Shrink the attention mask to align with the padding to the right.
-        # This is equivalent to the shrinking logic in eagle3.py
-        seq_lengths -= lck
+        if isinstance(self.rotary_emb, LlamaMutiRotaryEmbedding):
+            seq_lengths = attention_mask.sum(dim=-1)
+            # Shrink the attention mask to align with the padding to the right.
+            # This is equivalent to the shrinking logic in eagle3.py
+            seq_lengths -= lck
+            mask_mod = generate_eagle3_mask(
+                seq_lengths=seq_lengths,
+                Q_LEN=q_len,
+                KV_LEN=key_cache.shape[-2],
+                lck=lck,
+            )
+        else:
+            # The position ids restart at 0 at the start of each document of packed
+            # rows, a row which is not packed holds a single document.
+            mask_mod = generate_packed_eagle3_mask(
+                position_ids=position_ids.expand(bsz, -1),
+                attention_mask=attention_mask,
+                Q_LEN=q_len,
+                KV_LEN=key_cache.shape[-2],
+                lck=lck,
+            )
         # TODO: Remove the usage of uncompiled create_block_mask after
         # https://github.com/pytorch/pytorch/issues/160018
         if q_len <= 128:
@@ -815,12 +833,7 @@ class LlamaFlexAttention(LlamaAttention):
             flex_attention_func = compile_friendly_flex_attention
 
         block_mask = create_block_mask_func(
-            mask_mod=generate_eagle3_mask(
-                seq_lengths=seq_lengths,
-                Q_LEN=q_len,
-                KV_LEN=key_cache.shape[-2],
-                lck=lck,
-            ),
+            mask_mod=mask_mod,
             B=bsz,
             H=1,  # Rely on broadcast
             Q_LEN=q_len,
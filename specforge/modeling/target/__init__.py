@@ -1,17 +1,23 @@
 from .eagle3_target_model import (
     CustomEagle3TargetModel,
     Eagle3TargetModel,
+    Eagle3TargetOutput,
     HFEagle3TargetModel,
     SGLangEagle3TargetModel,
     get_eagle3_target_model,
 )
 from .target_head import TargetHead
+from .transport import Eagle3DataReceiver, Eagle3DataSender, get_num_transfer_steps
 
 __all__ = [
     "Eagle3TargetModel",
+    "Eagle3TargetOutput",
     "SGLangEagle3TargetModel",
     "HFEagle3TargetModel",
     "CustomEagle3TargetModel",
     "get_eagle3_target_model",
     "TargetHead",
+    "Eagle3DataSender",
+    "Eagle3DataReceiver",
+    "get_num_transfer_steps",
 ]
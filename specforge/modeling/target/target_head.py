@@ -81,10 +81,10 @@ class TargetHead(nn.Module):
     def forward(self, hidden_states):
         return self.fc(hidden_states)
 
-    def preprocess(self, input_ids, target, loss_mask):
+    def preprocess(self, input_ids, target, loss_mask, document_end=None):
         # apply pading
-        target = padding(target, left=False)
-        input_ids = padding(input_ids, left=False)
+        target = padding(target, left=False, document_end=document_end)
+        input_ids = padding(input_ids, left=False, document_end=document_end)
         loss_mask = loss_mask[..., None]
         loss_mask = loss_mask.to(target.device)
         return input_ids, target, loss_mask
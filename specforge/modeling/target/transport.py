@@ -0,0 +1,261 @@
+"""
+Transport of the target model outputs from the target ranks to the draft ranks of the
+disaggregated online training, see `init_distributed`.
+
+The producer p of P sends its outputs in order, and its output of step k, i.e. the chunk
+g = k * P + p, goes to the consumer g % C of C. Each consumer receives its chunks in the
+order of g, so both sides agree on the order of the messages of each pair of ranks
+without any other communication. A message is a fixed-size header of the dtypes and
+shapes of the tensors of an `Eagle3TargetOutput`, followed by the tensors, sent point to
+point with the default process group, i.e. NCCL for CUDA tensors, which uses NVLink or
+shared memory between the GPUs of a node, and gloo for CPU tensors.
+"""
+
+import dataclasses
+import math
+import queue
+import threading
+from collections import deque
+from typing import Deque, List, Optional, Tuple, Union
+
+import torch
+import torch.distributed as dist
+
+from .eagle3_target_model import Eagle3TargetOutput
+
+_FIELDS = [field.name for field in dataclasses.fields(Eagle3TargetOutput)]
+_DTYPES = [
+    torch.float32,
+    torch.bfloat16,
+    torch.float16,
+    torch.int64,
+    torch.int32,
+    torch.bool,
+    torch.uint8,
+    torch.int8,
+]
+_MAX_DIMS = 4
+# the dtype index, the number of dims and the dims of each field
+_FIELD_HEADER_SIZE = 2 + _MAX_DIMS
+
+
+def get_num_transfer_steps(
+    num_steps: int, num_producers: int, num_consumers: int
+) -> Tuple[int, int]:
+    """
+    Get the number of steps of an epoch of the producers and the consumers, such that
+    every consumer receives as many chunks.
+
+    Args:
+        num_steps: The number of batches of an epoch of the producers.
+        num_producers: The number of producer ranks.
+        num_consumers: The number of consumer ranks.
+
+    Returns:
+        The number of steps of the producers, which drop the last batches of the epoch
+        if needed, and the number of steps of the consumers.
+    """
+    period = num_consumers // math.gcd(num_producers, num_consumers)
+    producer_steps = num_steps - num_steps % period
+    return producer_steps, producer_steps * num_producers // num_consumers
+
+
+def _pack(
+    output: Eagle3TargetOutput, device: torch.device
+) -> Tuple[torch.Tensor, List[torch.Tensor]]:
+    header = torch.full((len(_FIELDS), _FIELD_HEADER_SIZE), -1, dtype=torch.int64)
+    tensors = []
+    for i, field in enumerate(_FIELDS):
+        tensor = getattr(output, field)
+        if tensor is None:
+            continue
+        if tensor.dim() > _MAX_DIMS:
+            raise ValueError(f"{field} has more than {_MAX_DIMS} dims")
+        header[i, 0] = _DTYPES.index(tensor.dtype)
+        header[i, 1] = tensor.dim()
+        header[i, 2 : 2 + tensor.dim()] = torch.tensor(tensor.shape)
+        tensors.append(tensor.to(device).contiguous())
+    return header.view(-1).to(device), tensors
+
+
+class Eagle3DataSender:
+    """
+    Send the target model outputs of a producer rank to the consumer ranks. Up to
+    `max_in_flight` outputs are held until the consumers receive them, a send waits for
+    the oldest one beyond that.
+    """
+
+    def __init__(
+        self,
+        producer_index: int,
+        num_producers: int,
+        consumer_ranks: List[int],
+        max_in_flight: int = 2,
+        device: Optional[Union[str, torch.device]] = None,
+    ):
+        """
+        Args:
+            producer_index: The index of this rank among the producers.
+            num_producers: The number of producer ranks.
+            consumer_ranks: The global ranks of the consumers.
+            max_in_flight: The number of outputs which may be in flight.
+            device: The device of the sent tensors, the current CUDA device if available.
+        """
+        assert max_in_flight >= 1, "max_in_flight must be at least 1"
+        if device is None:
+            device = (
+                torch.device("cuda", torch.cuda.current_device())
+                if torch.cuda.is_available()
+                else torch.device("cpu")
+            )
+        self.producer_index = producer_index
+        self.num_producers = num_producers
+        self.consumer_ranks = consumer_ranks
+        self.max_in_flight = max_in_flight
+        self.device = torch.device(device)
+        self.num_sent = 0
+        self._in_flight: Deque[Tuple[list, List[torch.Tensor]]] = deque()
+
+    @property
+    def next_chunk(self) -> int:
+        """The index g of the next chunk, see the module docstring."""
+        return self.num_sent * self.num_producers + self.producer_index
+
+    @property
+    def next_consumer_step(self) -> int:
+        """The number of chunks the consumer of the next chunk will have received."""
+        return self.next_chunk // len(self.consumer_ranks)
+
+    def send(self, output: Eagle3TargetOutput) -> None:
+        """
+        Start sending an output to its consumer.
+
+        Args:
+            output: The target model output of the next step of this rank.
+        """
+        dst = self.consumer_ranks[self.next_chunk % len(self.consumer_ranks)]
+        header, tensors = _pack(output, self.device)
+        # the tensors must be kept alive until they are sent
+        tensors = [header] + tensors
+        works = [dist.isend(tensor, dst) for tensor in tensors]
+        self._in_flight.append((works, tensors))
+        self.num_sent += 1
+        while len(self._in_flight) > self.max_in_flight:
+            self._wait_oldest()
+
+    def _wait_oldest(self) -> None:
+        works, _ = self._in_flight.popleft()
+        for work in works:
+            work.wait()
+
+    def flush(self) -> None:
+        """Wait for all the outputs to be received."""
+        while self._in_flight:
+            self._wait_oldest()
+
+
+class Eagle3DataReceiver:
+    """
+    Receive the target model outputs of a consumer rank from the producer ranks, and
+    iterate over those of an epoch. A background thread receives the outputs in order
+    into a queue of `max_in_flight` outputs, which bounds the memory they hold, and the
+    producers wait when it is full.
+    """
+
+    def __init__(
+        self,
+        consumer_index: int,
+        num_consumers: int,
+        producer_ranks: List[int],
+        num_steps: int,
+        max_steps: int,
+        max_in_flight: int = 2,
+        device: Optional[Union[str, torch.device]] = None,
+    ):
+        """
+        Args:
+            consumer_index: The index of this rank among the consumers.
+            num_consumers: The number of consumer ranks.
+            producer_ranks: The global ranks of the producers.
+            num_steps: The number of outputs of an epoch.
+            max_steps: The total number of outputs to receive.
+            max_in_flight: The number of received outputs which may be queued.
+            device: The device of the received tensors, the current CUDA device if available.
+        """
+        assert max_in_flight >= 1, "max_in_flight must be at least 1"
+        if device is None:
+            device = (
+                torch.device("cuda", torch.cuda.current_device())
+                if torch.cuda.is_available()
+                else torch.device("cpu")
+            )
+        self.consumer_index = consumer_index
+        self.num_consumers = num_consumers
+        self.producer_ranks = producer_ranks
+        self.num_steps = num_steps
+        self.max_steps = max_steps
+        self.device = torch.device(device)
+        self.stream = (
+            torch.cuda.Stream(device=self.device)
+            if self.device.type == "cuda"
+            else None
+        )
+        self._queue = queue.Queue(maxsize=max_in_flight)
+        self._thread = threading.Thread(target=self._receive_all, daemon=True)
+        self._thread.start()
+
+    def __len__(self) -> int:
+        return self.num_steps
+
+    def _receive(self, src: int) -> Eagle3TargetOutput:
+        header = torch.empty(
+            len(_FIELDS) * _FIELD_HEADER_SIZE, dtype=torch.int64, device=self.device
+        )
+        dist.recv(header, src)
+        fields = {}
+        field_headers = header.view(len(_FIELDS), -1).tolist()
+        for field, field_header in zip(_FIELDS, field_headers):
+            dtype_index, ndim = field_header[:2]
+            if dtype_index < 0:
+                fields[field] = None
+                continue
+            fields[field] = torch.empty(
+                field_header[2 : 2 + ndim],
+                dtype=_DTYPES[dtype_index],
+                device=self.device,
+            )
+            dist.recv(fields[field], src)
+        return Eagle3TargetOutput(**fields)
+
+    def _receive_all(self) -> None:
+        try:
+            if self.stream is not None:
+                # the current device and stream are set per thread
+                torch.cuda.set_device(self.device)
+                torch.cuda.set_stream(self.stream)
+            for step in range(self.max_steps):
+                chunk = step * self.num_consumers + self.consumer_index
+                src = self.producer_ranks[chunk % len(self.producer_ranks)]
+                output = self._receive(src)
+                if self.stream is not None:
+                    # the output is complete when it is handed to the trainer
+                    self.stream.synchronize()
+                self._queue.put(output)
+        except Exception as e:
+            self._queue.put(e)
+
+    def _record_stream(self, output: Eagle3TargetOutput) -> None:
+        # the tensors are allocated on the side stream but used on the current stream
+        for field in _FIELDS:
+            tensor = getattr(output, field)
+            if tensor is not None:
+                tensor.record_stream(torch.cuda.current_stream(self.device))
+
+    def __iter__(self):
+        for _ in range(self.num_steps):
+            output = self._queue.get()
+            if isinstance(output, Exception):
+                raise output
+            if self.stream is not None:
+                self._record_stream(output)
+            yield output
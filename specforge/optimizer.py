@@ -55,11 +55,21 @@ class BF16Optimizer:
         print_on_rank0("Successfully loaded optimizer state_dict.")
         self.scheduler.load_state_dict(state_dict["scheduler_state_dict"])
         print_on_rank0("Successfully loaded scheduler state_dict.")
+        if "fp32_params" in state_dict:
+            # the bf16 weights of the checkpoint lost the low bits of the master weights
+            with torch.no_grad():
+                for p, mp, saved in zip(
+                    self.model_params, self.fp32_params, state_dict["fp32_params"]
+                ):
+                    mp.data.copy_(saved)
+                    p.data.copy_(mp.data.to(p.dtype))
+            print_on_rank0("Successfully loaded fp32 master weights.")
 
     def state_dict(self):
         return {
             "optimizer_state_dict": self.optimizer.state_dict(),
             "scheduler_state_dict": self.scheduler.state_dict(),
+            "fp32_params": [mp.detach() for mp in self.fp32_params],
         }
 
     def get_learning_rate(self):
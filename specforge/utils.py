@@ -1,9 +1,11 @@
 import json
 import logging
 import os
+import random
 import re
 from contextlib import contextmanager
 
+import numpy as np
 import torch
 import torch.distributed as dist
 from torch.distributed._tensor import DTensor, Shard, distribute_tensor
@@ -33,15 +35,38 @@ def default_torch_dtype(dtype: torch.dtype):
 
 
 @torch.no_grad()
-def padding(tensor, left=True):
+def padding(tensor, left=True, document_end=None):
     zeropadding = torch.zeros_like(tensor[:, -1:])
     if left:
         tensor = torch.cat((zeropadding, tensor[:, :-1]), dim=1)
     else:
         tensor = torch.cat((tensor[:, 1:], zeropadding), dim=1)
+        if document_end is not None:
+            # the last token of each document of packed rows is padded instead of
+            # taking the first token of the next document
+            document_end = document_end.view(
+                *document_end.shape, *[1] * (tensor.dim() - document_end.dim())
+            )
+            tensor = tensor.masked_fill(document_end, 0)
     return tensor
 
 
+def get_document_end_mask(position_ids):
+    """
+    Get the mask of the last token of each document of packed rows, whose position ids
+    restart at 0 at the start of each document.
+
+    Args:
+        position_ids: (batch, seq_len)
+
+    Returns:
+        A boolean tensor of shape (batch, seq_len).
+    """
+    document_end = torch.ones_like(position_ids, dtype=torch.bool)
+    document_end[:, :-1] = position_ids[:, 1:] == 0
+    return document_end
+
+
 def load_config_from_file(config_path: str):
     with open(config_path, "r") as f:
         config = json.load(f)
@@ -63,7 +88,8 @@ def print_on_rank0(message):
 
 def get_last_checkpoint(folder, prefix="epoch"):
     content = os.listdir(folder)
-    _re_checkpoint = re.compile(r"^" + prefix + r"_(\d+)$")
+    # the checkpoints are saved as epoch_{epoch}_step_{global_step}
+    _re_checkpoint = re.compile(r"^" + prefix + r"_(\d+)(?:_step_(\d+))?$")
     checkpoints = [
         path
         for path in content
@@ -74,10 +100,36 @@ def get_last_checkpoint(folder, prefix="epoch"):
         return
     return os.path.join(
         folder,
-        max(checkpoints, key=lambda x: int(_re_checkpoint.search(x).groups()[0])),
+        max(
+            checkpoints,
+            key=lambda x: tuple(
+                int(group or 0) for group in _re_checkpoint.search(x).groups()
+            ),
+        ),
     )
 
 
+def get_rng_state():
+    """Get the states of the python, numpy, torch and CUDA random number generators."""
+    rng_state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        rng_state["cuda"] = torch.cuda.get_rng_state()
+    return rng_state
+
+
+def set_rng_state(rng_state):
+    """Restore the random number generators from the output of `get_rng_state`."""
+    random.setstate(rng_state["python"])
+    np.random.set_state(rng_state["numpy"])
+    torch.set_rng_state(rng_state["torch"])
+    if "cuda" in rng_state and torch.cuda.is_available():
+        torch.cuda.set_rng_state(rng_state["cuda"])
+
+
 def generate_draft_model_config(
     target_model_path: str, template_config_path: str = None, cache_dir: str = None
 ):
@@ -0,0 +1,66 @@
+import unittest
+
+import torch
+from torch.utils.data import DataLoader
+
+from specforge.data.utils import DataCollatorWithPadding
+
+
+def make_features(seq_lens):
+    return [
+        {
+            "input_ids": torch.arange(1, n + 1)[None, :],
+            "attention_mask": torch.ones(1, n, dtype=torch.long),
+            "loss_mask": torch.ones(1, n, dtype=torch.long),
+            "hidden_state": torch.randn(1, n, 6, dtype=torch.bfloat16),
+            "target": torch.randn(1, n, 2, dtype=torch.bfloat16),
+            "hidden_state_scale": torch.rand(1, 1, 6),
+        }
+        for n in seq_lens
+    ]
+
+
+class TestDataCollatorWithPadding(unittest.TestCase):
+
+    def test_padding(self):
+        features = make_features([3, 7, 5])
+        batch = DataCollatorWithPadding()(features)
+        self.assertEqual(tuple(batch["input_ids"].shape), (3, 7))
+        self.assertEqual(tuple(batch["hidden_state"].shape), (3, 7, 6))
+        self.assertEqual(batch["hidden_state"].dtype, torch.bfloat16)
+        # per-channel scales are stacked
+        self.assertEqual(tuple(batch["hidden_state_scale"].shape), (3, 1, 6))
+        for i, item in enumerate(features):
+            n = item["input_ids"].shape[1]
+            self.assertTrue(
+                torch.equal(batch["input_ids"][i, :n], item["input_ids"][0])
+            )
+            self.assertTrue(torch.all(batch["input_ids"][i, n:] == 0))
+            self.assertTrue(torch.all(batch["attention_mask"][i, n:] == 0))
+            self.assertTrue(torch.equal(batch["target"][i, :n], item["target"][0]))
+            self.assertTrue(torch.all(batch["target"][i, n:] == 0))
+
+    def test_pad_to_multiple_of(self):
+        collator = DataCollatorWithPadding(pad_to_multiple_of=8)
+        self.assertEqual(collator(make_features([3, 7]))["input_ids"].shape[1], 8)
+        self.assertEqual(collator(make_features([8]))["input_ids"].shape[1], 8)
+        self.assertEqual(collator(make_features([9]))["loss_mask"].shape[1], 16)
+
+    def test_worker(self):
+        features = make_features([4, 6, 2, 5])
+        # the batches of the workers are allocated in shared memory
+        dataloader = DataLoader(
+            features,
+            batch_size=2,
+            num_workers=1,
+            collate_fn=DataCollatorWithPadding(),
+        )
+        for i, batch in enumerate(dataloader):
+            expected = DataCollatorWithPadding()(features[2 * i : 2 * i + 2])
+            self.assertTrue(batch["hidden_state"].is_shared())
+            for key, value in expected.items():
+                self.assertTrue(torch.equal(batch[key], value), key)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,74 @@
+import pickle
+import tempfile
+import unittest
+from unittest import mock
+
+import torch
+
+from specforge.data import compact
+from specforge.data.compact import (
+    CompactEagle3Dataset,
+    is_compact_dataset,
+    write_compact_dataset,
+)
+from specforge.data.preprocessing import count_masked_tokens
+from specforge.data.utils import get_sample_lengths
+
+from .test_vocab_mapping import make_dataset
+
+
+class TestCompactDataset(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.output_dir = self.tmp_dir.name
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_round_trip(self):
+        dataset = make_dataset(37, vocab_size=300)
+        # small batches so that the loss mask bits are carried across the batches
+        with mock.patch.object(compact, "_WRITE_BATCH_SIZE", 5):
+            write_compact_dataset(dataset, self.output_dir)
+        self.assertTrue(is_compact_dataset(self.output_dir))
+
+        compact_dataset = CompactEagle3Dataset(self.output_dir)
+        self.assertEqual(len(compact_dataset), len(dataset))
+        self.assertEqual(
+            compact_dataset.lengths, [item["input_ids"].shape[1] for item in dataset]
+        )
+        self.assertEqual(
+            get_sample_lengths(compact_dataset, 3, 10), compact_dataset.lengths[3:10]
+        )
+        for i, item in enumerate(dataset):
+            sample = compact_dataset[i]
+            self.assertTrue(torch.equal(sample["input_ids"], item["input_ids"]))
+            self.assertTrue(torch.equal(sample["loss_mask"], item["loss_mask"]))
+            self.assertTrue(sample["attention_mask"].eq(1).all())
+            self.assertEqual(sample["attention_mask"].shape, item["input_ids"].shape)
+
+        # the buffers are opened again in the unpickled dataset
+        unpickled = pickle.loads(pickle.dumps(compact_dataset))
+        self.assertIsNone(unpickled._input_ids)
+        self.assertTrue(torch.equal(unpickled[5]["loss_mask"], dataset[5]["loss_mask"]))
+
+    def test_count_masked_tokens(self):
+        dataset = make_dataset(40, vocab_size=300)
+        write_compact_dataset(dataset, self.output_dir)
+        compact_dataset = CompactEagle3Dataset(self.output_dir)
+        expected = count_masked_tokens(dataset, 300)
+        # chunks which do not start at the beginning of a sample
+        with mock.patch.object(compact, "_COUNT_CHUNK_SIZE", 16):
+            self.assertTrue(
+                torch.equal(count_masked_tokens(compact_dataset, 300), expected)
+            )
+        # the counts are extended for the tokens out of the given vocab size
+        token_counts = count_masked_tokens(compact_dataset, 10)
+        self.assertTrue(torch.equal(token_counts, expected[: len(token_counts)]))
+        self.assertEqual(expected[len(token_counts) :].sum().item(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
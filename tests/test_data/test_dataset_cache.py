@@ -0,0 +1,102 @@
+import tempfile
+import unittest
+
+import numpy as np
+from datasets import Dataset
+
+from specforge.data.cache import (
+    MISSING_ROW,
+    ROW_HASH_COLUMN,
+    SKIPPED_ROW,
+    ProcessedDatasetCache,
+    get_dataset_key,
+    hash_rows,
+)
+
+
+def process(examples, indices, row_hashes):
+    # a stand-in for the tokenization, which skips the empty conversations
+    kept = [i for i, text in enumerate(examples["text"]) if text]
+    return {
+        "length": [len(examples["text"][i]) for i in kept],
+        ROW_HASH_COLUMN: [int(row_hashes[indices[i]]) for i in kept],
+    }
+
+
+class TestDatasetCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = self.tmp_dir.name
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _build(self, texts):
+        dataset = Dataset.from_dict({"text": texts, "source": ["a"] * len(texts)})
+        row_hashes = hash_rows(dataset)
+        cache = ProcessedDatasetCache(self.cache_dir, "fingerprint")
+        new_rows = np.flatnonzero(cache.lookup(row_hashes) == MISSING_ROW)
+        if len(new_rows) > 0:
+            new_row_hashes = row_hashes[new_rows]
+            cache.process(
+                dataset.select(new_rows),
+                lambda examples, indices: process(examples, indices, new_row_hashes),
+                new_row_hashes,
+                with_indices=True,
+                remove_columns=dataset.column_names,
+            )
+        key = get_dataset_key("fingerprint", row_hashes)
+        return cache, cache.select(row_hashes), key
+
+    def test_hash_rows(self):
+        dataset = Dataset.from_dict({"a": ["x", "y", "x"], "b": [1, 2, 1]})
+        row_hashes = hash_rows(dataset)
+        self.assertEqual(row_hashes.dtype, np.int64)
+        self.assertEqual(row_hashes[0], row_hashes[2])
+        self.assertNotEqual(row_hashes[0], row_hashes[1])
+        # the hash does not depend on the column order
+        reordered = Dataset.from_dict({"b": [1, 2, 1], "a": ["x", "y", "x"]})
+        self.assertTrue(np.array_equal(hash_rows(reordered), row_hashes))
+
+    def test_incremental(self):
+        texts = ["a", "bb", "", "cccc", "ddddd"]
+        cache, dataset, key = self._build(texts)
+        self.assertEqual(len(cache.shards), 1)
+        # the empty row is skipped
+        self.assertEqual(dataset["length"], [1, 2, 4, 5])
+        self.assertEqual(dataset.column_names, ["length"])
+
+        # the same rows are loaded from the cache, including the skipped empty row
+        cache, dataset, same_key = self._build(texts)
+        self.assertEqual(len(cache.shards), 1)
+        self.assertEqual(same_key, key)
+        row_hashes = hash_rows(Dataset.from_dict({"text": texts, "source": ["a"] * 5}))
+        self.assertEqual(cache.lookup(row_hashes)[2], SKIPPED_ROW)
+
+        # only the edited and appended rows are processed
+        texts[1] = "bbb"
+        texts.append("eeeeee")
+        cache, dataset, new_key = self._build(texts)
+        self.assertEqual(len(cache.shards), 2)
+        self.assertEqual(len(cache.shards[1]), 2)
+        self.assertNotEqual(new_key, key)
+        self.assertEqual(dataset["length"], [1, 3, 4, 5, 6])
+
+        # the order of the rows is kept
+        _, dataset, reversed_key = self._build(texts[::-1])
+        self.assertEqual(dataset["length"], [6, 5, 4, 3, 1])
+        self.assertNotEqual(reversed_key, new_key)
+
+    def test_all_rows_skipped(self):
+        cache, dataset, _ = self._build(["", ""])
+        self.assertEqual(len(cache.shards), 0)
+        self.assertIsNone(dataset)
+        # the skipped rows are not processed again
+        cache = ProcessedDatasetCache(self.cache_dir, "fingerprint")
+        row_hashes = hash_rows(Dataset.from_dict({"text": [""], "source": ["a"]}))
+        self.assertEqual(cache.lookup(row_hashes).tolist(), [SKIPPED_ROW])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,65 @@
+import random
+import unittest
+
+from specforge.data.utils import LengthGroupedDistributedSampler
+
+
+class TestLengthGroupedDistributedSampler(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(0)
+        self.lengths = [rng.randint(10, 2000) for _ in range(1000)]
+
+    def _make_samplers(self, num_replicas, batch_size=4, megabatch_multiplier=8):
+        return [
+            LengthGroupedDistributedSampler(
+                self.lengths,
+                batch_size,
+                num_replicas=num_replicas,
+                rank=rank,
+                megabatch_multiplier=megabatch_multiplier,
+            )
+            for rank in range(num_replicas)
+        ]
+
+    def test_ranks(self):
+        num_replicas, batch_size = 3, 4
+        samplers = self._make_samplers(num_replicas, batch_size)
+        rank_indices = [list(sampler) for sampler in samplers]
+        # all the ranks run as many steps and each sample is read once
+        self.assertTrue(
+            all(len(indices) == len(samplers[0]) for indices in rank_indices)
+        )
+        all_indices = [i for indices in rank_indices for i in indices]
+        self.assertEqual(len(all_indices), len(set(all_indices)))
+        self.assertEqual(len(all_indices), 1000 // 12 * 12)
+
+        # the longest samples of a step are spread over the ranks
+        for start in range(0, len(samplers[0]), batch_size):
+            step_lengths = [
+                [self.lengths[i] for i in indices[start : start + batch_size]]
+                for indices in rank_indices
+            ]
+            max_lengths = [max(lengths) for lengths in step_lengths]
+            all_lengths = sorted(sum(step_lengths, []))
+            self.assertGreaterEqual(min(max_lengths), all_lengths[-num_replicas])
+
+    def test_padding_ratio(self):
+        grouped = self._make_samplers(2)[0]
+        # a megabatch of one global batch is only sorted within the step
+        ungrouped = self._make_samplers(2, megabatch_multiplier=1)[0]
+        self.assertLess(grouped.get_padding_ratio(), 0.15)
+        self.assertGreater(ungrouped.get_padding_ratio(), 0.3)
+
+    def test_epoch(self):
+        sampler = self._make_samplers(2)[1]
+        indices = list(sampler)
+        self.assertEqual(list(sampler), indices)
+        sampler.set_epoch(1)
+        self.assertNotEqual(list(sampler), indices)
+        sampler.set_epoch(0)
+        self.assertEqual(list(sampler), indices)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
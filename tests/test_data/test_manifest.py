@@ -0,0 +1,156 @@
+import os
+import tempfile
+import unittest
+import zlib
+
+import torch
+
+from specforge.data.manifest import (
+    ManifestEntry,
+    ManifestWriter,
+    get_partial_manifest_path,
+    load_manifest,
+    merge_manifests,
+    verify_manifest,
+)
+from specforge.data.preprocessing import (
+    OfflineEagle3Dataset,
+    PackedOfflineEagle3Dataset,
+    build_offline_eagle3_dataset,
+)
+from specforge.data.shard import ShardReader, ShardWriter
+
+from .test_shard import make_sample
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.output_dir = self.tmp_dir.name
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _save_ckpt(self, sample_id, sample):
+        path = os.path.join(self.output_dir, f"data_{sample_id}.ckpt")
+        torch.save(
+            {
+                "input_ids": sample["input_ids"],
+                "loss_mask": sample["loss_mask"],
+                "hidden_state": sample["hidden_state"][None],
+                "aux_hidden_state": sample["aux_hidden_state"][None],
+            },
+            path,
+        )
+        with open(path, "rb") as f:
+            checksum = zlib.crc32(f.read())
+        return ManifestEntry(
+            sample_id=sample_id,
+            path=os.path.basename(path),
+            num_tokens=sample["input_ids"].shape[0],
+            num_loss_tokens=int(sample["loss_mask"].sum()),
+            checksum=checksum,
+        )
+
+    def test_ckpt_manifest(self):
+        seq_lens = [6, 9, 4, 11]
+        # two DP ranks write their partial manifests
+        for dp_rank in range(2):
+            writer = ManifestWriter(get_partial_manifest_path(self.output_dir, dp_rank))
+            for sample_id in range(dp_rank, len(seq_lens), 2):
+                sample = make_sample(seq_lens[sample_id])
+                writer.add(self._save_ckpt(sample_id, sample))
+            writer.close()
+
+        # a resumed writer keeps the entries of the previous run
+        writer = ManifestWriter(get_partial_manifest_path(self.output_dir, 0))
+        self.assertEqual(set(writer.entries), {0, 2})
+        writer.close()
+
+        merge_manifests(
+            [get_partial_manifest_path(self.output_dir, i) for i in range(2)],
+            self.output_dir,
+        )
+        entries = load_manifest(self.output_dir)
+        self.assertEqual([entry.sample_id for entry in entries], [0, 1, 2, 3])
+        self.assertEqual(verify_manifest(self.output_dir, entries), [])
+
+        dataset = build_offline_eagle3_dataset(self.output_dir)
+        self.assertIsInstance(dataset, OfflineEagle3Dataset)
+        self.assertEqual(dataset.lengths, seq_lens)
+        self.assertEqual(dataset[3]["input_ids"].shape, (1, 11))
+
+        # corrupt one file
+        with open(os.path.join(self.output_dir, entries[1].path), "ab") as f:
+            f.write(b"\0")
+        corrupted = verify_manifest(self.output_dir, entries)
+        self.assertEqual([entry.sample_id for entry in corrupted], [1])
+
+    def test_journal_recovery(self):
+        manifest_path = get_partial_manifest_path(self.output_dir, 0)
+        writer = ManifestWriter(manifest_path, sync_interval=2)
+        for sample_id in range(3):
+            writer.add(self._save_ckpt(sample_id, make_sample(4)))
+        writer.close()
+        # simulate a crash in the middle of writing an entry
+        with open(manifest_path, "a") as f:
+            f.write('{"sample_id": 3, "pa')
+
+        writer = ManifestWriter(manifest_path)
+        self.assertEqual(list(writer.entries), [0, 1, 2])
+        # the truncated line is removed, so the next entry can be appended
+        writer.add(self._save_ckpt(3, make_sample(4)))
+
+        # the sample 1 did not reach the disk, it is detected and removed from the journal
+        os.remove(os.path.join(self.output_dir, writer.entries[1].path))
+        corrupted = verify_manifest(self.output_dir, list(writer.entries.values()))
+        writer.discard([entry.sample_id for entry in corrupted])
+        self.assertEqual(list(writer.entries), [0, 2, 3])
+        writer.add(self._save_ckpt(1, make_sample(4)))
+        writer.close()
+
+        writer = ManifestWriter(manifest_path)
+        self.assertEqual(list(writer.entries), [0, 2, 3, 1])
+        self.assertEqual(
+            verify_manifest(self.output_dir, list(writer.entries.values())), []
+        )
+        writer.close()
+
+    def test_packed_manifest(self):
+        seq_lens = [5, 8, 3]
+        shard_writer = ShardWriter(self.output_dir, samples_per_shard=2)
+        for sample_id, seq_len in enumerate(seq_lens):
+            shard_writer.write(sample_id, make_sample(seq_len))
+        shard_writer.close()
+
+        writer = ManifestWriter(get_partial_manifest_path(self.output_dir, 0))
+        for shard_dir in sorted(os.listdir(self.output_dir)):
+            if not shard_dir.startswith("shard_"):
+                continue
+            reader = ShardReader(os.path.join(self.output_dir, shard_dir))
+            for index, sample_id in enumerate(reader.sample_ids):
+                writer.add(
+                    ManifestEntry(
+                        sample_id=sample_id,
+                        path=shard_dir,
+                        num_tokens=seq_lens[sample_id],
+                        num_loss_tokens=0,
+                        checksum=reader.checksums[index],
+                        index=index,
+                    )
+                )
+        writer.close()
+        merge_manifests([writer.manifest_path], self.output_dir)
+
+        entries = load_manifest(self.output_dir)
+        self.assertEqual(verify_manifest(self.output_dir, entries), [])
+        dataset = build_offline_eagle3_dataset(self.output_dir)
+        self.assertIsInstance(dataset, PackedOfflineEagle3Dataset)
+        self.assertEqual(dataset.lengths, seq_lens)
+        self.assertEqual(dataset[2]["input_ids"].shape, (1, 3))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,105 @@
+import unittest
+
+import torch
+
+from specforge.data.utils import DataCollatorWithPacking, PackedBatchSampler
+from specforge.utils import get_document_end_mask, padding
+
+
+class TestPackedBatchSampler(unittest.TestCase):
+
+    def test_rows_fit_max_tokens(self):
+        lengths = [5, 100, 30, 30, 7, 64, 12, 300, 1, 30, 90, 40]
+        sampler = PackedBatchSampler(lengths, max_tokens=128, shuffle=False)
+
+        rows = list(sampler)
+        self.assertEqual(len(sampler), len(rows))
+        self.assertEqual(sorted(i for row in rows for i in row), list(range(12)))
+        for row in rows:
+            # a sample longer than a row has a row of its own
+            self.assertTrue(sum(lengths[i] for i in row) <= 128 or len(row) == 1)
+        # the samples are packed into fewer rows than the batches of one sample
+        self.assertEqual(len(rows), 5)
+
+    def test_distributed(self):
+        lengths = [(i * 37) % 100 + 1 for i in range(50)]
+        rows = list(PackedBatchSampler(lengths, max_tokens=128, shuffle=False))
+        num_replicas = 3
+        samplers = [
+            PackedBatchSampler(
+                lengths, max_tokens=128, num_replicas=num_replicas, rank=rank, seed=1
+            )
+            for rank in range(num_replicas)
+        ]
+        rank_rows = [list(sampler) for sampler in samplers]
+        # all the ranks run as many steps and the rows are dealt without overlap
+        self.assertTrue(
+            all(len(r) == len(rows) // num_replicas for r in rank_rows), rank_rows
+        )
+        packed = sorted(tuple(row) for r in rank_rows for row in r)
+        self.assertEqual(len(packed), len(set(packed)))
+        self.assertTrue(set(packed) <= set(tuple(row) for row in rows))
+
+        # the order is reproducible and changes with the epoch
+        self.assertEqual(list(samplers[0]), rank_rows[0])
+        samplers[0].set_epoch(1)
+        self.assertNotEqual(list(samplers[0]), rank_rows[0])
+
+
+class TestDataCollatorWithPacking(unittest.TestCase):
+
+    def test_collate(self):
+        features = []
+        for n in [3, 2, 4]:
+            features.append(
+                {
+                    "input_ids": torch.arange(n)[None, :] + 10 * n,
+                    "attention_mask": torch.ones(1, n, dtype=torch.long),
+                    "loss_mask": torch.ones(1, n, dtype=torch.long),
+                    "hidden_state": torch.randn(1, n, 6),
+                    "target": torch.randn(1, n, 2),
+                }
+            )
+        batch = DataCollatorWithPacking()(features)
+
+        self.assertEqual(batch["input_ids"].shape, (1, 9))
+        self.assertEqual(batch["hidden_state"].shape, (1, 9, 6))
+        self.assertEqual(batch["position_ids"].tolist(), [[0, 1, 2, 0, 1, 0, 1, 2, 3]])
+        self.assertTrue(torch.equal(batch["target"][:, 3:5], features[1]["target"]))
+
+        # the shift does not move tokens across the documents
+        document_end = get_document_end_mask(batch["position_ids"])
+        self.assertEqual(document_end.long().tolist(), [[0, 0, 1, 0, 1, 0, 0, 0, 1]])
+        shifted = padding(batch["input_ids"], left=False, document_end=document_end)
+        self.assertEqual(shifted.tolist(), [[31, 32, 0, 21, 0, 41, 42, 43, 0]])
+        shifted = padding(batch["target"], left=False, document_end=document_end)
+        self.assertTrue(torch.equal(shifted[:, 3], features[1]["target"][:, 1]))
+        self.assertTrue(torch.equal(shifted[:, 4], torch.zeros(1, 2)))
+
+    def test_scales(self):
+        def make_features(granularity):
+            return [
+                {
+                    "input_ids": torch.ones(1, n, dtype=torch.long),
+                    "attention_mask": torch.ones(1, n, dtype=torch.long),
+                    "loss_mask": torch.ones(1, n, dtype=torch.long),
+                    "hidden_state": torch.ones(1, n, 6, dtype=torch.int8),
+                    "hidden_state_scale": (
+                        torch.ones(1, n, 3)
+                        if granularity == "per_token"
+                        else torch.ones(1, 1, 6)
+                    ),
+                    "quantize_granularity": granularity,
+                }
+                for n in [5, 1]
+            ]
+
+        # the per-token scales of a one-token sample are packed like the others
+        batch = DataCollatorWithPacking()(make_features("per_token"))
+        self.assertEqual(batch["hidden_state_scale"].shape, (1, 6, 3))
+        with self.assertRaises(ValueError):
+            DataCollatorWithPacking()(make_features("per_channel"))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
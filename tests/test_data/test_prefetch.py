@@ -0,0 +1,102 @@
+import unittest
+
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from specforge.data.prefetch import BatchPrefetcher, TargetPrefetcher
+
+
+def collate(items):
+    inputs, labels = zip(*items)
+    return {"input_ids": torch.stack(inputs), "labels": list(labels), "meta": None}
+
+
+class TestBatchPrefetcher(unittest.TestCase):
+
+    def _build_dataloader(self):
+        dataset = TensorDataset(torch.arange(40).view(10, 4), torch.arange(10))
+        return DataLoader(dataset, batch_size=3, collate_fn=collate)
+
+    def _check(self, device):
+        dataloader = self._build_dataloader()
+        for num_prefetch in [1, 2, 5]:
+            prefetcher = BatchPrefetcher(
+                dataloader, device=device, num_prefetch=num_prefetch
+            )
+            self.assertEqual(len(prefetcher), len(dataloader))
+            self.assertIs(prefetcher.sampler, dataloader.sampler)
+
+            batches = list(prefetcher)
+            expected = list(dataloader)
+            self.assertEqual(len(batches), len(expected))
+            for batch, expected_batch in zip(batches, expected):
+                self.assertEqual(batch["input_ids"].device.type, device)
+                self.assertTrue(
+                    torch.equal(batch["input_ids"].cpu(), expected_batch["input_ids"])
+                )
+                self.assertEqual(
+                    [label.item() for label in batch["labels"]],
+                    [label.item() for label in expected_batch["labels"]],
+                )
+                self.assertIsNone(batch["meta"])
+            self.assertGreaterEqual(prefetcher.wait_time, prefetcher.last_wait_time)
+
+    def test_cpu(self):
+        self._check("cpu")
+
+    @unittest.skipUnless(torch.cuda.is_available(), "CUDA is not available")
+    def test_cuda(self):
+        self._check("cuda")
+
+
+class TestTargetPrefetcher(unittest.TestCase):
+
+    def _check(self, device, use_thread):
+        dataset = TensorDataset(torch.arange(40).view(10, 4), torch.arange(10))
+        dataloader = DataLoader(dataset, batch_size=3, collate_fn=collate)
+        for num_prefetch in [1, 3]:
+            generated = []
+
+            def generate(batch):
+                generated.append(batch["input_ids"][0, 0].item())
+                return batch["input_ids"].to(device) * 2
+
+            prefetcher = TargetPrefetcher(
+                dataloader,
+                generate,
+                num_prefetch=num_prefetch,
+                use_thread=use_thread,
+                device=device,
+            )
+            self.assertEqual(len(prefetcher), len(dataloader))
+            self.assertIs(prefetcher.sampler, dataloader.sampler)
+
+            expected = list(dataloader)
+            num_batches = 0
+            for i, (batch, output) in enumerate(prefetcher):
+                # the outputs in flight are bounded
+                self.assertLessEqual(len(generated), i + 1 + num_prefetch)
+                self.assertTrue(
+                    torch.equal(batch["input_ids"], expected[i]["input_ids"])
+                )
+                self.assertEqual(output.device.type, device)
+                self.assertTrue(torch.equal(output.cpu(), batch["input_ids"] * 2))
+                num_batches += 1
+            self.assertEqual(num_batches, len(expected))
+            self.assertEqual(generated, [0, 12, 24, 36])
+            self.assertGreater(prefetcher.target_time, 0)
+            self.assertGreaterEqual(prefetcher.overlap, 0)
+            self.assertLessEqual(prefetcher.overlap, 1)
+
+    def test_cpu(self):
+        self._check("cpu", use_thread=False)
+        self._check("cpu", use_thread=True)
+
+    @unittest.skipUnless(torch.cuda.is_available(), "CUDA is not available")
+    def test_cuda(self):
+        self._check("cuda", use_thread=False)
+        self._check("cuda", use_thread=True)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -171,6 +171,50 @@ class TestPreprocessing(unittest.TestCase):
             f"Assistant text does not match exactly. Expected: {repr(expected_assistant_text)}, Got: {repr(assistant_text)}",
         )
 
+    def test_batched_tokenization(self):
+        """Test that tokenizing a batch gives the same results as one conversation at a time."""
+        conversations = [
+            [
+                {"role": "user", "content": "What is 2+2?"},
+                {"role": "assistant", "content": "The answer is 4."},
+                {"role": "user", "content": "Are you sure?"},
+                {"role": "assistant", "content": "Yes, I'm certain."},
+            ],
+            None,
+            [
+                {"role": "user", "content": "Tell me about Python."},
+                {"role": "assistant", "content": "Python is a language. " * 100},
+            ],
+            [
+                {"role": "user", "content": "Hi"},
+                {"role": "assistant", "content": "Hello!"},
+            ],
+        ]
+
+        batch_results = preprocess_conversations(
+            tokenizer=self.tokenizer,
+            conversations=conversations,
+            chat_template=self.chat_template,
+            max_length=self.max_length,
+        )
+        self.assertEqual(len(batch_results["input_ids"]), 3)
+
+        sample_results = [
+            preprocess_conversations(
+                tokenizer=self.tokenizer,
+                conversations=[conversation],
+                chat_template=self.chat_template,
+                max_length=self.max_length,
+            )
+            for conversation in conversations
+            if conversation
+        ]
+        for i, results in enumerate(sample_results):
+            for key in ["input_ids", "loss_mask", "attention_mask"]:
+                self.assertTrue(torch.equal(batch_results[key][i], results[key][0]))
+        # the second conversation is truncated
+        self.assertEqual(batch_results["input_ids"][1].shape[1], self.max_length)
+
     def test_preformatted_conversation(self):
         """Test preprocessing of pre-formatted conversation strings."""
         preformatted_conversations = [
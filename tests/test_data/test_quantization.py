@@ -0,0 +1,112 @@
+import unittest
+
+import torch
+
+from specforge.data.preprocessing import OfflineEagle3Dataset
+from specforge.data.quantization import (
+    compute_quantization_error,
+    dequantize_hidden_states,
+    quantize_hidden_states,
+)
+from specforge.data.utils import DataCollatorWithPadding
+
+
+class TestQuantization(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.hidden_states = torch.randn(64, 96, dtype=torch.bfloat16)
+
+    def test_round_trip(self):
+        for dtype, max_rel_error in [("fp8", 0.05), ("int8", 0.02)]:
+            for granularity, num_groups, scale_shape in [
+                ("per_token", 3, (64, 3)),
+                ("per_channel", 1, (1, 96)),
+            ]:
+                with self.subTest(dtype=dtype, granularity=granularity):
+                    q, scale = quantize_hidden_states(
+                        self.hidden_states, dtype, granularity, num_groups
+                    )
+                    self.assertEqual(q.shape, self.hidden_states.shape)
+                    self.assertEqual(q.element_size(), 1)
+                    self.assertEqual(tuple(scale.shape), scale_shape)
+
+                    x_hat = dequantize_hidden_states(q, scale)
+                    self.assertEqual(x_hat.dtype, torch.bfloat16)
+                    error = compute_quantization_error(self.hidden_states, q, scale)
+                    self.assertLess(error["relative_error"], max_rel_error)
+                    self.assertGreater(error["compression_ratio"], 1.5)
+
+    def test_dataset_and_collator(self):
+        features = []
+        originals = []
+        # a one-token sample has per-token scales with a single row
+        for seq_len in [10, 16, 1]:
+            aux = torch.randn(seq_len, 96, dtype=torch.bfloat16)
+            last = torch.randn(seq_len, 32, dtype=torch.bfloat16)
+            q_aux, aux_scale = quantize_hidden_states(aux, "fp8", "per_token", 3)
+            q_last, last_scale = quantize_hidden_states(last, "fp8", "per_token", 1)
+            data = {
+                "input_ids": torch.arange(seq_len),
+                "loss_mask": torch.ones(seq_len, dtype=torch.long),
+                "aux_hidden_state": q_aux[None],
+                "hidden_state": q_last[None],
+                "aux_hidden_state_scale": aux_scale[None],
+                "hidden_state_scale": last_scale[None],
+                "quantize_granularity": "per_token",
+            }
+            features.append(OfflineEagle3Dataset.process_data(data, max_len=2048))
+            originals.append(
+                (
+                    dequantize_hidden_states(q_aux, aux_scale),
+                    dequantize_hidden_states(q_last, last_scale),
+                )
+            )
+
+        # the per-token target scales of the one-token sample are shifted too
+        self.assertTrue(torch.all(features[-1]["target_scale"] == 0))
+
+        batch = DataCollatorWithPadding()(features)
+        hidden_states = dequantize_hidden_states(
+            batch["hidden_state"], batch["hidden_state_scale"]
+        )
+        target = dequantize_hidden_states(batch["target"], batch["target_scale"])
+        for i, (aux, last) in enumerate(originals):
+            seq_len = aux.shape[0]
+            self.assertTrue(torch.equal(hidden_states[i, :seq_len], aux))
+            # the target is shifted by one token
+            self.assertTrue(torch.equal(target[i, : seq_len - 1], last[1:]))
+            self.assertTrue(torch.all(target[i, seq_len - 1 :] == 0))
+
+    def test_collator_per_channel(self):
+        features = []
+        for seq_len in [1, 4]:
+            q_aux, aux_scale = quantize_hidden_states(
+                torch.randn(seq_len, 96), "int8", "per_channel"
+            )
+            q_last, last_scale = quantize_hidden_states(
+                torch.randn(seq_len, 32), "int8", "per_channel"
+            )
+            data = {
+                "input_ids": torch.arange(seq_len),
+                "loss_mask": torch.ones(seq_len, dtype=torch.long),
+                "aux_hidden_state": q_aux[None],
+                "hidden_state": q_last[None],
+                "aux_hidden_state_scale": aux_scale[None],
+                "hidden_state_scale": last_scale[None],
+                "quantize_granularity": "per_channel",
+            }
+            features.append(OfflineEagle3Dataset.process_data(data, max_len=2048))
+
+        # the per-channel scales are shared by the tokens of a sample
+        batch = DataCollatorWithPadding()(features)
+        self.assertEqual(batch["hidden_state_scale"].shape, (2, 1, 96))
+        self.assertEqual(batch["target_scale"].shape, (2, 1, 32))
+
+        features[0]["quantize_granularity"] = "per_token"
+        with self.assertRaises(ValueError):
+            DataCollatorWithPadding()(features)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
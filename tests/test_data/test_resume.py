@@ -0,0 +1,69 @@
+import os
+import tempfile
+import unittest
+
+from torch.utils.data import DataLoader, DistributedSampler
+
+from specforge.data.utils import ResumableSampler, TokenBudgetBatchSampler
+from specforge.utils import get_last_checkpoint
+
+
+class TestResumableSampler(unittest.TestCase):
+
+    def test_skip_batches(self):
+        dataset = list(range(20))
+        sampler = ResumableSampler(
+            DistributedSampler(dataset, num_replicas=1, rank=0, seed=3), batch_size=4
+        )
+        dataloader = DataLoader(dataset, batch_size=4, sampler=sampler)
+        batches = [batch.tolist() for batch in dataloader]
+
+        # only the next iteration skips the batches
+        sampler.skip_batches(2)
+        self.assertEqual([batch.tolist() for batch in dataloader], batches[2:])
+        self.assertEqual([batch.tolist() for batch in dataloader], batches)
+
+        # the other attributes are those of the wrapped sampler
+        sampler.set_epoch(1)
+        self.assertEqual(sampler.epoch, 1)
+        self.assertNotEqual([batch.tolist() for batch in dataloader], batches)
+
+    def test_batch_sampler(self):
+        lengths = [(i * 37) % 100 + 1 for i in range(50)]
+        sampler = ResumableSampler(
+            TokenBudgetBatchSampler(lengths, max_tokens=256, shuffle=True)
+        )
+        batches = list(sampler)
+        self.assertEqual(len(sampler), len(batches))
+        sampler.skip_batches(3)
+        self.assertEqual(list(sampler), batches[3:])
+
+
+class TestGetLastCheckpoint(unittest.TestCase):
+
+    def test_step_checkpoints(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            self.assertIsNone(get_last_checkpoint(output_dir))
+            for name in [
+                "epoch_0_step_900",
+                "epoch_1_step_1000",
+                "epoch_1_step_200",
+                "epoch_2",
+                "runs",
+            ]:
+                os.makedirs(os.path.join(output_dir, name))
+            # a file is not a checkpoint
+            open(os.path.join(output_dir, "epoch_3_step_1"), "w").close()
+            self.assertEqual(
+                get_last_checkpoint(output_dir),
+                os.path.join(output_dir, "epoch_2"),
+            )
+            os.makedirs(os.path.join(output_dir, "epoch_2_step_1200"))
+            self.assertEqual(
+                get_last_checkpoint(output_dir),
+                os.path.join(output_dir, "epoch_2_step_1200"),
+            )
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,136 @@
+import os
+import pickle
+import tempfile
+import unittest
+
+import torch
+from torch.utils.data import DataLoader
+
+from specforge.data.manifest import compute_tensors_checksum
+from specforge.data.preprocessing import (
+    PackedOfflineEagle3Dataset,
+    build_offline_eagle3_dataset,
+)
+from specforge.data.shard import SHARD_CODECS, ShardReader, ShardWriter, list_shard_dirs
+
+
+def make_sample(seq_len, hidden_size=16):
+    return {
+        "input_ids": torch.randint(0, 1000, (seq_len,)),
+        "loss_mask": torch.randint(0, 2, (seq_len,)),
+        "hidden_state": torch.randn(seq_len, hidden_size, dtype=torch.bfloat16),
+        "aux_hidden_state": torch.randn(seq_len, hidden_size * 3, dtype=torch.bfloat16),
+    }
+
+
+class TestShard(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.output_dir = self.tmp_dir.name
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_write_and_read(self):
+        samples = [make_sample(seq_len) for seq_len in [5, 17, 1, 64, 33]]
+        metadata = {"quantize_granularity": "per_token"}
+        writer = ShardWriter(self.output_dir, samples_per_shard=2, metadata=metadata)
+        for sample_id, sample in enumerate(samples):
+            writer.write(sample_id, sample)
+        writer.close()
+
+        shard_dirs = list_shard_dirs(self.output_dir)
+        self.assertEqual(len(shard_dirs), 3)
+
+        readers = [ShardReader(shard_dir) for shard_dir in shard_dirs]
+        self.assertTrue(all(reader.metadata == metadata for reader in readers))
+        loaded = [reader[i] for reader in readers for i in range(len(reader))]
+        sample_ids = [sid for reader in readers for sid in reader.sample_ids]
+        self.assertEqual(sample_ids, list(range(len(samples))))
+
+        for expected, actual in zip(samples, loaded):
+            for key in expected:
+                self.assertEqual(expected[key].dtype, actual[key].dtype)
+                self.assertTrue(torch.equal(expected[key], actual[key]))
+
+        # readers must be picklable to be sent to the DataLoader workers
+        reader = pickle.loads(pickle.dumps(readers[0]))
+        self.assertTrue(torch.equal(reader[1]["input_ids"], samples[1]["input_ids"]))
+
+    def test_resume_discards_partial_shard(self):
+        writer = ShardWriter(self.output_dir, samples_per_shard=2)
+        for sample_id in range(3):
+            writer.write(sample_id, make_sample(4))
+        # simulate a crash: the third sample is in a shard without index
+        writer = ShardWriter(self.output_dir, samples_per_shard=2)
+        self.assertEqual(writer.completed_sample_ids, {0, 1})
+        self.assertEqual(len(os.listdir(self.output_dir)), 1)
+
+        writer.write(2, make_sample(4))
+        writer.close()
+        self.assertEqual(len(list_shard_dirs(self.output_dir)), 2)
+
+    def test_compressed_shards(self):
+        samples = [make_sample(seq_len) for seq_len in [5, 17, 64, 33]]
+        scales = [torch.rand(1, 16) for _ in samples]
+        for codec in SHARD_CODECS[1:]:
+            with self.subTest(codec=codec):
+                output_dir = os.path.join(self.output_dir, codec)
+                try:
+                    writer = ShardWriter(output_dir, samples_per_shard=3, codec=codec)
+                except ImportError:
+                    self.skipTest(f"{codec} is not installed")
+                for sample_id, (sample, scale) in enumerate(zip(samples, scales)):
+                    writer.write(sample_id, sample, {"hidden_state_scale": scale})
+                writer.close()
+
+                readers = [ShardReader(d) for d in list_shard_dirs(output_dir)]
+                self.assertEqual(readers[0].codec, codec)
+                loaded = [reader[i] for reader in readers for i in range(len(reader))]
+                for expected, scale, actual in zip(samples, scales, loaded):
+                    for key in expected:
+                        self.assertEqual(expected[key].dtype, actual[key].dtype)
+                        self.assertTrue(torch.equal(expected[key], actual[key]))
+                    self.assertTrue(torch.equal(actual["hidden_state_scale"], scale))
+                # the checksums are computed on the uncompressed bytes
+                self.assertEqual(
+                    readers[0].checksums[1],
+                    compute_tensors_checksum(readers[0][1].values()),
+                )
+
+                # the samples are decompressed in the worker processes
+                dataset = build_offline_eagle3_dataset(output_dir, max_len=16)
+                dataloader = DataLoader(dataset, batch_size=None, num_workers=2)
+                items = list(dataloader)
+                self.assertEqual(len(items), len(samples))
+                self.assertTrue(
+                    torch.equal(
+                        items[3]["hidden_state"][0],
+                        samples[3]["aux_hidden_state"][:16],
+                    )
+                )
+
+    def test_offline_dataset(self):
+        samples = [make_sample(seq_len) for seq_len in [8, 12, 20]]
+        writer = ShardWriter(self.output_dir, samples_per_shard=2)
+        for sample_id, sample in enumerate(samples):
+            writer.write(sample_id, sample)
+        writer.close()
+
+        dataset = build_offline_eagle3_dataset(self.output_dir, max_len=16)
+        self.assertIsInstance(dataset, PackedOfflineEagle3Dataset)
+        self.assertEqual(len(dataset), 3)
+
+        item = dataset[2]
+        self.assertEqual(item["hidden_state"].shape, (1, 16, 48))
+        self.assertEqual(item["target"].shape, (1, 16, 16))
+        self.assertEqual(item["input_ids"].shape, (1, 16))
+        self.assertTrue(
+            torch.equal(item["hidden_state"][0], samples[2]["aux_hidden_state"][:16])
+        )
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,101 @@
+import unittest
+
+import torch
+
+from specforge.data.parse import get_span_loss_mask, get_token_loss_mask
+from specforge.data.template import SeparatorTokenIds
+
+
+def reference_loss_mask(offsets, spans):
+    loss_mask = torch.zeros(len(offsets), dtype=torch.long)
+    for start, end in spans:
+        for idx, (token_start, token_end) in enumerate(offsets):
+            if token_end <= start or token_start > end:
+                continue
+            loss_mask[idx] = 1
+    return loss_mask
+
+
+class TestSpanLossMask(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def _random_offsets(self, num_tokens):
+        # contiguous tokens of 1 to 5 characters, some of them preceded by a space
+        lengths = torch.randint(1, 6, (num_tokens,))
+        gaps = torch.randint(0, 2, (num_tokens,))
+        ends = torch.cumsum(lengths + gaps, dim=0)
+        return torch.stack([ends - lengths, ends], dim=1)
+
+    def test_sorted_offsets(self):
+        for _ in range(20):
+            offsets = self._random_offsets(200)
+            num_chars = offsets[-1, 1].item()
+            bounds = sorted(torch.randint(0, num_chars + 5, (6,)).tolist())
+            spans = [(bounds[i], bounds[i + 1]) for i in range(0, len(bounds), 2)]
+            # spans touching the token boundaries and empty spans
+            spans += [(offsets[10, 0].item(), offsets[20, 1].item()), (5, 5)]
+            self.assertTrue(
+                torch.equal(
+                    get_span_loss_mask(offsets, spans),
+                    reference_loss_mask(offsets, spans),
+                )
+            )
+
+    def test_unsorted_offsets(self):
+        offsets = self._random_offsets(50)
+        # tokens mapped to (0, 0), e.g. the image tokens of a VLM processor
+        offsets[20:25] = 0
+        spans = [(3, 40), (offsets[30, 0].item(), offsets[45, 1].item())]
+        self.assertTrue(
+            torch.equal(
+                get_span_loss_mask(offsets, spans), reference_loss_mask(offsets, spans)
+            )
+        )
+
+    def test_empty(self):
+        offsets = self._random_offsets(10)
+        self.assertEqual(get_span_loss_mask(offsets, []).tolist(), [0] * 10)
+        empty_offsets = torch.zeros(0, 2, dtype=torch.long)
+        self.assertEqual(get_span_loss_mask(empty_offsets, [(0, 3)]).tolist(), [])
+
+
+class TestTokenLossMask(unittest.TestCase):
+    # 1: end of turn, 2: header start, 3: "assistant", 4: "user", 5: "\n", 6: "\n\n"
+    SEPARATORS = SeparatorTokenIds(
+        assistant=[1, 5, 2, 3], assistant_suffix=[5], user=[1, 5, 2, 4]
+    )
+
+    def _mask(self, input_ids, truncated=False):
+        loss_mask = get_token_loss_mask(
+            torch.tensor(input_ids), self.SEPARATORS, truncated=truncated
+        )
+        if loss_mask is None:
+            return None
+        return torch.nonzero(loss_mask).flatten().tolist()
+
+    def test_multiple_turns(self):
+        # fmt: off
+        input_ids = [2, 4, 5, 10, 11, 1, 5, 2, 3, 5, 12, 13, 1, 5, 2, 4, 5, 14, 1, 5, 2, 3, 5, 15, 1, 5]
+        # fmt: on
+        # the assistant messages, including the end of turn token of the first one
+        self.assertEqual(self._mask(input_ids), [10, 11, 12, 23, 24, 25])
+
+        # the whitespace of the header is merged with the message
+        input_ids[9] = 6
+        self.assertEqual(self._mask(input_ids), [9, 10, 11, 12, 23, 24, 25])
+
+    def test_truncated(self):
+        input_ids = [2, 4, 5, 10, 1, 5, 2, 3, 5, 12, 13, 1, 5, 2]
+        # the user separator is cut by the truncation
+        self.assertEqual(self._mask(input_ids, truncated=True), [9, 10, 11])
+        self.assertEqual(self._mask(input_ids), [9, 10, 11, 12, 13])
+
+    def test_no_assistant(self):
+        self.assertIsNone(self._mask([2, 4, 5, 10, 11]))
+        self.assertIsNone(self._mask([1, 5]))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
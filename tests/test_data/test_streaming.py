@@ -0,0 +1,102 @@
+import json
+import os
+import random
+import tempfile
+import unittest
+
+from specforge.data.streaming import (
+    StreamingEagle3Dataset,
+    read_chunk,
+    shuffle_buffer,
+    split_chunks,
+)
+
+
+class TestStreamingDataset(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.data_dir = self.tmp_dir.name
+        self.num_records = 0
+        for file_index, num_records in enumerate([57, 3, 40]):
+            path = os.path.join(self.data_dir, f"data_{file_index}.jsonl")
+            with open(path, "w") as f:
+                for _ in range(num_records):
+                    # records of different sizes so that the chunks end mid-line
+                    padding = "x" * (self.num_records % 13)
+                    record = {"id": self.num_records, "padding": padding}
+                    f.write(json.dumps(record) + "\n")
+                    self.num_records += 1
+                # blank lines are skipped
+                f.write("\n")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _make_dataset(self, **kwargs):
+        return StreamingEagle3Dataset(
+            self.data_dir, tokenizer=None, chat_template="llama3", **kwargs
+        )
+
+    def test_read_chunks(self):
+        files = sorted(
+            os.path.join(self.data_dir, name) for name in os.listdir(self.data_dir)
+        )
+        for chunk_size in [1, 7, 64, 1 << 20]:
+            ids = [
+                record["id"]
+                for chunk in split_chunks(files, chunk_size)
+                for record in read_chunk(chunk)
+            ]
+            self.assertEqual(ids, list(range(self.num_records)))
+
+    def test_shards(self):
+        dataset = self._make_dataset(chunk_size=128, shuffle_buffer_size=16, seed=3)
+        num_shards = 6
+        ids = [
+            [record["id"] for record in dataset.iter_records(shard, num_shards, 0)]
+            for shard in range(num_shards)
+        ]
+        # each record is read by exactly one shard
+        self.assertEqual(
+            sorted(i for shard_ids in ids for i in shard_ids),
+            list(range(self.num_records)),
+        )
+        # the order is reproducible from the seed and changes with the epoch
+        self.assertEqual(
+            [record["id"] for record in dataset.iter_records(2, num_shards, 0)], ids[2]
+        )
+        all_ids = [i for shard_ids in ids for i in shard_ids]
+        next_epoch_ids = [
+            record["id"]
+            for shard in range(num_shards)
+            for record in dataset.iter_records(shard, num_shards, 1)
+        ]
+        self.assertNotEqual(next_epoch_ids, all_ids)
+
+        # the files are split finer when there are more shards than chunks
+        dataset = self._make_dataset(chunk_size=1 << 20)
+        self.assertEqual(len(dataset.chunks), 3)
+        ids = [
+            record["id"]
+            for shard in range(8)
+            for record in dataset.iter_records(shard, 8, 0)
+        ]
+        self.assertEqual(sorted(ids), list(range(self.num_records)))
+
+    def test_shuffle_buffer(self):
+        items = list(range(100))
+        shuffled = list(shuffle_buffer(iter(items), 10, random.Random(0)))
+        self.assertEqual(sorted(shuffled), items)
+        self.assertNotEqual(shuffled, items)
+        self.assertEqual(
+            list(shuffle_buffer(iter(items), 10, random.Random(0))), shuffled
+        )
+        # a buffer larger than the stream
+        self.assertEqual(
+            sorted(shuffle_buffer(iter(items), 1000, random.Random(0))), items
+        )
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
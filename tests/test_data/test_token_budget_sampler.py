@@ -0,0 +1,92 @@
+import unittest
+
+from datasets import Dataset
+
+from specforge.data.utils import TokenBudgetBatchSampler, get_sample_lengths
+
+
+class TestTokenBudgetBatchSampler(unittest.TestCase):
+
+    def test_batches_fit_budget(self):
+        lengths = [5, 100, 30, 30, 7, 64, 12, 300, 1, 30]
+        sampler = TokenBudgetBatchSampler(lengths, max_tokens=128)
+
+        batches = list(sampler)
+        self.assertEqual(len(sampler), len(batches))
+        self.assertEqual(sorted(i for b in batches for i in b), list(range(10)))
+        for batch in batches:
+            padded_tokens = len(batch) * max(lengths[i] for i in batch)
+            # a sample longer than the budget has a batch of its own
+            self.assertTrue(padded_tokens <= 128 or len(batch) == 1)
+        # the longest samples come first, samples of the same length are ordered by index
+        self.assertEqual(batches, [[7], [1], [5, 2], [3, 9, 6, 4], [0, 8]])
+
+    def test_indices_and_max_batch_size(self):
+        lengths = [4] * 10
+        sampler = TokenBudgetBatchSampler(
+            lengths, max_tokens=1000, indices=range(100, 110), max_batch_size=3
+        )
+        self.assertEqual(
+            list(sampler),
+            [[100, 101, 102], [103, 104, 105], [106, 107, 108], [109]],
+        )
+        # the batches are deterministic
+        self.assertEqual(
+            list(sampler),
+            list(
+                TokenBudgetBatchSampler(
+                    lengths,
+                    max_tokens=1000,
+                    indices=range(100, 110),
+                    max_batch_size=3,
+                )
+            ),
+        )
+
+    def test_distributed(self):
+        lengths = [(i * 37) % 100 + 1 for i in range(50)]
+        batches = TokenBudgetBatchSampler(lengths, max_tokens=256).batches
+        num_replicas = 3
+        samplers = [
+            TokenBudgetBatchSampler(
+                lengths,
+                max_tokens=256,
+                num_replicas=num_replicas,
+                rank=rank,
+                shuffle=True,
+                seed=1,
+            )
+            for rank in range(num_replicas)
+        ]
+        rank_batches = [list(sampler) for sampler in samplers]
+        # all the ranks run as many steps and the batches are dealt without overlap
+        for sampler, rank_batch in zip(samplers, rank_batches):
+            self.assertEqual(len(rank_batch), len(batches) // num_replicas)
+            self.assertEqual(len(sampler), len(rank_batch))
+        dealt = [tuple(batch) for rank_batch in rank_batches for batch in rank_batch]
+        self.assertEqual(len(dealt), len(set(dealt)))
+        self.assertTrue(set(dealt) <= set(tuple(batch) for batch in batches))
+
+        # the order is reproducible and changes with the epoch
+        self.assertEqual(list(samplers[0]), rank_batches[0])
+        samplers[0].set_epoch(1)
+        self.assertNotEqual(list(samplers[0]), rank_batches[0])
+
+    def test_get_sample_lengths(self):
+        # the processed samples have shape (1, seq_len)
+        dataset = Dataset.from_dict(
+            {
+                "input_ids": [[[1] * n] for n in [3, 8, 1, 5]],
+                "loss_mask": [[[1] * n] for n in [3, 8, 1, 5]],
+            }
+        )
+        dataset.set_format(type="torch")
+        self.assertEqual(get_sample_lengths(dataset), [3, 8, 1, 5])
+        self.assertEqual(get_sample_lengths(dataset, 1, 3), [8, 1])
+
+        dataset = Dataset.from_dict({"input_ids": [[1] * n for n in [3, 8]]})
+        self.assertEqual(get_sample_lengths(dataset), [3, 8])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,92 @@
+import unittest
+
+import torch
+
+from specforge.core.eagle3 import (
+    _compute_target_p_padded_from_topk,
+    compute_topk_target_p,
+)
+from specforge.data.preprocessing import OfflineEagle3Dataset
+from specforge.data.utils import DataCollatorWithPadding
+from specforge.utils import padding
+
+
+class TestTopkTarget(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.vocab_size = 64
+        self.draft_vocab_size = 16
+        self.t2d = torch.zeros(self.vocab_size, dtype=torch.bool)
+        self.t2d[torch.randperm(self.vocab_size)[: self.draft_vocab_size]] = True
+
+    def test_full_topk_matches_dense(self):
+        target = torch.randn(2, 10, self.vocab_size)
+        loss_mask = torch.randint(0, 2, (2, 10, 1))
+        probs, indices, target_in_draft = compute_topk_target_p(
+            target, self.t2d, self.draft_vocab_size
+        )
+        self.assertEqual(probs.dtype, torch.float16)
+        self.assertEqual(indices.dtype, torch.int32)
+        self.assertEqual(tuple(target_in_draft.shape), (2, 10))
+
+        target_p_padded, position_mask = _compute_target_p_padded_from_topk(
+            probs,
+            indices,
+            target_in_draft,
+            self.draft_vocab_size,
+            loss_mask,
+            length=3,
+        )
+        self.assertEqual(tuple(target_p_padded.shape), (2, 13, self.draft_vocab_size))
+
+        expected_p = torch.softmax(target[..., self.t2d], dim=-1)
+        torch.testing.assert_close(
+            target_p_padded[:, :10], expected_p, rtol=1e-3, atol=1e-3
+        )
+        expected_mask = self.t2d[target.argmax(-1)][..., None].int() * loss_mask
+        self.assertTrue(torch.equal(position_mask, expected_mask))
+
+    def test_dataset_and_collator(self):
+        features = []
+        for seq_len in [7, 12]:
+            target = torch.randn(seq_len, self.vocab_size)
+            probs, indices, target_in_draft = compute_topk_target_p(
+                target, self.t2d, topk=4
+            )
+            data = {
+                "input_ids": torch.arange(seq_len),
+                "loss_mask": torch.ones(seq_len, dtype=torch.long),
+                "aux_hidden_state": torch.randn(1, seq_len, 24),
+                "hidden_state": None,
+                "target_topk_probs": probs,
+                "target_topk_indices": indices,
+                "target_in_draft": target_in_draft,
+            }
+            features.append(OfflineEagle3Dataset.process_data(data, max_len=2048))
+
+        batch = DataCollatorWithPadding()(features)
+        self.assertIsNone(batch["target"])
+        self.assertEqual(tuple(batch["hidden_state"].shape), (2, 12, 24))
+        self.assertEqual(tuple(batch["target_topk_probs"].shape), (2, 12, 4))
+        self.assertEqual(tuple(batch["target_topk_indices"].shape), (2, 12, 4))
+        self.assertEqual(tuple(batch["target_in_draft"].shape), (2, 12))
+        # the shifted-out and padded positions carry no probability mass
+        self.assertTrue(torch.all(batch["target_topk_probs"][0, 6:] == 0))
+        self.assertTrue(torch.all(batch["target_in_draft"][0, 6:] == 0))
+
+        # the batch is padded again before training like TargetHead.preprocess
+        target_p, position_mask = _compute_target_p_padded_from_topk(
+            padding(batch["target_topk_probs"], left=False),
+            padding(batch["target_topk_indices"], left=False),
+            padding(batch["target_in_draft"], left=False),
+            self.draft_vocab_size,
+            batch["loss_mask"][..., None],
+            length=1,
+        )
+        self.assertEqual(tuple(target_p.shape), (2, 13, self.draft_vocab_size))
+        self.assertEqual(tuple(position_mask.shape), (2, 12, 1))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
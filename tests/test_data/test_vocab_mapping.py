@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+from collections import Counter
+
+import torch
+from datasets import Dataset
+
+from specforge.data.preprocessing import (
+    count_masked_tokens,
+    generate_vocab_mapping_file,
+    process_token_dict_to_mappings,
+)
+
+
+def make_dataset(num_samples, vocab_size):
+    input_ids, loss_mask = [], []
+    for _ in range(num_samples):
+        seq_len = torch.randint(1, 50, (1,)).item()
+        # a skewed distribution so that the frequencies differ
+        # the processed samples have shape (1, seq_len)
+        input_ids.append([(torch.rand(seq_len) ** 3 * vocab_size).long().tolist()])
+        loss_mask.append([torch.randint(0, 2, (seq_len,)).tolist()])
+    dataset = Dataset.from_dict({"input_ids": input_ids, "loss_mask": loss_mask})
+    dataset.set_format(type="torch")
+    return dataset
+
+
+class TestVocabMapping(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def test_count_masked_tokens(self):
+        dataset = make_dataset(100, vocab_size=300)
+        expected = Counter()
+        for item in dataset:
+            expected.update(item["input_ids"][item["loss_mask"] == 1].tolist())
+
+        for num_proc in [None, 2]:
+            token_counts = count_masked_tokens(dataset, 500, num_proc=num_proc)
+            self.assertEqual(token_counts.shape, (500,))
+            self.assertEqual(
+                {i: c for i, c in enumerate(token_counts.tolist()) if c > 0},
+                dict(expected),
+            )
+
+    def test_mappings(self):
+        token_counts = torch.tensor([0, 5, 0, 7, 5, 1, 0, 9])
+        d2t, t2d = process_token_dict_to_mappings(token_counts, 4, 8)
+        # the ties between the tokens 1 and 4 are broken by token id
+        self.assertEqual((torch.arange(4) + d2t).tolist(), [1, 3, 4, 7])
+        self.assertEqual(t2d.tolist(), [i in [1, 3, 4, 7] for i in range(8)])
+
+        # there are less unique tokens than the draft vocab size, the vocab is
+        # completed with the smallest unseen token ids
+        d2t, t2d = process_token_dict_to_mappings(token_counts, 7, 8)
+        self.assertEqual((torch.arange(7) + d2t).tolist(), [0, 1, 2, 3, 4, 5, 7])
+
+        # the Counter input gives the same mapping
+        counter = Counter({1: 5, 3: 7, 4: 5, 5: 1, 7: 9})
+        d2t_counter, t2d_counter = process_token_dict_to_mappings(counter, 7, 8)
+        self.assertTrue(torch.equal(d2t, d2t_counter))
+        self.assertTrue(torch.equal(t2d, t2d_counter))
+
+    def test_generate_vocab_mapping_file(self):
+        dataset = make_dataset(50, vocab_size=200)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = generate_vocab_mapping_file(
+                dataset, target_vocab_size=200, draft_vocab_size=32, cache_dir=cache_dir
+            )
+            self.assertTrue(os.path.exists(path))
+            vocab_mapping = torch.load(path)
+        d2t, t2d = vocab_mapping["d2t"], vocab_mapping["t2d"]
+        self.assertEqual(d2t.shape, (32,))
+        self.assertEqual(t2d.dtype, torch.bool)
+        self.assertEqual(t2d.sum().item(), 32)
+        self.assertTrue(t2d[torch.arange(32) + d2t].all())
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,97 @@
+import os
+import unittest
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from specforge.modeling.target import (
+    Eagle3DataReceiver,
+    Eagle3DataSender,
+    Eagle3TargetOutput,
+    get_num_transfer_steps,
+)
+from tests.utils import get_available_port
+
+NUM_CONSUMERS = 2
+NUM_PRODUCERS = 3
+NUM_EPOCHS = 2
+
+
+def get_output(chunk):
+    # the outputs of the chunks have different lengths
+    seq_len = 4 + chunk % 3
+    return Eagle3TargetOutput(
+        hidden_states=torch.full((1, seq_len, 8), float(chunk), dtype=torch.bfloat16),
+        target=torch.rand(1, seq_len, 16, generator=torch.manual_seed(chunk)),
+        loss_mask=torch.ones(1, seq_len, 1, dtype=torch.int32),
+        input_ids=torch.full((1, seq_len), chunk, dtype=torch.int64),
+        attention_mask=torch.ones(1, seq_len, dtype=torch.bool),
+    )
+
+
+def run_transport(rank, world_size, port, num_batches, max_steps):
+    os.environ["MASTER_ADDR"] = "localhost"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    consumer_ranks = list(range(NUM_CONSUMERS))
+    producer_ranks = list(range(NUM_CONSUMERS, world_size))
+    producer_steps, consumer_steps = get_num_transfer_steps(
+        num_batches, NUM_PRODUCERS, NUM_CONSUMERS
+    )
+
+    if rank in producer_ranks:
+        sender = Eagle3DataSender(
+            rank - NUM_CONSUMERS, NUM_PRODUCERS, consumer_ranks, device="cpu"
+        )
+        for _ in range(NUM_EPOCHS * producer_steps):
+            if sender.next_consumer_step >= max_steps:
+                break
+            sender.send(get_output(sender.next_chunk))
+        sender.flush()
+    else:
+        receiver = Eagle3DataReceiver(
+            rank,
+            NUM_CONSUMERS,
+            producer_ranks,
+            num_steps=consumer_steps,
+            max_steps=max_steps,
+            device="cpu",
+        )
+        assert len(receiver) == consumer_steps
+        step = 0
+        while step < max_steps:
+            for output in receiver:
+                expected = get_output(step * NUM_CONSUMERS + rank)
+                for field in ["hidden_states", "target", "loss_mask", "input_ids"]:
+                    assert torch.equal(getattr(output, field), getattr(expected, field))
+                assert output.attention_mask.dtype == torch.bool
+                assert output.last_hidden_states is None
+                step += 1
+                if step == max_steps:
+                    break
+    dist.destroy_process_group()
+
+
+class TestTransport(unittest.TestCase):
+
+    def test_get_num_transfer_steps(self):
+        # every consumer receives as many chunks
+        self.assertEqual(get_num_transfer_steps(5, 3, 2), (4, 6))
+        self.assertEqual(get_num_transfer_steps(5, 2, 4), (4, 2))
+        self.assertEqual(get_num_transfer_steps(5, 4, 2), (5, 10))
+        self.assertEqual(get_num_transfer_steps(1, 1, 2), (0, 0))
+
+    def test_transport(self):
+        world_size = NUM_CONSUMERS + NUM_PRODUCERS
+        # the producers stop before the end of the second epoch
+        for max_steps in [12, 10]:
+            mp.spawn(
+                run_transport,
+                nprocs=world_size,
+                args=(world_size, get_available_port(), 5, max_steps),
+            )
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,127 @@
+import importlib.util
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+import torch
+import torch.multiprocessing as mp
+
+from specforge.data.manifest import (
+    get_partial_manifest_path,
+    load_manifest,
+    merge_manifests,
+    verify_manifest,
+)
+from specforge.distributed import destroy_distributed, init_distributed
+from tests.utils import get_available_port
+
+SCRIPT_PATH = Path(__file__).parent.parent.parent.joinpath(
+    "scripts", "prepare_hidden_states.py"
+)
+HIDDEN_SIZE = 16
+
+
+def load_script():
+    spec = importlib.util.spec_from_file_location("prepare_hidden_states", SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakeTargetModel:
+
+    def __init__(self):
+        self.num_calls = 0
+
+    def extend(self, input_ids, attention_mask, loss_mask, **kwargs):
+        self.num_calls += 1
+        aux_hidden_states_list, last_hidden_states_list = [], []
+        for row in input_ids:
+            seq_len = row.shape[0]
+            aux_hidden_states_list.append(
+                torch.randn(seq_len, 3 * HIDDEN_SIZE, device=row.device)
+            )
+            last_hidden_states_list.append(
+                torch.randn(seq_len, HIDDEN_SIZE, device=row.device)
+            )
+        return None, None, aux_hidden_states_list, last_hidden_states_list
+
+
+def make_batches(num_batches, batch_size=2, seq_len=8):
+    return [
+        {
+            "input_ids": torch.randint(0, 1000, (batch_size, seq_len)),
+            "attention_mask": torch.ones(batch_size, seq_len, dtype=torch.long),
+            "loss_mask": torch.ones(batch_size, seq_len, dtype=torch.long),
+        }
+        for _ in range(num_batches)
+    ]
+
+
+def run_generate(rank, world_size, port, output_dir):
+    os.environ["MASTER_ADDR"] = "localhost"
+    os.environ["MASTER_PORT"] = str(port)
+    os.environ["RANK"] = str(rank)
+    os.environ["WORLD_SIZE"] = str(world_size)
+    init_distributed(tp_size=1)
+    script = load_script()
+    batches = make_batches(3)
+
+    # the default ckpt format on a fresh output
+    target_model = FakeTargetModel()
+    with script.HiddenStatesGenerator(
+        target_model, num_io_threads=2, io_queue_size=2, file_group_size=4
+    ) as generator:
+        generator.generate(batches, output_dir, start_idx=0, samples_per_dp=6)
+    assert target_model.num_calls == 3
+
+    # a second run skips the samples recorded in the journal
+    target_model = FakeTargetModel()
+    with script.HiddenStatesGenerator(
+        target_model, num_io_threads=2, io_queue_size=2, file_group_size=4
+    ) as generator:
+        generator.generate(batches, output_dir, start_idx=0, samples_per_dp=6)
+    assert target_model.num_calls == 0
+
+    # the per-token scales of the aux hidden states are per captured layer
+    generator = script.HiddenStatesGenerator(target_model, quantize_dtype="int8")
+    fields = generator._process_sample_on_gpu(
+        torch.randn(8, 2 * HIDDEN_SIZE), torch.randn(8, HIDDEN_SIZE)
+    )
+    assert fields["aux_hidden_state_scale"].shape == (8, 2)
+    assert fields["hidden_state_scale"].shape == (8, 1)
+    destroy_distributed()
+
+
+class TestPrepareHiddenStates(unittest.TestCase):
+
+    @unittest.skipUnless(torch.cuda.is_available(), "CUDA is not available")
+    def test_generate_ckpt(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            mp.spawn(
+                run_generate,
+                nprocs=1,
+                args=(1, get_available_port(), output_dir),
+            )
+
+            self.assertEqual(
+                sorted(
+                    name for name in os.listdir(output_dir) if name.startswith("rows_")
+                ),
+                ["rows_0-4", "rows_4-8"],
+            )
+            merge_manifests([get_partial_manifest_path(output_dir, 0)], output_dir)
+            entries = load_manifest(output_dir)
+            self.assertEqual([entry.sample_id for entry in entries], list(range(6)))
+            self.assertEqual(verify_manifest(output_dir, entries), [])
+            data = torch.load(
+                os.path.join(output_dir, "rows_4-8", "data_5.ckpt"), weights_only=False
+            )
+            self.assertEqual(data["input_ids"].shape, (8,))
+            self.assertEqual(data["hidden_state"].shape, (1, 8, HIDDEN_SIZE))
+            self.assertEqual(data["aux_hidden_state"].shape, (1, 8, 3 * HIDDEN_SIZE))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
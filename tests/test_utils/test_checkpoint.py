@@ -0,0 +1,132 @@
+import os
+import tempfile
+import unittest
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from safetensors.torch import load_file
+from torch.distributed.device_mesh import init_device_mesh
+from torch.distributed.tensor import Shard, distribute_tensor
+from transformers import LlamaConfig
+
+from specforge.checkpoint import (
+    AsyncCheckpointer,
+    consolidate_checkpoint,
+    is_consolidated,
+    list_checkpoints,
+    remove_old_checkpoints,
+)
+from specforge.modeling.draft.llama3_eagle import LlamaForCausalLMEagle3
+from tests.utils import get_available_port
+
+CONFIG = LlamaConfig(
+    architectures=["LlamaForCausalLMEagle3"],
+    hidden_size=64,
+    intermediate_size=128,
+    num_attention_heads=4,
+    num_key_value_heads=2,
+    num_hidden_layers=1,
+    max_position_embeddings=256,
+    vocab_size=256,
+    draft_vocab_size=64,
+    tie_word_embeddings=False,
+)
+
+
+def get_draft_state_dict():
+    torch.manual_seed(0)
+    draft_model = LlamaForCausalLMEagle3(CONFIG).to(torch.bfloat16)
+    return {k: v for k, v in draft_model.state_dict().items() if "embed" not in k}
+
+
+def run_async_checkpointer(rank, world_size, port, output_dir):
+    os.environ["MASTER_ADDR"] = "localhost"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    mesh = init_device_mesh("cpu", (world_size,))
+    checkpointer = AsyncCheckpointer(max_checkpoints=2)
+
+    # each rank holds a shard of every weight
+    model_state_dict = {
+        k: distribute_tensor(v, mesh, [Shard(0)])
+        for k, v in get_draft_state_dict().items()
+    }
+    rank_state = {"optimizer": {"exp_avg": torch.full((4,), float(rank))}}
+    for step in [1, 2, 3]:
+        checkpoint_dir = os.path.join(output_dir, f"epoch_0_step_{step}")
+        if rank == 0:
+            CONFIG.save_pretrained(checkpoint_dir)
+        checkpointer.save(
+            checkpoint_dir, model_state_dict, rank_state, {"global_step": step}
+        )
+        # the host copy is taken when the save starts
+        rank_state["optimizer"]["exp_avg"] += 10
+    checkpointer.close()
+    dist.destroy_process_group()
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def test_list_checkpoints(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            for name in ["epoch_1_step_20", "epoch_0_step_30", "epoch_2", "runs"]:
+                os.makedirs(os.path.join(output_dir, name))
+                torch.save({}, os.path.join(output_dir, name, "training_state.pt"))
+            # the training state of an interrupted save is missing
+            os.makedirs(os.path.join(output_dir, "epoch_2_step_40"))
+            self.assertEqual(
+                [os.path.basename(path) for path in list_checkpoints(output_dir)],
+                ["epoch_0_step_30", "epoch_1_step_20", "epoch_2"],
+            )
+
+            remove_old_checkpoints(output_dir, max_checkpoints=2)
+            self.assertEqual(
+                sorted(os.listdir(output_dir)),
+                ["epoch_1_step_20", "epoch_2", "epoch_2_step_40", "runs"],
+            )
+
+    def test_async_checkpointer(self):
+        world_size = 2
+        with tempfile.TemporaryDirectory() as output_dir:
+            mp.spawn(
+                run_async_checkpointer,
+                nprocs=world_size,
+                args=(world_size, get_available_port(), output_dir),
+            )
+
+            # the oldest checkpoint was deleted
+            checkpoints = list_checkpoints(output_dir)
+            self.assertEqual(
+                [os.path.basename(path) for path in checkpoints],
+                ["epoch_0_step_2", "epoch_0_step_3"],
+            )
+            checkpoint_dir = checkpoints[-1]
+            training_state = torch.load(
+                os.path.join(checkpoint_dir, "training_state.pt")
+            )
+            self.assertEqual(training_state["global_step"], 3)
+            for rank in range(world_size):
+                rank_state = torch.load(
+                    os.path.join(checkpoint_dir, f"rank_{rank}_state.pt")
+                )
+                self.assertTrue(
+                    torch.equal(
+                        rank_state["optimizer"]["exp_avg"],
+                        torch.full((4,), rank + 20.0),
+                    )
+                )
+
+            # the shards are gathered into the save_pretrained format
+            self.assertFalse(is_consolidated(checkpoint_dir))
+            consolidate_checkpoint(checkpoint_dir)
+            self.assertTrue(is_consolidated(checkpoint_dir))
+            state_dict = load_file(os.path.join(checkpoint_dir, "model.safetensors"))
+            expected = get_draft_state_dict()
+            self.assertEqual(state_dict.keys(), expected.keys())
+            for key, value in expected.items():
+                self.assertTrue(torch.equal(state_dict[key], value), key)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
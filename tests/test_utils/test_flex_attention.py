@@ -2,6 +2,7 @@ import unittest
 
 import torch
 import torch._dynamo as dynamo
+from torch.nn.attention.flex_attention import create_mask
 from transformers import LlamaConfig
 from transformers.cache_utils import DynamicCache
 
@@ -9,6 +10,7 @@ from specforge.modeling.draft.flex_attention import (
     compile_friendly_create_block_mask,
     compile_friendly_flex_attention,
     generate_eagle3_mask,
+    generate_packed_eagle3_mask,
 )
 from specforge.modeling.draft.llama3_eagle import (
     LlamaAttention,
@@ -287,6 +289,82 @@ class TestEagle3FlexMask(unittest.TestCase):
             query, key_cache, value_cache, block_mask=block_mask
         )
 
+    def test_packed_eagle3_mask(self):
+        # three documents and two padding tokens packed in a row
+        document_lengths = [5, 3, 4]
+        Q_LEN = sum(document_lengths) + 2
+        position_ids = torch.cat(
+            [torch.arange(n) for n in document_lengths] + [torch.arange(2)]
+        )[None, :]
+        attention_mask = torch.ones(1, Q_LEN, dtype=torch.long)
+        attention_mask[:, -2:] = 0
+        for lck in range(4):
+            KV_LEN = Q_LEN * (lck + 1)
+            packed_mask = create_mask(
+                generate_packed_eagle3_mask(
+                    position_ids, attention_mask, Q_LEN=Q_LEN, KV_LEN=KV_LEN, lck=lck
+                ),
+                1,
+                1,
+                Q_LEN,
+                KV_LEN,
+                device="cpu",
+            )[0, 0]
+            # each document sees the mask it would have in a row of its own
+            expected_mask = torch.zeros(Q_LEN, KV_LEN, dtype=torch.bool)
+            start = 0
+            for n in document_lengths:
+                document_mask = create_mask(
+                    generate_eagle3_mask(
+                        seq_lengths=torch.tensor([n - lck]),
+                        Q_LEN=n,
+                        KV_LEN=n * (lck + 1),
+                        lck=lck,
+                    ),
+                    1,
+                    1,
+                    n,
+                    n * (lck + 1),
+                    device="cpu",
+                )[0, 0]
+                for step in range(lck + 1):
+                    expected_mask[
+                        start : start + n,
+                        step * Q_LEN + start : step * Q_LEN + start + n,
+                    ] = document_mask[:, step * n : (step + 1) * n]
+                start += n
+            self.assertTrue(torch.equal(packed_mask, expected_mask))
+
+            # a row holding a single document has the unpacked mask
+            single_mask = create_mask(
+                generate_packed_eagle3_mask(
+                    torch.arange(Q_LEN)[None, :],
+                    attention_mask,
+                    Q_LEN=Q_LEN,
+                    KV_LEN=KV_LEN,
+                    lck=lck,
+                ),
+                1,
+                1,
+                Q_LEN,
+                KV_LEN,
+                device="cpu",
+            )
+            unpacked_mask = create_mask(
+                generate_eagle3_mask(
+                    seq_lengths=attention_mask.sum(-1) - lck,
+                    Q_LEN=Q_LEN,
+                    KV_LEN=KV_LEN,
+                    lck=lck,
+                ),
+                1,
+                1,
+                Q_LEN,
+                KV_LEN,
+                device="cpu",
+            )
+            self.assertTrue(torch.equal(single_mask, unpacked_mask))
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)
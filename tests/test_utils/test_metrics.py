@@ -0,0 +1,53 @@
+import os
+import unittest
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from specforge.metrics import MetricAccumulator
+from tests.utils import get_available_port
+
+
+def run_metric_accumulator(rank, world_size, port):
+    os.environ["MASTER_ADDR"] = "localhost"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    metrics = MetricAccumulator(length=3, device="cpu")
+    assert metrics.collect() is None
+
+    # the steps of rank r have the losses r + step and the accuracies (r + step) / 10
+    for step in [1, 2]:
+        plosses = [torch.tensor(float(rank + step), requires_grad=True)] * 3
+        accuracies = [torch.tensor((rank + step) / 10)] * 3
+        metrics.update(plosses, accuracies)
+    metrics.reduce(step=2)
+    reduced = metrics.collect()
+    assert reduced.step == 2
+    # the averages over the steps and the ranks
+    expected = (1 + 2 + 2 + 3) / 4
+    assert reduced.plosses == [expected] * 3, reduced.plosses
+    assert all(abs(acc - expected / 10) < 1e-6 for acc in reduced.accuracies)
+    assert metrics.collect() is None
+    assert metrics.last is reduced
+
+    # the sums are reset by the reduce
+    metrics.update([torch.tensor(1.0)] * 3, [torch.tensor(0.5)] * 3)
+    metrics.reduce(step=3)
+    assert metrics.collect().plosses == [1.0] * 3
+    dist.destroy_process_group()
+
+
+class TestMetricAccumulator(unittest.TestCase):
+
+    def test_metric_accumulator(self):
+        world_size = 2
+        mp.spawn(
+            run_metric_accumulator,
+            nprocs=world_size,
+            args=(world_size, get_available_port()),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)